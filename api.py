@@ -0,0 +1,610 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+import uuid
+from datetime import date, datetime
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+
+import bulk_import
+import metrics
+import query_cache
+import reports
+import storage
+from pagination import TABLES
+from storage import get_repository
+from tenancy import tenant_scope
+
+# API REST/JSON per integrazioni (LMS, app mobile) accanto all'interfaccia Streamlit.
+# Letture e scritture passano dall'archivio configurato (storage.get_repository()): con
+# PLANNER_STORAGE=postgres più istanze dell'API su server diversi condividono gli stessi dati.
+# Le operazioni sul database sono sincrone e vengono eseguite nel thread pool di Starlette.
+
+# Chiave per firmare i token: va impostata se l'API gira con più processi o deve
+# sopravvivere ai riavvii, altrimenti ne viene generata una per processo
+SECRET = os.environ.get('PLANNER_API_SECRET') or secrets.token_hex(32)
+TOKEN_TTL = int(os.environ.get('PLANNER_API_TOKEN_TTL', str(12 * 3600)))
+
+MAX_PAGE_SIZE = 500
+GZIP_MINIMUM_SIZE = 1000
+MAX_BATCH_ROWS = 10000
+
+# Come in export.py: le generazioni ripartono da zero a ogni avvio, il token evita che un
+# ETag rilasciato da un processo precedente risulti ancora valido
+_PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+# Ordinamento predefinito delle liste paginate
+DEFAULT_SORT = {'students': 'ID', 'subjects': 'ID', 'lessons': 'Data'}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _json_default(value):
+    # Tipi prodotti da pandas e sqlite che json non sa serializzare; le date di pandas
+    # senza orario tornano nel formato AAAA-MM-GG usato dal database
+    if isinstance(value, datetime):
+        return value.date().isoformat() if value.time() == datetime.min.time() else value.isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f"Valore non serializzabile: {value!r}")
+
+
+def _json_response(data, status=200, headers=None):
+    body = json.dumps(data, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+    return Response(body, status_code=status, headers=headers, media_type='application/json')
+
+
+def _records(df):
+    # I NaN (ad esempio start_time assente) diventano null
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+# --- Autenticazione: token firmati con HMAC, senza stato sul server ---
+
+def _sign(payload):
+    return base64.urlsafe_b64encode(hmac.new(SECRET.encode(), payload, hashlib.sha256).digest()).rstrip(b'=')
+
+
+def issue_token(user_id, role, tenant_id):
+    payload = base64.urlsafe_b64encode(json.dumps(
+        [user_id, role, tenant_id, int(time.time()) + TOKEN_TTL]).encode()).rstrip(b'=')
+    return (payload + b'.' + _sign(payload)).decode()
+
+
+def read_token(token):
+    # Restituisce (id utente, ruolo, tenant) oppure None se il token non è valido o è scaduto
+    try:
+        payload, signature = token.encode().split(b'.')
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        user_id, role, tenant_id, expires = json.loads(base64.urlsafe_b64decode(payload + b'=' * (-len(payload) % 4)))
+    except ValueError:
+        return None
+    return (user_id, role, tenant_id) if expires > time.time() else None
+
+
+def _user(request):
+    header = request.headers.get('authorization', '')
+    user = read_token(header[7:]) if header.lower().startswith('bearer ') else None
+    if user is None:
+        raise ApiError(401, "Token mancante o non valido")
+    if user[1] != 'insegnante':
+        raise ApiError(403, "Accesso riservato agli insegnanti")
+    return user
+
+
+async def _body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise ApiError(400, "Corpo della richiesta non valido: è richiesto JSON")
+
+
+def _field(data, name, convert=str, required=True):
+    value = data.get(name)
+    if value is None or value == '':
+        if required:
+            raise ApiError(400, f"Campo '{name}' mancante")
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, f"Valore non valido per '{name}': {value}")
+
+
+def _query_date(request, name):
+    value = request.query_params.get(name)
+    if value is None:
+        raise ApiError(400, f"Parametro '{name}' mancante")
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ApiError(400, f"Data non valida per '{name}': {value}")
+
+
+def _query_int(request, name, default=None):
+    value = request.query_params.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ApiError(400, f"Valore non valido per '{name}': {value}")
+
+
+# --- Esecuzione nel thread pool con tenant e cache allineati ---
+
+def _run(tenant_id, func, *args):
+    with tenant_scope(tenant_id):
+        # Scritture fatte da altri processi (l'interfaccia Streamlit o altri worker dell'API)
+        if storage.STORAGE == 'sqlite':
+            query_cache.sync()
+        return func(*args)
+
+
+def _etag(tables, request, tenant_id):
+    # Calcolato dalle generazioni delle tabelle, senza eseguire la query: una richiesta
+    # condizionale su dati invariati non tocca il database. Le generazioni sono comuni a tutti
+    # i tenant, quindi il tenant fa parte dell'ETag.
+    generations = '-'.join(str(query_cache.generation(t)) for t in tables)
+    target = hashlib.sha1(f'{tenant_id}:{request.url.path}?{request.url.query}'.encode()).hexdigest()[:16]
+    return f'W/"{_PROCESS_TOKEN}-{generations}-{target}"'
+
+
+def _content_etag(data, request, tenant_id):
+    # Con PostgreSQL le generazioni locali non vedono le scritture degli altri server:
+    # l'ETag è calcolato dal contenuto della risposta (si risparmia solo la trasmissione)
+    body = json.dumps(data, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+    return 'W/"' + hashlib.sha1(f'{tenant_id}:{request.url.path}:{body}'.encode()).hexdigest()[:24] + '"'
+
+
+async def _conditional_get(request, tenant_id, tables, compute):
+    # GET con ETag/If-None-Match: 304 se il client ha già la versione corrente
+    def read():
+        matches = [t.strip() for t in request.headers.get('if-none-match', '').split(',')]
+        if storage.STORAGE != 'sqlite':
+            data = compute()
+            etag = _content_etag(data, request, tenant_id)
+            return etag, None if etag in matches else data
+        etag = _etag(tables, request, tenant_id)
+        if etag in matches:
+            return etag, None
+        return etag, compute()
+
+    etag, data = await run_in_threadpool(_run, tenant_id, read)
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if data is None:
+        return Response(status_code=304, headers=headers)
+    return _json_response(data, headers=headers)
+
+
+def _endpoint(handler):
+    # Converte gli errori applicativi in risposte JSON
+    async def endpoint(request):
+        try:
+            return await handler(request)
+        except ApiError as e:
+            return _json_response({'error': e.message}, status=e.status)
+    return endpoint
+
+
+# --- Login ---
+
+async def login(request):
+    data = await _body(request)
+    username, password = _field(data, 'username'), _field(data, 'password')
+    user = await run_in_threadpool(get_repository().authenticate_user, username, password)
+    if user is None:
+        raise ApiError(401, "Credenziali non valide")
+    user_id, role, _, tenant_id = user
+    return _json_response({'token': issue_token(user_id, role, tenant_id), 'expires_in': TOKEN_TTL,
+                           'role': role, 'tenant_id': tenant_id})
+
+
+# --- Liste paginate e singoli elementi ---
+
+def _encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(cursor, default=_json_default).encode()).decode().rstrip('=')
+
+
+def _decode_cursor(value):
+    if value is None:
+        return None
+    try:
+        return tuple(json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))))
+    except ValueError:
+        raise ApiError(400, "Cursore non valido")
+
+
+def _list(table):
+    async def handler(request):
+        user = _user(request)
+        params = request.query_params
+        sort = params.get('sort', DEFAULT_SORT[table])
+        if sort not in TABLES[table]['sort']:
+            raise ApiError(400, f"Ordinamento non valido: {sort}")
+        limit = min(max(_query_int(request, 'limit', 25), 1), MAX_PAGE_SIZE)
+        descending = params.get('desc', 'false').lower() in ('1', 'true')
+        after = _decode_cursor(params.get('after'))
+
+        def compute():
+            df, cursor = get_repository().fetch_page(table, sort, descending, params.get('search') or None,
+                                                     after, limit)
+            return {'items': _records(df), 'next': _encode_cursor(cursor)}
+
+        return await _conditional_get(request, user[2], TABLES[table]['tables'], compute)
+    return handler
+
+
+# Metodo dell'archivio che legge un elemento e tabelle da cui dipende
+_GETTERS = {
+    'students': ('get_student', ('students',)),
+    'subjects': ('get_subject', ('subjects',)),
+    'lessons': ('get_lesson', ('lessons',)),
+}
+
+
+def _get(table, item_id):
+    return getattr(get_repository(), _GETTERS[table][0])(item_id)
+
+
+def _detail(table):
+    tables = _GETTERS[table][1]
+
+    async def handler(request):
+        user = _user(request)
+
+        def compute():
+            item = _get(table, request.path_params['id'])
+            if item is None:
+                raise ApiError(404, "Elemento non trovato")
+            return item
+
+        return await _conditional_get(request, user[2], tables, compute)
+    return handler
+
+
+# --- Scritture ---
+
+def _merged(data, current, name, convert=str, required=True):
+    # Negli aggiornamenti i campi assenti mantengono il valore attuale
+    if current is not None and name not in data:
+        return current[name]
+    return _field(data, name, convert, required)
+
+
+def _student_values(data, current=None):
+    return (_merged(data, current, 'name'), _merged(data, current, 'email'),
+            _merged(data, current, 'hourly_cost', float))
+
+
+def _iso_date(value):
+    return date.fromisoformat(str(value)[:10]).isoformat()
+
+
+def _lesson_values(data, current=None):
+    return (_merged(data, current, 'student_id', int), _merged(data, current, 'subject_id', int),
+            _merged(data, current, 'date', _iso_date), _merged(data, current, 'duration', float),
+            _merged(data, current, 'notes', required=False), _merged(data, current, 'start_time', required=False))
+
+
+def _create_student(data):
+    student_id = get_repository().add_student(*_student_values(data))
+    if not student_id:
+        raise ApiError(409, "Email già registrata")
+    return {'id': student_id}
+
+
+def _teacher(data, current):
+    # teacher_id indicato dal client: deve essere un insegnante del tenant del chiamante
+    teacher_id = _merged(data, current, 'teacher_id', int)
+    if 'teacher_id' in data and not get_repository().is_teacher(teacher_id):
+        raise ApiError(422, "Insegnante non valido")
+    return teacher_id
+
+
+def _create_subject(data, teacher_id):
+    if data.get('teacher_id') not in (None, ''):
+        teacher_id = _teacher(data, None)
+    return {'id': get_repository().add_subject(_field(data, 'name'), teacher_id)}
+
+
+def _create_lesson(data):
+    # Il repository rifiuta con ValueError studenti e materie di altri tenant: 400, non 201
+    try:
+        success, message = get_repository().add_lesson(*_lesson_values(data))
+    except ValueError as e:
+        raise ApiError(400, str(e))
+    if not success:
+        raise ApiError(409, message)
+    return {'message': message}
+
+
+def _update(table, item_id, data):
+    repository = get_repository()
+    current = _get(table, item_id)
+    if current is None:
+        raise ApiError(404, "Elemento non trovato")
+    if table == 'students':
+        if not repository.update_student(item_id, *_student_values(data, current)):
+            raise ApiError(409, "Email già registrata")
+    elif table == 'subjects':
+        if not repository.update_subject(item_id, _merged(data, current, 'name'), _teacher(data, current)):
+            raise ApiError(500, "Errore durante l'aggiornamento della materia")
+    else:
+        try:
+            success, message = repository.update_lesson(item_id, *_lesson_values(data, current))
+        except ValueError as e:
+            raise ApiError(400, str(e))
+        if not success:
+            raise ApiError(409, message)
+    return _get(table, item_id)
+
+
+_DELETES = {'students': 'delete_student', 'subjects': 'delete_subject', 'lessons': 'delete_lesson'}
+
+
+def _delete(table, item_id):
+    if _get(table, item_id) is None:
+        raise ApiError(404, "Elemento non trovato")
+    success, message = getattr(get_repository(), _DELETES[table])(item_id)
+    if not success:
+        raise ApiError(409, message)
+    return {'message': message}
+
+
+def _create(table):
+    async def handler(request):
+        user = _user(request)
+        data = await _body(request)
+        if not isinstance(data, dict):
+            raise ApiError(400, "È richiesto un oggetto JSON")
+        if table == 'students':
+            result = await run_in_threadpool(_run, user[2], _create_student, data)
+        elif table == 'subjects':
+            result = await run_in_threadpool(_run, user[2], _create_subject, data, user[0])
+        else:
+            result = await run_in_threadpool(_run, user[2], _create_lesson, data)
+        return _json_response(result, status=201)
+    return handler
+
+
+def _insert_each(table, rows, teacher_id):
+    # L'importazione massiva scrive direttamente sulle tabelle SQLite: con gli altri archivi ogni
+    # riga passa dal repository come una POST singola (stessi campi, una transazione per riga)
+    create = {'students': _create_student, 'subjects': lambda data: _create_subject(data, teacher_id),
+              'lessons': _create_lesson}[table]
+    inserted, errors = 0, []
+    for index, row in enumerate(rows):
+        try:
+            create(row)
+            inserted += 1
+        except ApiError as e:
+            errors.append({'index': index, 'error': e.message})
+    return {'inserted': inserted, 'errors': errors}
+
+
+def _batch(table):
+    # Inserimento di molte righe con le regole dell'importazione massiva: executemany a blocchi
+    # in un'unica transazione per blocco, conflitti verificati in memoria, righe non valide scartate
+    async def handler(request):
+        user = _user(request)
+        rows = await _body(request)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ApiError(400, "È richiesta una lista di oggetti JSON")
+        if len(rows) > MAX_BATCH_ROWS:
+            raise ApiError(413, f"Massimo {MAX_BATCH_ROWS} righe per richiesta")
+        if storage.STORAGE != 'sqlite':
+            result = await run_in_threadpool(_run, user[2], _insert_each, table, rows, user[0])
+            return _json_response(result, status=201 if result['inserted'] else 200)
+        result = await run_in_threadpool(_run, user[2], bulk_import.import_rows, table, rows, user[0])
+        # Indici delle righe nella lista inviata invece dei numeri di riga del file
+        return _json_response({'inserted': result.inserted,
+                               'errors': [{'index': row_number - 2 if row_number else None, 'error': message}
+                                          for row_number, message in result.errors]},
+                              status=201 if result.inserted else 200)
+    return handler
+
+
+def _change(table):
+    async def handler(request):
+        user = _user(request)
+        item_id = request.path_params['id']
+        if request.method == 'DELETE':
+            return _json_response(await run_in_threadpool(_run, user[2], _delete, table, item_id))
+        data = await _body(request)
+        if not isinstance(data, dict):
+            raise ApiError(400, "È richiesto un oggetto JSON")
+        return _json_response(await run_in_threadpool(_run, user[2], _update, table, item_id, data))
+    return handler
+
+
+# --- Report ---
+
+async def report_totals(request):
+    user = _user(request)
+    start, end = _query_date(request, 'start'), _query_date(request, 'end')
+    period = request.query_params.get('period', 'Mensile')
+    if period not in reports.PERIODS:
+        raise ApiError(400, f"Periodo non valido: {period}")
+    student_id = _query_int(request, 'student_id')
+
+    def compute():
+        df = get_repository().get_report_totals(start, end, period, student_id).reset_index()
+        return {'items': _records(df)}
+
+    return await _conditional_get(request, user[2], ('lessons', 'students', 'lesson_series', 'billing_summary'),
+                                  compute)
+
+
+async def report_lessons(request):
+    user = _user(request)
+    start, end = _query_date(request, 'start'), _query_date(request, 'end')
+    student_id = _query_int(request, 'student_id')
+
+    def compute():
+        return {'items': _records(get_repository().get_lessons_in_range(start, end, student_id))}
+
+    return await _conditional_get(request, user[2], ('lessons', 'students', 'subjects'), compute)
+
+
+# --- Metriche ---
+
+async def metrics_endpoint(request):
+    # Istogrammi in formato Prometheus, solo per richieste dalla macchina locale
+    if request.client is None or request.client.host not in ('127.0.0.1', '::1'):
+        raise ApiError(403, "Metriche disponibili solo in locale")
+    return Response(metrics.exposition(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _routes():
+    routes = [Route('/api/token', _endpoint(login), methods=['POST'])]
+    for table in ('students', 'subjects', 'lessons'):
+        routes += [
+            Route(f'/api/{table}', _endpoint(_list(table)), methods=['GET']),
+            Route(f'/api/{table}', _endpoint(_create(table)), methods=['POST']),
+            Route(f'/api/{table}/batch', _endpoint(_batch(table)), methods=['POST']),
+            Route(f'/api/{table}/{{id:int}}', _endpoint(_detail(table)), methods=['GET']),
+            Route(f'/api/{table}/{{id:int}}', _endpoint(_change(table)), methods=['PUT', 'PATCH', 'DELETE']),
+        ]
+    routes += [
+        Route('/api/reports/totals', _endpoint(report_totals), methods=['GET']),
+        Route('/api/reports/lessons', _endpoint(report_lessons), methods=['GET']),
+    ]
+    if metrics.ENABLED:
+        routes.append(Route('/metrics', _endpoint(metrics_endpoint), methods=['GET']))
+    return routes
+
+
+def create_app():
+    # Con SQLite crea o aggiorna lo schema (init_db), con PostgreSQL apre il pool
+    get_repository()
+    return Starlette(routes=_routes(), middleware=[Middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)])
+
+
+# --- Generatore di carico locale ---
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def load_test(base_url, username, password, paths, requests=1000, concurrency=8, write_ratio=0.0,
+              conditional=True):
+    # Richieste GET (e una quota di POST di lezioni) da concurrency thread con connessioni
+    # keep-alive. Restituisce un dizionario con throughput e latenze in millisecondi.
+    import http.client
+    import random
+    from urllib.parse import urlsplit
+
+    url = urlsplit(base_url)
+
+    def connect():
+        return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+
+    conn = connect()
+    conn.request('POST', '/api/token', json.dumps({'username': username, 'password': password}),
+                 {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    if response.status != 200:
+        raise RuntimeError(f"Login non riuscito: {response.status} {response.read().decode()}")
+    token = json.loads(response.read())['token']
+    conn.close()
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = connect()
+        etags = {}
+        local = []
+        local_statuses = {}
+        for n in counter:
+            headers = {'Authorization': f'Bearer {token}', 'Accept-Encoding': 'gzip'}
+            if rng.random() < write_ratio:
+                method, path = 'POST', '/api/lessons/batch'
+                day = date.fromordinal(date(2030, 1, 1).toordinal() + n % 3650).isoformat()
+                body = json.dumps([{'student_id': 1, 'subject_id': 1, 'date': day, 'duration': 1}])
+                headers['Content-Type'] = 'application/json'
+            else:
+                method, path, body = 'GET', rng.choice(paths), None
+                if conditional and path in etags:
+                    headers['If-None-Match'] = etags[path]
+            started = time.perf_counter()
+            client.request(method, path, body, headers)
+            response = client.getresponse()
+            response.read()
+            local.append((time.perf_counter() - started) * 1000)
+            local_statuses[response.status] = local_statuses.get(response.status, 0) + 1
+            if method == 'GET' and response.getheader('ETag'):
+                etags[path] = response.getheader('ETag')
+        client.close()
+        with lock:
+            latencies.extend(local)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {'requests': len(latencies), 'seconds': round(elapsed, 3),
+            'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(_percentile(latencies, 0.5), 2), 'p95_ms': round(_percentile(latencies, 0.95), 2),
+            'p99_ms': round(_percentile(latencies, 0.99), 2), 'statuses': statuses}
+
+
+DEFAULT_BENCH_PATHS = ['/api/students?limit=50', '/api/subjects', '/api/lessons?limit=100&desc=true',
+                       '/api/reports/totals?start=2024-01-01&end=2024-12-31&period=Mensile']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='API REST/JSON del planner')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve = subparsers.add_parser('serve', help='avvia il server (uvicorn)')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--workers', type=int, default=1, help='con più processi impostare PLANNER_API_SECRET')
+    bench = subparsers.add_parser('bench', help='generatore di carico contro un server avviato')
+    bench.add_argument('--url', default='http://127.0.0.1:8000')
+    bench.add_argument('--username', default='admin')
+    bench.add_argument('--password', default='admin')
+    bench.add_argument('--requests', type=int, default=2000)
+    bench.add_argument('--concurrency', type=int, default=8)
+    bench.add_argument('--write-ratio', type=float, default=0.0, help='quota di richieste di scrittura (0-1)')
+    bench.add_argument('--no-etag', action='store_true', help='non inviare If-None-Match')
+    bench.add_argument('--path', action='append', help='percorso da interrogare (ripetibile)')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        import uvicorn
+        uvicorn.run('api:create_app', factory=True, host=args.host, port=args.port, workers=args.workers)
+    else:
+        print(json.dumps(load_test(args.url, args.username, args.password, args.path or DEFAULT_BENCH_PATHS,
+                                   args.requests, args.concurrency, args.write_ratio, not args.no_etag), indent=2))
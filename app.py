@@ -1,19 +1,50 @@
+import json
+import os
 import streamlit as st
-import sqlite3
 import pandas as pd
-import io
 from datetime import datetime
 
 # Configurazione iniziale della pagina
 st.set_page_config(page_title='Planner Lezioni', layout='wide')
 
 # Funzioni di gestione database e autenticazione saranno implementate qui
-from database import init_db, authenticate_user, get_user_role, add_student, add_subject, add_lesson, \
-    update_student, delete_student, update_subject, delete_subject, update_lesson, delete_lesson, \
-    get_student, get_subject, get_lesson
+import metrics
+import query_cache
+import storage
+import tenancy
+from auth import login_throttle
+from database import reset_student_password
+from reports import has_lessons, get_students_in_range, get_student_summary, get_upcoming_lessons, \
+    get_past_lessons
+from calendar_data import get_month_summary
+from billing import get_month_billing, month_key
+from journal import OPERATIONS as JOURNAL_OPERATIONS, history as journal_history
+from components import render_job, render_lesson_search, render_paginated_table
+from bulk_import import COLUMNS
+from export import FORMATS as EXPORT_FORMATS
+from jobs import fingerprint as data_fingerprint, load_result as load_job_result, submit as submit_job
+from recurrence import WEEKDAYS, FREQUENCIES, add_series, add_exception, delete_series, get_series, \
+    get_series_lessons_in_range, materialize
+from scheduler import problem_from_spec, solve, rows as timetable_rows, apply_timetable
 
-# Inizializzazione database
-init_db()
+# Calendario, ricerca, serie, fatturazione e attività in background leggono direttamente da
+# SQLite: con PLANNER_STORAGE=postgres i dati condivisi tra più server sono disponibili tramite l'API
+if storage.STORAGE != 'sqlite':
+    st.error("L'interfaccia richiede PLANNER_STORAGE=sqlite; con PostgreSQL usare l'API (api.py)")
+    st.stop()
+
+# Inizializzazione database e archivio usato per studenti, materie, lezioni e report
+repository = storage.get_repository()
+
+# Endpoint locale delle metriche (solo se PLANNER_METRICS=1 e PLANNER_METRICS_PORT sono impostate)
+metrics.start_server()
+
+# Report su periodi più lunghi di così vengono calcolati in background
+LARGE_REPORT_DAYS = 366
+
+# Navigazione della dashboard insegnante: con 'sezioni' viene eseguita solo la sezione scelta,
+# con 'tab' tutte le sezioni sono disegnate a ogni esecuzione dentro st.tabs
+NAVIGATION = os.environ.get('PLANNER_NAVIGATION', 'sezioni')
 
 # Gestione sessione
 def main():
@@ -27,15 +58,23 @@ def main():
             submitted = st.form_submit_button("Login")
             
             if submitted:
-                user = authenticate_user(username, password)
+                attesa = login_throttle.retry_after(username)
+                user = None if attesa else repository.authenticate_user(username, password)
                 if user:
                     st.session_state.logged_in = True
-                    st.session_state.user_role = get_user_role(username)
+                    (st.session_state.user_id, st.session_state.user_role, st.session_state.student_id,
+                     st.session_state.tenant_id) = user
                     st.session_state.username = username
                     st.rerun()
+                elif attesa:
+                    st.error(f"Troppi tentativi non riusciti: riprova tra {int(attesa) + 1} secondi")
                 else:
                     st.error("Credenziali non valide")
     else:
+        # Tutte le query di questa esecuzione vedono solo i dati del tenant dell'utente
+        tenancy.activate(st.session_state.tenant_id)
+        # Scritture arrivate da altri processi, ad esempio tramite l'API
+        query_cache.sync()
         if st.button("Logout"):
             st.session_state.clear()
             st.rerun()
@@ -45,94 +84,115 @@ def main():
         else:
             render_student_dashboard()
 
+@metrics.timed()
 def render_teacher_dashboard():
     st.title('Dashboard Insegnante')
     
-    # Definizione delle tab
-    tab_names = ["Studenti", "Materie", "Pianificazione Lezioni", "Report"]
-    
-    # Crea i tab
-    tabs = st.tabs(tab_names)
-    
-    # Contenuto delle tab
-    with tabs[0]:  # Tab Studenti
-        render_students_tab()
-    
-    with tabs[1]:  # Tab Materie
-        render_subjects_tab()
-    
-    with tabs[2]:  # Tab Pianificazione Lezioni
-        render_lessons_tab()
-    
-    with tabs[3]:  # Tab Report
-        render_reports_tab()
+    # Statistiche della cache delle query
+    with st.sidebar.expander('Cache query'):
+        cache_stats = query_cache.stats()
+        st.write(f"Hit: {cache_stats['hits']} — Miss: {cache_stats['misses']} ({cache_stats['hit_rate']:.0%})")
+        st.write(f"Voci: {cache_stats['entries']} — Memoria: {cache_stats['bytes'] / 1024:.0f} / {cache_stats['max_bytes'] / 1024:.0f} KB")
+        st.write(f"Evizioni: {cache_stats['evictions']} — Invalidazioni: {cache_stats['invalidations']}")
+    
+    # Tempi di query e pagine, con il log delle query lente
+    if metrics.ENABLED:
+        render_metrics_panel()
+    
+    # Sezioni della dashboard
+    sections = {
+        "Studenti": render_students_tab,
+        "Materie": render_subjects_tab,
+        "Pianificazione Lezioni": render_lessons_tab,
+        "Report": render_reports_tab,
+        "Importazione": render_import_tab,
+    }
+    
+    # Sezione richiesta da un'altra sezione (es. modifica di una lezione dal calendario):
+    # va impostata prima di creare il widget di navigazione
+    if 'next_section' in st.session_state:
+        st.session_state.teacher_section = st.session_state.pop('next_section')
+    
+    if NAVIGATION == 'tab':
+        for tab, render_section in zip(st.tabs(list(sections)), sections.values()):
+            with tab:
+                render_section()
+        return
     
+    # Solo la sezione visibile esegue le sue query e costruisce i suoi widget
+    section = st.radio('Sezione', list(sections), horizontal=True, label_visibility='collapsed',
+                       key='teacher_section')
+    sections[section]()
+
+
+def render_metrics_panel():
+    with st.sidebar.expander('Metriche'):
+        righe = metrics.summary()
+        if righe:
+            st.dataframe(pd.DataFrame(righe), hide_index=True,
+                         column_config={col: st.column_config.NumberColumn(format='%.2f')
+                                        for col in ('totale_ms', 'media_ms', 'p95_ms', 'max_ms')})
+        else:
+            st.info('Nessuna misura registrata')
+        lente = metrics.slow_queries(20)
+        st.write(f"Query lente (oltre {metrics.SLOW_QUERY_MS:g} ms): {len(lente)}")
+        for record in lente:
+            st.code(f"{record['ts']} — {record['ms']:.1f} ms\n{record['sql']}\n"
+                    f"parametri: {record['params']}\n" + '\n'.join(record['plan']), language=None)
+        if st.button('Azzera metriche'):
+            metrics.reset()
+            st.rerun()
+
+
+@metrics.timed()
 def render_students_tab():
     # Gestione stato per modifica studente
     if 'edit_student_id' not in st.session_state:
         st.session_state.edit_student_id = None
     
-    # Visualizza lista studenti esistenti
-    conn = sqlite3.connect('planner.db')
-    students_df = pd.read_sql('SELECT id, name, email, hourly_cost FROM students', conn)
-    conn.close()
-    
-    if not students_df.empty:
-        st.subheader('Studenti Registrati')
-        
-        # Aggiungi colonne per i pulsanti di modifica e cancellazione
-        col1, col2, col3, col4, col5, col6 = st.columns([1, 2, 2, 1, 0.5, 0.5])
+    # Visualizza lista studenti esistenti, una pagina alla volta
+    def render_student_row(row, cols):
+        col1, col2, col3, col4, col5, col6 = cols
         with col1:
-            st.write("ID")
+            st.write(row['id'])
         with col2:
-            st.write("Nome")
+            st.write(row['name'])
         with col3:
-            st.write("Email")
+            st.write(row['email'])
         with col4:
-            st.write("Costo Orario")
+            st.write(f"€{row['hourly_cost']:.2f}")
         with col5:
-            st.write("Modifica")
+            if st.button("✏️", key=f"edit_student_{row['id']}"):
+                st.session_state.edit_student_id = row['id']
+                st.rerun()
         with col6:
-            st.write("Elimina")
-        
-        for _, row in students_df.iterrows():
-            col1, col2, col3, col4, col5, col6 = st.columns([1, 2, 2, 1, 0.5, 0.5])
-            with col1:
-                st.write(row['id'])
-            with col2:
-                st.write(row['name'])
-            with col3:
-                st.write(row['email'])
-            with col4:
-                st.write(f"€{row['hourly_cost']:.2f}")
-            with col5:
-                if st.button("✏️", key=f"edit_student_{row['id']}"):
-                    st.session_state.edit_student_id = row['id']
+            if st.button("🗑️", key=f"delete_student_{row['id']}"):
+                success, message = repository.delete_student(row['id'])
+                if success:
+                    st.success(message)
                     st.rerun()
-            with col6:
-                if st.button("🗑️", key=f"delete_student_{row['id']}"):
-                    success, message = delete_student(row['id'])
-                    if success:
-                        st.success(message)
-                        st.rerun()
-                    else:
-                        st.error(message)
+                else:
+                    st.error(message)
+    
+    render_paginated_table('students_table', 'students', 'Studenti Registrati',
+                           ["ID", "Nome", "Email", "Costo Orario", "Modifica", "Elimina"],
+                           [1, 2, 2, 1, 0.5, 0.5], render_student_row, default_sort='Nome')
     
     # Form per modificare studente esistente
     if st.session_state.edit_student_id is not None:
         st.subheader('Modifica Studente')
-        student = get_student(st.session_state.edit_student_id)
+        student = repository.get_student(st.session_state.edit_student_id)
         if student:
             with st.form("Modifica Studente"):
                 name = st.text_input("Nome Studente", value=student['name'])
                 email = st.text_input("Email", value=student['email'])
                 hourly_cost = st.number_input("Costo Orario", min_value=0.0, value=student['hourly_cost'])
                 
-                col1, col2 = st.columns(2)
+                col1, col2, col3 = st.columns(3)
                 with col1:
                     if st.form_submit_button("Aggiorna"):
                         if name and email:  # Verifica che i campi obbligatori siano compilati
-                            if update_student(st.session_state.edit_student_id, name, email, hourly_cost):
+                            if repository.update_student(st.session_state.edit_student_id, name, email, hourly_cost):
                                 st.success("Studente aggiornato con successo")
                                 st.session_state.edit_student_id = None
                                 st.rerun()
@@ -144,8 +204,26 @@ def render_students_tab():
                     if st.form_submit_button("Annulla"):
                         st.session_state.edit_student_id = None
                         st.rerun()
+                with col3:
+                    if st.form_submit_button("Genera password di accesso"):
+                        st.session_state.student_account = reset_student_password(st.session_state.edit_student_id)
+                        st.rerun()
+    
+    # Credenziali appena generate, mostrate una sola volta
+    account = st.session_state.pop('student_account', None)
+    if account and account[0]:
+        st.info(f"Account studente: username **{account[0]}**, password **{account[1]}** (comunicala allo studente)")
+    elif account:
+        st.error("Impossibile creare l'account: l'email dello studente è già usata da un altro account")
     
-    # Form per aggiungere nuovo studente
+    render_new_student_form()
+
+
+# I form di inserimento sono frammenti: un invio non valido riesegue solo il form,
+# un salvataggio riuscito aggiorna tutta la pagina con st.rerun()
+@st.fragment
+@metrics.timed()
+def render_new_student_form():
     st.subheader('Aggiungi Nuovo Studente')
     with st.form("Nuovo Studente"):
         name = st.text_input("Nome Studente")
@@ -153,8 +231,9 @@ def render_students_tab():
         hourly_cost = st.number_input("Costo Orario", min_value=0.0)
         if st.form_submit_button("Salva"):
             if name and email:  # Verifica che i campi obbligatori siano compilati
-                if add_student(name, email, hourly_cost):
-                    st.success("Studente aggiunto con successo")
+                student_id = repository.add_student(name, email, hourly_cost)
+                if student_id:
+                    st.session_state.student_account = reset_student_password(student_id)
                     st.rerun()  # Aggiorna la lista
                 else:
                     st.error("Email già esistente")
@@ -162,53 +241,40 @@ def render_students_tab():
                 st.warning("Compila tutti i campi obbligatori")
 
 
+@metrics.timed()
 def render_subjects_tab():
     # Gestione stato per modifica materia
     if 'edit_subject_id' not in st.session_state:
         st.session_state.edit_subject_id = None
     
-    # Visualizza materie esistenti
-    conn = sqlite3.connect('planner.db')
-    subjects_df = pd.read_sql('SELECT id, name FROM subjects', conn)
-    conn.close()
-    
-    if not subjects_df.empty:
-        st.subheader('Materie Disponibili')
-        
-        # Aggiungi colonne per i pulsanti di modifica e cancellazione
-        col1, col2, col3, col4 = st.columns([1, 3, 0.5, 0.5])
+    # Visualizza materie esistenti, una pagina alla volta
+    def render_subject_row(row, cols):
+        col1, col2, col3, col4 = cols
         with col1:
-            st.write("ID")
+            st.write(row['id'])
         with col2:
-            st.write("Nome")
+            st.write(row['name'])
         with col3:
-            st.write("Modifica")
+            if st.button("✏️", key=f"edit_subject_{row['id']}"):
+                st.session_state.edit_subject_id = row['id']
+                st.rerun()
         with col4:
-            st.write("Elimina")
-        
-        for _, row in subjects_df.iterrows():
-            col1, col2, col3, col4 = st.columns([1, 3, 0.5, 0.5])
-            with col1:
-                st.write(row['id'])
-            with col2:
-                st.write(row['name'])
-            with col3:
-                if st.button("✏️", key=f"edit_subject_{row['id']}"):
-                    st.session_state.edit_subject_id = row['id']
+            if st.button("🗑️", key=f"delete_subject_{row['id']}"):
+                success, message = repository.delete_subject(row['id'])
+                if success:
+                    st.success(message)
                     st.rerun()
-            with col4:
-                if st.button("🗑️", key=f"delete_subject_{row['id']}"):
-                    success, message = delete_subject(row['id'])
-                    if success:
-                        st.success(message)
-                        st.rerun()
-                    else:
-                        st.error(message)
+                else:
+                    st.error(message)
+    
+    render_paginated_table('subjects_table', 'subjects', 'Materie Disponibili',
+                           ["ID", "Nome", "Modifica", "Elimina"],
+                           [1, 3, 0.5, 0.5], render_subject_row, default_sort='Nome')
     
     # Form per modificare materia esistente
     if st.session_state.edit_subject_id is not None:
         st.subheader('Modifica Materia')
-        subject = get_subject(st.session_state.edit_subject_id)
+        subject = repository.get_subject(st.session_state.edit_subject_id)
         if subject:
             with st.form("Modifica Materia"):
                 name = st.text_input("Nome Materia", value=subject['name'])
@@ -218,14 +284,9 @@ def render_subjects_tab():
                     if st.form_submit_button("Aggiorna"):
                         if name:  # Verifica che il campo nome sia compilato
                             # Ottieni l'ID dell'insegnante corrente
-                            conn = sqlite3.connect('planner.db')
-                            c = conn.cursor()
-                            c.execute('SELECT id FROM users WHERE username = ?', (st.session_state.username,))
-                            result = c.fetchone()
-                            teacher_id = result[0] if result else 1  # Default a 1 se non trovato
-                            conn.close()
+                            teacher_id = st.session_state.user_id
                             
-                            if update_subject(st.session_state.edit_subject_id, name, teacher_id):
+                            if repository.update_subject(st.session_state.edit_subject_id, name, teacher_id):
                                 st.success("Materia aggiornata con successo")
                                 st.session_state.edit_subject_id = None
                                 st.rerun()
@@ -238,100 +299,79 @@ def render_subjects_tab():
                         st.session_state.edit_subject_id = None
                         st.rerun()
     
-    # Form per aggiungere nuova materia
+    render_new_subject_form()
+
+
+@st.fragment
+@metrics.timed()
+def render_new_subject_form():
     st.subheader('Aggiungi Nuova Materia')
     with st.form("Nuova Materia"):
         name = st.text_input("Nome Materia")
         if st.form_submit_button("Salva"):
             if name:  # Verifica che il campo nome sia compilato
                 # Ottieni l'ID dell'insegnante corrente
-                conn = sqlite3.connect('planner.db')
-                c = conn.cursor()
-                c.execute('SELECT id FROM users WHERE username = ?', (st.session_state.username,))
-                result = c.fetchone()
-                teacher_id = result[0] if result else 1  # Default a 1 se non trovato
-                conn.close()
+                teacher_id = st.session_state.user_id
                 
-                add_subject(name, teacher_id)
+                repository.add_subject(name, teacher_id)
                 st.success("Materia aggiunta con successo")
                 st.rerun()  # Aggiorna la lista
             else:
                 st.warning("Inserisci il nome della materia")
 
 
+@metrics.timed()
 def render_lessons_tab():
     # Gestione stato per modifica lezione
     if 'edit_lesson_id' not in st.session_state:
         st.session_state.edit_lesson_id = None
     
-    conn = sqlite3.connect('planner.db')
-    
     # Verifica se ci sono studenti e materie prima di mostrare il form
-    students = pd.read_sql('SELECT id, name FROM students', conn)
-    subjects = pd.read_sql('SELECT id, name FROM subjects', conn)
-    
-    # Visualizza lezioni esistenti
-    lessons_df = pd.read_sql_query('''
-        SELECT lessons.id, students.name as studente, subjects.name as materia, 
-        lessons.date, lessons.duration, lessons.notes,
-        lessons.student_id, lessons.subject_id
-        FROM lessons
-        JOIN students ON lessons.student_id = students.id
-        JOIN subjects ON lessons.subject_id = subjects.id
-        ORDER BY lessons.date DESC
-    ''', conn)
-    
-    if not lessons_df.empty:
-        st.subheader('Lezioni Programmate')
-        # Converto la colonna date in datetime
-        lessons_df['date'] = pd.to_datetime(lessons_df['date'])
-        
-        # Aggiungi colonne per i pulsanti di modifica e cancellazione
-        col1, col2, col3, col4, col5, col6, col7 = st.columns([0.5, 2, 2, 1, 1, 0.5, 0.5])
+    students = query_cache.read_sql('SELECT id, name FROM students WHERE tenant_id = ?',
+                                    (tenancy.current_tenant(),), tables=('students',))
+    subjects = query_cache.read_sql('SELECT id, name FROM subjects WHERE tenant_id = ?',
+                                    (tenancy.current_tenant(),), tables=('subjects',))
+    
+    # Visualizza lezioni esistenti, una pagina alla volta (le più recenti prima)
+    def render_lesson_row(row, cols):
+        col1, col2, col3, col4, col5, col6, col7 = cols
         with col1:
-            st.write("ID")
+            st.write(row['id'])
         with col2:
-            st.write("Studente")
+            st.write(row['studente'])
         with col3:
-            st.write("Materia")
+            st.write(row['materia'])
         with col4:
-            st.write("Data")
+            orario = f" {row['start_time']}" if row['start_time'] else ''
+            st.write(pd.to_datetime(row['date']).strftime('%d/%m/%Y') + orario)
         with col5:
-            st.write("Durata (ore)")
+            st.write(f"{row['duration']:.1f}")
         with col6:
-            st.write("Modifica")
+            if st.button("✏️", key=f"edit_lesson_{row['id']}"):
+                st.session_state.edit_lesson_id = row['id']
+                st.rerun()
         with col7:
-            st.write("Elimina")
-        
-        for _, row in lessons_df.iterrows():
-            col1, col2, col3, col4, col5, col6, col7 = st.columns([0.5, 2, 2, 1, 1, 0.5, 0.5])
-            with col1:
-                st.write(row['id'])
-            with col2:
-                st.write(row['studente'])
-            with col3:
-                st.write(row['materia'])
-            with col4:
-                st.write(row['date'].strftime('%d/%m/%Y'))
-            with col5:
-                st.write(f"{row['duration']:.1f}")
-            with col6:
-                if st.button("✏️", key=f"edit_lesson_{row['id']}"):
-                    st.session_state.edit_lesson_id = row['id']
+            if st.button("🗑️", key=f"delete_lesson_{row['id']}"):
+                success, message = repository.delete_lesson(row['id'])
+                if success:
+                    st.success(message)
                     st.rerun()
-            with col7:
-                if st.button("🗑️", key=f"delete_lesson_{row['id']}"):
-                    success, message = delete_lesson(row['id'])
-                    if success:
-                        st.success(message)
-                        st.rerun()
-                    else:
-                        st.error(message)
+                else:
+                    st.error(message)
+    
+    render_paginated_table('lessons_table', 'lessons', 'Lezioni Programmate',
+                           ["ID", "Studente", "Materia", "Data", "Durata (ore)", "Modifica", "Elimina"],
+                           [0.5, 2, 2, 1, 1, 0.5, 0.5], render_lesson_row,
+                           default_sort='Data', descending=True)
+    
+    # Ricerca testuale su note, studenti e materie
+    st.subheader('Cerca Lezioni')
+    render_lesson_search('lesson_search')
     
     # Form per modificare lezione esistente
     if st.session_state.edit_lesson_id is not None:
         st.subheader('Modifica Lezione')
-        lesson = get_lesson(st.session_state.edit_lesson_id)
+        lesson = repository.get_lesson(st.session_state.edit_lesson_id)
         if lesson:
             with st.form("Modifica Lezione"):
                 student_id = st.selectbox('Studente', students['id'], 
@@ -341,22 +381,37 @@ def render_lessons_tab():
                                          format_func=lambda x: subjects[subjects['id'] == x]['name'].values[0],
                                          index=subjects.index[subjects['id'] == lesson['subject_id']].tolist()[0] if lesson['subject_id'] in subjects['id'].values else 0)
                 date = st.date_input('Data lezione', pd.to_datetime(lesson['date']).date())
+                start_time = st.time_input('Ora di inizio (facoltativa)',
+                                           value=datetime.strptime(lesson['start_time'], '%H:%M').time() if lesson['start_time'] else None)
                 duration = st.number_input('Durata (ore)', min_value=0.5, max_value=8.0, step=0.5, value=float(lesson['duration']))
                 notes = st.text_area('Note', value=lesson['notes'] if lesson['notes'] else "")
                 
                 col1, col2 = st.columns(2)
                 with col1:
                     if st.form_submit_button("Aggiorna"):
-                        if update_lesson(st.session_state.edit_lesson_id, student_id, subject_id, date, duration, notes):
-                            st.success("Lezione aggiornata con successo")
+                        success, message = repository.update_lesson(st.session_state.edit_lesson_id, student_id, subject_id,
+                                                         date, duration, notes, start_time)
+                        if success:
+                            st.success(message)
                             st.session_state.edit_lesson_id = None
                             st.rerun()
                         else:
-                            st.error("Errore durante l'aggiornamento della lezione")
+                            st.error(message)
                 with col2:
                     if st.form_submit_button("Annulla"):
                         st.session_state.edit_lesson_id = None
                         st.rerun()
+            
+            # Valori precedenti della lezione, dal giornale delle modifiche
+            with st.expander('Storico modifiche'):
+                storico = journal_history('lessons', st.session_state.edit_lesson_id)
+                if storico:
+                    st.dataframe(pd.DataFrame(
+                        [(ts, JOURNAL_OPERATIONS[op], json.dumps(before, ensure_ascii=False) if before else '',
+                          json.dumps(after, ensure_ascii=False) if after else '') for ts, op, before, after in storico],
+                        columns=['Data', 'Operazione', 'Prima', 'Dopo']), hide_index=True)
+                else:
+                    st.info('Nessuna modifica registrata')
     
     # Form per aggiungere nuova lezione
     st.subheader('Pianifica Nuova Lezione')
@@ -366,78 +421,218 @@ def render_lessons_tab():
     elif subjects.empty:
         st.warning('Aggiungi almeno una materia prima di pianificare lezioni')
     else:
-        with st.form("Nuova Lezione"):
-            student_id = st.selectbox('Studente', students['id'], format_func=lambda x: students[students['id'] == x]['name'].values[0])
-            subject_id = st.selectbox('Materia', subjects['id'], format_func=lambda x: subjects[subjects['id'] == x]['name'].values[0])
-            date = st.date_input('Data lezione', datetime.now())
-            duration = st.number_input('Durata (ore)', min_value=0.5, max_value=8.0, step=0.5)
-            notes = st.text_area('Note')
-            
-            if st.form_submit_button('Pianifica Lezione'):
-                add_lesson(student_id, subject_id, date, duration, notes)
-                st.success('Lezione programmata con successo!')
+        render_new_lesson_form(students, subjects)
+        render_series_section(students, subjects)
+        render_scheduler_section()
+
+
+@st.fragment
+@metrics.timed()
+def render_new_lesson_form(students, subjects):
+    with st.form("Nuova Lezione"):
+        student_id = st.selectbox('Studente', students['id'], format_func=lambda x: students[students['id'] == x]['name'].values[0])
+        subject_id = st.selectbox('Materia', subjects['id'], format_func=lambda x: subjects[subjects['id'] == x]['name'].values[0])
+        date = st.date_input('Data lezione', st.session_state.get('add_lesson_date') or datetime.now())
+        start_time = st.time_input('Ora di inizio (facoltativa)', value=None)
+        duration = st.number_input('Durata (ore)', min_value=0.5, max_value=8.0, step=0.5)
+        notes = st.text_area('Note')
+        
+        if st.form_submit_button('Pianifica Lezione'):
+            success, message = repository.add_lesson(student_id, subject_id, date, duration, notes, start_time)
+            if success:
+                st.success(message)
                 st.rerun()  # Aggiorna la lista
+            else:
+                st.error(message)
+
+
+# Serie ricorrenti e orario automatico: le date e i file scelti rieseguono solo la propria sezione
+@st.fragment
+@metrics.timed()
+def render_series_section(students, subjects):
+    st.subheader('Lezioni Ricorrenti')
+    
+    # Serie esistenti: le ripetizioni vengono generate al volo per calendario e report
+    series = get_series()
+    for _, row in series.iterrows():
+        giorni = ', '.join(WEEKDAYS[int(d)] for d in row['weekdays'].split(','))
+        frequenza = 'ogni settimana' if row['interval_weeks'] == 1 else f"ogni {row['interval_weeks']} settimane"
+        fine = f" al {pd.to_datetime(row['end_date']).strftime('%d/%m/%Y')}" if row['end_date'] else ''
+        with st.expander(f"{row['studente']} - {row['materia']}: {giorni}, {frequenza} "
+                         f"dal {pd.to_datetime(row['start_date']).strftime('%d/%m/%Y')}{fine}"):
+            if row['materialized_until']:
+                st.write(f"Lezioni già create fino al {pd.to_datetime(row['materialized_until']).strftime('%d/%m/%Y')}")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                until = st.date_input('Crea lezioni fino al', datetime.now(), key=f"materialize_until_{row['id']}")
+                if st.button('Crea lezioni', key=f"materialize_series_{row['id']}"):
+                    count, skipped = materialize(until, int(row['id']))
+                    st.success(f"Create {count} lezioni")
+                    if skipped:
+                        st.warning("Saltate per conflitto di orario: " + ', '.join(d.strftime('%d/%m/%Y') for d in skipped))
+                    else:
+                        st.rerun()
+            with col2:
+                skip = st.date_input('Salta la data', datetime.now(), key=f"exception_date_{row['id']}")
+                if st.button('Salta', key=f"add_exception_{row['id']}"):
+                    add_exception(int(row['id']), skip)
+                    st.rerun()
+            with col3:
+                if st.button('🗑️ Elimina serie', key=f"delete_series_{row['id']}"):
+                    success, message = delete_series(int(row['id']))
+                    st.success(message)
+                    st.rerun()
     
-    conn.close()
+    # Form per una nuova serie
+    with st.form('Nuova Serie'):
+        student_id = st.selectbox('Studente', students['id'], format_func=lambda x: students[students['id'] == x]['name'].values[0])
+        subject_id = st.selectbox('Materia', subjects['id'], format_func=lambda x: subjects[subjects['id'] == x]['name'].values[0])
+        col1, col2 = st.columns(2)
+        with col1:
+            start_date = st.date_input('Dal', datetime.now())
+        with col2:
+            end_date = st.date_input('Al (facoltativo)', value=None)
+        start_time = st.time_input('Ora di inizio (facoltativa)', value=None)
+        weekdays = st.multiselect('Giorni', range(7), format_func=lambda d: WEEKDAYS[d])
+        frequenza = st.selectbox('Frequenza', list(FREQUENCIES))
+        duration = st.number_input('Durata (ore)', min_value=0.5, max_value=8.0, step=0.5)
+        notes = st.text_area('Note')
+        
+        if st.form_submit_button('Crea Serie'):
+            if not weekdays:
+                st.warning('Seleziona almeno un giorno della settimana')
+            elif end_date is not None and end_date < start_date:
+                st.warning('La data di fine deve seguire quella di inizio')
+            else:
+                success, message = add_series(int(student_id), int(subject_id), start_date, weekdays, duration,
+                                              notes, FREQUENCIES[frequenza], end_date, start_time)
+                if success:
+                    st.success(message)
+                    st.rerun()
+                else:
+                    st.error(message)
 
 
+@st.fragment
+@metrics.timed()
+def render_scheduler_section():
+    st.subheader('Pianificazione Automatica')
+    
+    with st.expander('Genera orario settimanale'):
+        st.caption('File JSON con "students" e "teachers" (finestre [giorno, "HH:MM", "HH:MM"]), '
+                   '"requirements" ([{"student_id", "subject_id", "hours", "session_hours"}]), '
+                   '"rooms" e "slot_minutes"')
+        uploaded = st.file_uploader('Vincoli', type=['json'], key='scheduler_spec')
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            week = st.date_input('Settimana dal', datetime.now(), key='scheduler_week')
+        with col2:
+            weeks = st.number_input('Numero di settimane', min_value=1, max_value=52, value=1)
+        with col3:
+            budget = st.number_input('Tempo massimo (secondi)', min_value=1, max_value=120, value=10)
+        
+        if uploaded is not None and st.button('Calcola orario'):
+            try:
+                problem = problem_from_spec(json.load(uploaded), week)
+            except (ValueError, KeyError) as e:
+                st.error(f"File dei vincoli non valido: {e}")
+                return
+            # La soluzione precedente viene riutilizzata: si ricalcolano solo le sessioni non più valide
+            previous = st.session_state.get('timetable')
+            timetable = solve(problem, budget, previous.assignments if previous else None)
+            st.session_state.timetable_problem = problem
+            st.session_state.timetable = timetable
+        
+        timetable = st.session_state.get('timetable')
+        if timetable is None:
+            return
+        problem = st.session_state.timetable_problem
+        st.write(f"Sessioni collocate: {len(timetable.assignments)}, non collocate: {len(timetable.unassigned)} "
+                 f"({timetable.elapsed:.1f}s)")
+        st.dataframe(pd.DataFrame(timetable_rows(problem, timetable),
+                                  columns=['Studente', 'Materia', 'Giorno', 'Ora', 'Ore']), hide_index=True)
+        if timetable.unassigned:
+            st.warning('Non collocate: ' + ', '.join(f"studente {s} / materia {m}" for s, m, _ in timetable.unassigned))
+        if st.button('Crea lezioni'):
+            created, rejected = apply_timetable(problem, timetable, week, int(weeks))
+            st.success(f"Create {created} lezioni")
+            if rejected:
+                st.warning(f"{len(rejected)} lezioni scartate per conflitto di orario o riferimenti non validi")
+
+
+@metrics.timed()
 def render_student_dashboard():
     st.title('Dashboard Studente')
-    conn = sqlite3.connect('planner.db')
-    
-    # Verifica se l'utente esiste come studente
-    student = pd.read_sql_query(
-        'SELECT id FROM students WHERE email = ?',
-        conn,
-        params=(st.session_state.username,)
-    )
-    
-    if not student.empty:
-        student_id = student.iloc[0]['id']
-        df = pd.read_sql_query(
-            '''SELECT lessons.date, subjects.name as materia, duration, notes 
-               FROM lessons 
-               JOIN subjects ON lessons.subject_id = subjects.id
-               WHERE student_id = ?''',
-            conn,
-            params=(student_id,)
-        )
-        
-        if not df.empty:
-            # Converto la colonna date in datetime
-            df['date'] = pd.to_datetime(df['date'])
-            st.dataframe(df)
-        else:
-            st.info('Non hai ancora lezioni programmate.')
-    else:
+    # Lo studente è collegato all'account tramite users.student_id
+    student_id = st.session_state.get('student_id')
+    if student_id is None:
         st.warning('Il tuo account non è associato a nessuno studente.')
+        return
     
-    conn.close()
+    oggi = datetime.now().date()
+    riepilogo = get_student_summary(student_id)
+    col1, col2, col3 = st.columns(3)
+    col1.metric('Lezioni svolte e programmate', riepilogo['lezioni'])
+    col2.metric('Ore', f"{riepilogo['ore']:g}")
+    col3.metric('Totale', f"€{riepilogo['costo']:.2f}")
+    
+    st.subheader('Prossime Lezioni')
+    prossime = get_upcoming_lessons(student_id, oggi)
+    if prossime.empty:
+        st.info('Non hai lezioni programmate.')
+    else:
+        st.dataframe(prossime, hide_index=True)
+    
+    # Lezioni passate caricate a pagine, dalla più recente
+    st.subheader('Lezioni Passate')
+    if 'past_pages' not in st.session_state:
+        st.session_state.past_pages = 1
+    pagine = []
+    cursore = None
+    for _ in range(st.session_state.past_pages):
+        pagina, cursore = get_past_lessons(student_id, oggi, cursore)
+        pagine.append(pagina)
+        if cursore is None:
+            break
+    passate = pd.concat(pagine, ignore_index=True)
+    if passate.empty:
+        st.info('Non hai ancora svolto lezioni.')
+    else:
+        st.dataframe(passate.drop(columns=['id']), hide_index=True)
+        if cursore is not None and st.button('Mostra altre'):
+            st.session_state.past_pages += 1
+            st.rerun()
 
+@metrics.timed()
 def render_reports_tab():
     st.subheader('Report Lezioni')
     
-    conn = sqlite3.connect('planner.db')
-    # Query per ottenere tutte le lezioni con dettagli
-    df = pd.read_sql_query('''
-        SELECT lessons.id, lessons.date, students.name as studente, subjects.name as materia, 
-               duration, (duration * students.hourly_cost) as costo, notes,
-               lessons.student_id, lessons.subject_id
-        FROM lessons
-        JOIN students ON lessons.student_id = students.id
-        JOIN subjects ON lessons.subject_id = subjects.id
-    ''', conn)
-    conn.close()
-    
-    if df.empty:
+    if not has_lessons():
         st.info('Non ci sono ancora lezioni registrate per generare report.')
         return
-    
-    # Converto la colonna date in datetime se non lo è già
-    if not pd.api.types.is_datetime64_any_dtype(df['date']):
-        df['date'] = pd.to_datetime(df['date'])
         
-    # Calendario interattivo
+    render_calendar()
+    render_report_statistics()
+
+
+def previous_month():
+    st.session_state.calendar_date = st.session_state.calendar_date.replace(day=1) - pd.Timedelta(days=1)
+    st.session_state.calendar_date = st.session_state.calendar_date.replace(day=1)
+
+
+def next_month():
+    fine_mese = st.session_state.calendar_date.replace(day=28) + pd.Timedelta(days=4)
+    st.session_state.calendar_date = fine_mese.replace(day=1)
+
+
+def select_day(day):
+    st.session_state.selected_day = day
+
+
+# Calendario interattivo: cambiare mese o giorno riesegue solo il calendario
+@st.fragment
+@metrics.timed()
+def render_calendar():
     st.subheader('Calendario Lezioni')
     
     # Gestione stato per il calendario
@@ -447,17 +642,11 @@ def render_reports_tab():
     # Controlli per navigare nel calendario
     col1, col2, col3 = st.columns([1, 3, 1])
     with col1:
-        if st.button('◀ Mese precedente'):
-            st.session_state.calendar_date = st.session_state.calendar_date.replace(day=1) - pd.Timedelta(days=1)
-            st.session_state.calendar_date = st.session_state.calendar_date.replace(day=1)
-            st.rerun()
+        st.button('◀ Mese precedente', on_click=previous_month)
     with col2:
         st.write(f"### {st.session_state.calendar_date.strftime('%B %Y')}")
     with col3:
-        if st.button('Mese successivo ▶'):
-            next_month = st.session_state.calendar_date.replace(day=28) + pd.Timedelta(days=4)
-            st.session_state.calendar_date = next_month.replace(day=1)
-            st.rerun()
+        st.button('Mese successivo ▶', on_click=next_month)
     
     # Creazione del calendario
     current_date = st.session_state.calendar_date.replace(day=1)
@@ -466,6 +655,9 @@ def render_reports_tab():
                               freq='D')
     month_days = month_days[month_days.month == current_date.month]
     
+    # Riepilogo per giorno del mese visualizzato (una sola query, in cache fino alla prossima modifica)
+    month_summary = get_month_summary(current_date)
+    
     # Giorni della settimana
     weekdays = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom']
     cols = st.columns(7)
@@ -490,18 +682,16 @@ def render_reports_tab():
                     day_date = current_date.replace(day=day_counter)
                     
                     # Verifica se ci sono lezioni in questo giorno
-                    day_lessons = df[df['date'].dt.date == day_date.date()]
-                    
-                    if not day_lessons.empty:
+                    if day_counter in month_summary:
                         # Giorno con lezioni (evidenziato)
-                        if st.button(f"**{day_counter}** 📚", key=f"day_{day_counter}"):
-                            st.session_state.selected_day = day_date.date()
-                            st.rerun()
+                        summary = month_summary[day_counter]
+                        st.button(f"**{day_counter}** 📚", key=f"day_{day_counter}",
+                                  help=f"{summary.lessons} lezioni, {summary.hours:.1f} ore, €{summary.cost:.2f}",
+                                  on_click=select_day, args=(day_date.date(),))
                     else:
                         # Giorno senza lezioni
-                        if st.button(f"{day_counter}", key=f"day_{day_counter}"):
-                            st.session_state.selected_day = day_date.date()
-                            st.rerun()
+                        st.button(f"{day_counter}", key=f"day_{day_counter}",
+                                  on_click=select_day, args=(day_date.date(),))
                     
                     day_counter += 1
                 else:
@@ -515,11 +705,25 @@ def render_reports_tab():
         selected_day = st.session_state.selected_day
         st.subheader(f"Lezioni del {selected_day.strftime('%d/%m/%Y')}")
         
-        day_lessons = df[df['date'].dt.date == selected_day]
+        day_lessons = repository.get_lessons_in_range(selected_day, selected_day)
+        day_series = get_series_lessons_in_range(selected_day, selected_day)
+        
+        # Ripetizioni di serie ricorrenti non ancora create come lezioni
+        for _, lesson in day_series.iterrows():
+            orario = f"{lesson['start_time']} " if lesson['start_time'] else ''
+            with st.expander(f"🔁 {orario}{lesson['studente']} - {lesson['materia']} ({lesson['duration']} ore)"):
+                st.write(f"**Durata:** {lesson['duration']} ore")
+                st.write(f"**Costo:** €{lesson['costo']:.2f}")
+                if lesson['notes']:
+                    st.write(f"**Note:** {lesson['notes']}")
+                if st.button("Salta questa data", key=f"skip_cal_series_{lesson['series_id']}"):
+                    add_exception(int(lesson['series_id']), selected_day)
+                    st.rerun()
         
         if not day_lessons.empty:
             for _, lesson in day_lessons.iterrows():
-                with st.expander(f"{lesson['studente']} - {lesson['materia']} ({lesson['duration']} ore)"):
+                orario = f"{lesson['start_time']} " if lesson['start_time'] else ''
+                with st.expander(f"{orario}{lesson['studente']} - {lesson['materia']} ({lesson['duration']} ore)"):
                     st.write(f"**Studente:** {lesson['studente']}")
                     st.write(f"**Materia:** {lesson['materia']}")
                     st.write(f"**Durata:** {lesson['duration']} ore")
@@ -530,23 +734,30 @@ def render_reports_tab():
                     col1, col2 = st.columns(2)
                     with col1:
                         if st.button("✏️ Modifica", key=f"edit_cal_lesson_{lesson['id']}"):
+                            # Il form di modifica si trova nella sezione delle lezioni
                             st.session_state.edit_lesson_id = lesson['id']
+                            st.session_state.next_section = "Pianificazione Lezioni"
                             st.rerun()
                     with col2:
                         if st.button("🗑️ Elimina", key=f"delete_cal_lesson_{lesson['id']}"):
-                            success, message = delete_lesson(lesson['id'])
+                            success, message = repository.delete_lesson(lesson['id'])
                             if success:
                                 st.success(message)
                                 st.rerun()
                             else:
                                 st.error(message)
-        else:
+        elif day_series.empty:
             st.info(f"Nessuna lezione programmata per il {selected_day.strftime('%d/%m/%Y')}")
             if st.button("➕ Aggiungi lezione", key="add_lesson_from_calendar"):
                 st.session_state.add_lesson_date = selected_day
+                st.session_state.next_section = "Pianificazione Lezioni"
                 st.rerun()
-    
-    # Filtri per il report
+
+
+# Filtri, grafico e dettaglio del report: cambiare periodo o filtri riesegue solo questa parte
+@st.fragment
+@metrics.timed()
+def render_report_statistics():
     st.subheader('Report Statistiche')
     col1, col2 = st.columns(2)
     with col1:
@@ -554,21 +765,34 @@ def render_reports_tab():
     with col2:
         periodo = st.selectbox('Raggruppa per', ['Giornaliero', 'Settimanale', 'Mensile'])
     
-    # Filtro per data
-    filtered = df[(df['date'] >= pd.to_datetime(date_range[0])) & (df['date'] <= pd.to_datetime(date_range[1]))]
+    if len(date_range) != 2:
+        st.info('Seleziona la data di inizio e di fine del periodo.')
+        return
+    start_date, end_date = date_range
+    
+    # Aggregazione per periodo eseguita in SQL sul solo intervallo selezionato; sui periodi
+    # lunghi in background, con il risultato riutilizzato finché i dati non cambiano
+    if (end_date - start_date).days > LARGE_REPORT_DAYS:
+        # Nuova attività solo quando cambiano i parametri o i dati (o quella precedente è scaduta):
+        # le altre esecuzioni, compresi gli aggiornamenti dello stato, mostrano quella già avviata
+        params = (start_date, end_date, periodo, data_fingerprint())
+        if st.session_state.get('report_job') is None or st.session_state.get('report_job_params') != params:
+            st.session_state.report_job = submit_job('report', {'start': start_date, 'end': end_date,
+                                                                'period': periodo})
+            st.session_state.report_job_params = params
+        job = render_job('report_job', 'Calcolo del report', cancellable=False)
+        if job is None:
+            return
+        if job.status != 'done':
+            return
+        grouped = load_job_result(job)
+    else:
+        grouped = repository.get_report_totals(start_date, end_date, periodo)
     
-    if filtered.empty:
+    if grouped.empty:
         st.warning('Nessuna lezione trovata nel periodo selezionato.')
         return
     
-    # Raggruppamento per periodo
-    if periodo == 'Giornaliero':
-        grouped = filtered.groupby(pd.Grouper(key='date', freq='D')).sum(numeric_only=True)
-    elif periodo == 'Settimanale':
-        grouped = filtered.groupby(pd.Grouper(key='date', freq='W-MON')).sum(numeric_only=True)
-    else:  # Mensile
-        grouped = filtered.groupby(pd.Grouper(key='date', freq='M')).sum(numeric_only=True)
-    
     # Visualizzazione grafico
     st.subheader('Andamento Costi')
     if not grouped.empty and 'costo' in grouped.columns:
@@ -576,34 +800,71 @@ def render_reports_tab():
     else:
         st.info('Dati insufficienti per generare il grafico.')
     
+    # Totali per studente del mese, letti dal riepilogo di fatturazione
+    with st.expander('Riepilogo mensile per studente'):
+        mese = st.date_input('Mese', end_date, key='billing_month')
+        riepilogo = get_month_billing(month_key(mese))
+        if riepilogo.empty:
+            st.info('Nessuna lezione nel mese selezionato.')
+        else:
+            st.dataframe(riepilogo[['studente', 'email', 'lezioni', 'duration', 'costo']], hide_index=True)
+            st.write(f"**Totale:** €{riepilogo['costo'].sum():.2f}")
+            
+            # Generazione in background: la pagina resta utilizzabile mentre le fatture vengono prodotte
+            if st.button('Genera fatture del mese', key='generate_invoices'):
+                st.session_state.invoice_job = submit_job('invoices', {'month': month_key(mese)})
+            render_job('invoice_job', 'Fatture', file_name=f'fatture_{month_key(mese)}')
+    
     # Dettaglio lezioni
     st.subheader('Dettaglio Lezioni')
-    studenti_list = filtered['studente'].unique().tolist()
-    if studenti_list:
-        studente = st.selectbox('Filtra per studente', ['Tutti'] + studenti_list)
-        if studente != 'Tutti':
-            filtered = filtered[filtered['studente'] == studente]
+    studenti = get_students_in_range(start_date, end_date)
+    studente_id = None
+    if not studenti.empty:
+        studente_id = st.selectbox('Filtra per studente', [None] + studenti['id'].tolist(),
+                                   format_func=lambda x: 'Tutti' if x is None else studenti[studenti['id'] == x]['name'].values[0])
+    render_lesson_search('report_search', start_date, end_date, studente_id)
+    filtered = repository.get_lessons_in_range(start_date, end_date, studente_id)
+    planned = get_series_lessons_in_range(start_date, end_date, studente_id)
+    if not planned.empty:
+        st.caption(f"Lezioni ricorrenti pianificate nel periodo: {len(planned)}")
+        st.dataframe(planned)
     
     # Mostra tabella dettaglio
     if not filtered.empty:
         st.dataframe(filtered)
         
-        # Funzione per esportare in Excel
-        @st.cache_data
-        def convert_to_excel(df):
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                df.to_excel(writer, index=False)
-            return output.getvalue()
-        
-        # Bottone per scaricare Excel
-        excel_data = convert_to_excel(filtered)
-        st.download_button(
-            label='Esporta in Excel',
-            data=excel_data,
-            file_name='report_lezioni.xlsx',
-            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        # Esportazione in background, leggendo le righe a blocchi dal database
+        col1, col2 = st.columns([1, 3])
+        with col1:
+            fmt = st.selectbox('Formato', list(EXPORT_FORMATS), key='export_format')
+        with col2:
+            if st.button('Esporta'):
+                st.session_state.export_job = submit_job('export', {'start': start_date, 'end': end_date,
+                                                                    'student_id': studente_id, 'fmt': fmt})
+        render_job('export_job', 'Esportazione', file_name='report_lezioni')
+
+@metrics.timed()
+def render_import_tab():
+    st.subheader('Importazione da CSV/Excel')
+    
+    tipi = {'Studenti': 'students', 'Materie': 'subjects', 'Lezioni': 'lessons'}
+    tipo = st.selectbox('Tipo di dati', list(tipi))
+    kind = tipi[tipo]
+    st.caption('Colonne attese: ' + ', '.join(COLUMNS[kind]) + " ('|' indica alternative, '?' colonne facoltative)")
+    
+    uploaded = st.file_uploader('File da importare', type=['csv', 'xlsx'], key=f'import_{kind}')
+    if uploaded is not None and st.button('Importa', key='run_import'):
+        # Il file viene salvato e importato in background
+        st.session_state.import_job = submit_job('import', {'kind': kind, 'filename': uploaded.name,
+                                                            'teacher_id': st.session_state.user_id},
+                                                 upload=(uploaded.name, uploaded.getvalue()))
+    
+    job = render_job('import_job', 'Importazione')
+    if job is not None and job.status == 'done':
+        result = load_job_result(job)
+        if result.errors:
+            st.warning(f"{len(result.errors)} righe scartate")
+            st.dataframe(pd.DataFrame(result.errors, columns=['Riga', 'Errore']))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# Parametri scrypt: N determina tempo e memoria di ogni verifica (128 * r * N byte).
+# Gli hash con parametri diversi da quelli correnti vengono aggiornati al login successivo.
+SCRYPT_N = int(os.environ.get('PLANNER_SCRYPT_N', 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+
+# Limite ai tentativi falliti: dopo MAX_FAILURES errori in FAILURE_WINDOW secondi l'utente
+# viene bloccato per LOCKOUT_SECONDS, senza calcolare l'hash delle password inviate
+MAX_FAILURES = 5
+FAILURE_WINDOW = 300
+LOCKOUT_SECONDS = 300
+MAX_TRACKED = 10000
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, maxmem=256 * r * n)
+
+
+def hash_password(password):
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}'
+
+
+# Password degli account creati automaticamente: nessun valore inserito la verifica
+# finché l'insegnante non ne imposta una
+LOCKED_PASSWORD = '!'
+
+
+def generate_password():
+    return secrets.token_urlsafe(9)
+
+
+def is_hashed(stored):
+    return stored.startswith('scrypt$')
+
+
+def verify_password(password, stored):
+    # Restituisce (valida, da_aggiornare). Le password in chiaro rimaste da versioni
+    # precedenti vengono accettate e segnalate per la conversione.
+    if stored == LOCKED_PASSWORD:
+        return False, False
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8')), True
+    _, n, r, p, salt, digest = stored.split('$')
+    n, r, p = int(n), int(r), int(p)
+    valid = hmac.compare_digest(_scrypt(password, base64.b64decode(salt), n, r, p), base64.b64decode(digest))
+    return valid, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+# Hash fittizio verificato per gli utenti inesistenti, così la risposta richiede lo stesso tempo
+_DUMMY_HASH = None
+
+
+def dummy_verify(password):
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = hash_password('')
+    verify_password(password, _DUMMY_HASH)
+
+
+class LoginThrottle:
+    # Tentativi falliti recenti per utente, in un dizionario LRU di dimensione limitata:
+    # un attacco con molti nomi diversi scarta le voci più vecchie invece di far crescere la memoria
+
+    def __init__(self, max_failures=MAX_FAILURES, window=FAILURE_WINDOW, lockout=LOCKOUT_SECONDS,
+                 max_tracked=MAX_TRACKED):
+        self.max_failures = max_failures
+        self.window = window
+        self.lockout = lockout
+        self.max_tracked = max_tracked
+        self._entries = OrderedDict()  # chiave -> (fallimenti, primo fallimento, bloccato fino a)
+        self._lock = threading.Lock()
+
+    def retry_after(self, key):
+        # Secondi da attendere prima di poter ritentare (0 se non bloccato)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return 0
+            return max(0, entry[2] - now)
+
+    def failure(self, key):
+        now = time.monotonic()
+        with self._lock:
+            failures, first, locked_until = self._entries.pop(key, (0, now, 0))
+            if now - first > self.window:
+                failures, first = 0, now
+            failures += 1
+            if failures >= self.max_failures:
+                locked_until = now + self.lockout
+                failures, first = 0, now
+            self._entries[key] = (failures, first, locked_until)
+            while len(self._entries) > self.max_tracked:
+                self._entries.popitem(last=False)
+
+    def success(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+login_throttle = LoginThrottle()
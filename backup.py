@@ -0,0 +1,248 @@
+import argparse
+import glob
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import connection
+import tenancy
+
+# Copie di sicurezza del database principale e degli shard dei tenant, prese mentre
+# l'applicazione è in uso. In modalità WAL la copia legge da uno snapshot e non prende mai
+# il lock di scrittura del database: gli insegnanti possono continuare a salvare.
+BACKUP_DIR = os.environ.get('PLANNER_BACKUP_DIR', 'backups')
+KEEP = int(os.environ.get('PLANNER_BACKUP_KEEP', '14'))
+
+# Pagine copiate a ogni passo dell'API di backup e pausa tra un passo e l'altro (secondi),
+# per non saturare il disco mentre l'applicazione lavora
+PAGES_PER_STEP = 256
+STEP_SLEEP = 0.005
+
+METHODS = ('backup', 'vacuum')
+
+BackupResult = namedtuple('BackupResult', ['source', 'path', 'size', 'elapsed'])
+
+_NAME = re.compile(r'^(?P<stem>.+)_(?P<ts>\d{8}_\d{6})\.db(\.gz)?$')
+
+
+def _sources():
+    # Database principale e shard esistenti, come (nome, percorso)
+    sources = [(os.path.splitext(os.path.basename(connection.DB_PATH))[0], connection.DB_PATH)]
+    if tenancy.SHARD_DIR:
+        for path in sorted(glob.glob(os.path.join(tenancy.SHARD_DIR, 'tenant_*.db'))):
+            sources.append((os.path.splitext(os.path.basename(path))[0], path))
+    return sources
+
+
+def _open(path):
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout=5000')
+    return conn
+
+
+def _copy_paged(source, target, progress=None):
+    # API di backup a passi. La transazione di lettura resta aperta per tutta la copia:
+    # i passi leggono tutti lo stesso snapshot, quindi le scritture concorrenti non fanno
+    # ripartire la copia e il risultato è coerente.
+    src = _open(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.execute('BEGIN')
+        src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        src.backup(dst, pages=PAGES_PER_STEP, sleep=STEP_SLEEP,
+                   progress=(lambda status, remaining, total: progress(total - remaining, total)) if progress else None)
+        src.execute('COMMIT')
+    finally:
+        dst.close()
+        src.close()
+
+
+def _copy_vacuum(source, target, progress=None):
+    # VACUUM INTO: una copia compattata e senza pagine libere, letta da un unico snapshot
+    src = _open(source)
+    try:
+        src.execute('VACUUM INTO ?', (target,))
+    finally:
+        src.close()
+
+
+_COPIES = {'backup': _copy_paged, 'vacuum': _copy_vacuum}
+
+
+def verify(path):
+    # Controllo di integrità di una copia (anche compressa): restituisce (esito, messaggio)
+    work = path
+    if path.endswith('.gz'):
+        work = f'{path[:-3]}.{os.getpid()}.verify.tmp'
+        with gzip.open(path, 'rb') as src, open(work, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    try:
+        conn = sqlite3.connect(f'file:{work}?mode=ro', uri=True)
+        try:
+            result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+            version = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        return False, f"Copia non leggibile: {e}"
+    finally:
+        if work != path:
+            os.remove(work)
+    if result != ['ok']:
+        return False, 'Copia danneggiata: ' + '; '.join(result[:5])
+    return True, f"Copia integra (schema versione {version})"
+
+
+def _rotate(stem, keep):
+    # Conserva le keep copie più recenti di un database
+    copies = sorted(p for p in glob.glob(os.path.join(BACKUP_DIR, f'{stem}_*.db*'))
+                    if (m := _NAME.match(os.path.basename(p))) and m.group('stem') == stem)
+    for old in copies[:-keep] if keep > 0 else []:
+        os.remove(old)
+
+
+def create_backup(method='backup', compress=True, keep=KEEP, progress=None):
+    # Copia di tutti i database, verificata e compressa. Restituisce un BackupResult per database.
+    # progress(pagine copiate, pagine totali) è chiamata solo con il metodo 'backup'.
+    if method not in _COPIES:
+        raise ValueError(f"Metodo di backup sconosciuto: {method}")
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    results = []
+    for stem, source in _sources():
+        started = time.perf_counter()
+        path = os.path.join(BACKUP_DIR, f'{stem}_{timestamp}.db')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            _COPIES[method](source, tmp_path, progress)
+            ok, message = verify(tmp_path)
+            if not ok:
+                raise RuntimeError(f"{stem}: {message}")
+            if compress:
+                with open(tmp_path, 'rb') as src, gzip.open(tmp_path + '.gz', 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.remove(tmp_path)
+                tmp_path += '.gz'
+                path += '.gz'
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        _rotate(stem, keep)
+        results.append(BackupResult(source, path, os.path.getsize(path), time.perf_counter() - started))
+    return results
+
+
+def list_backups():
+    # Copie presenti, dalla più recente: (nome del database, istante, percorso, dimensione)
+    rows = []
+    for path in glob.glob(os.path.join(BACKUP_DIR, '*.db*')):
+        m = _NAME.match(os.path.basename(path))
+        if m:
+            rows.append((m.group('stem'), datetime.strptime(m.group('ts'), '%Y%m%d_%H%M%S'), path,
+                         os.path.getsize(path)))
+    return sorted(rows, key=lambda row: (row[1], row[0]), reverse=True)
+
+
+def restore(path, target=None):
+    # Ripristina una copia sul database indicato (predefinito: quello da cui è stata presa).
+    # La copia viene verificata e scritta con l'API di backup sul file in uso, così le altre
+    # connessioni vedono i nuovi dati senza riaprire il file; prima viene salvata una copia
+    # dello stato attuale. Restituisce il percorso di questa copia.
+    ok, message = verify(path)
+    if not ok:
+        raise RuntimeError(message)
+    m = _NAME.match(os.path.basename(path))
+    if target is None:
+        if m is None:
+            raise ValueError("Specificare il database da ripristinare")
+        target = dict(_sources()).get(m.group('stem'))
+        if target is None:
+            raise ValueError(f"Database sconosciuto: {m.group('stem')}")
+
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(target))[0]
+    safety = os.path.join(BACKUP_DIR, f"{stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+    if os.path.exists(target):
+        _copy_vacuum(target, safety)
+
+    work = path
+    if path.endswith('.gz'):
+        work = f'{path[:-3]}.{os.getpid()}.restore.tmp'
+        with gzip.open(path, 'rb') as src, open(work, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    try:
+        src = sqlite3.connect(f'file:{work}?mode=ro', uri=True)
+        dst = _open(target)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        if work != path:
+            os.remove(work)
+
+    # Le connessioni del processo e la cache vanno riaperte e svuotate. Una copia con uno schema
+    # precedente viene aggiornata: subito il database principale, al primo accesso gli shard.
+    connection.close_all()
+    import query_cache
+    query_cache.clear()
+    if os.path.abspath(target) == os.path.abspath(connection.DB_PATH):
+        from migrations import migrate
+        with tenancy.directory():
+            migrate()
+    return safety
+
+
+def schedule(interval_minutes, method='backup', compress=True, keep=KEEP):
+    # Ciclo di backup periodici (in alternativa a cron); gli errori vengono stampati e il
+    # ciclo prosegue
+    while True:
+        try:
+            for result in create_backup(method, compress, keep):
+                print(f"{datetime.now():%d/%m/%Y %H:%M:%S} {result.path} "
+                      f"({result.size / 1024:.0f} KB, {result.elapsed:.1f} s)", flush=True)
+        except (OSError, sqlite3.Error, RuntimeError) as e:
+            print(f"{datetime.now():%d/%m/%Y %H:%M:%S} Backup non riuscito: {e}", flush=True)
+        time.sleep(interval_minutes * 60)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backup e ripristino del database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    create = subparsers.add_parser('create', help='crea una copia di tutti i database')
+    repeat = subparsers.add_parser('schedule', help='crea copie a intervalli regolari')
+    repeat.add_argument('--interval', type=float, default=60, help='minuti tra due copie')
+    for sub in (create, repeat):
+        sub.add_argument('--method', choices=METHODS, default='backup',
+                         help="'backup': API di backup a passi; 'vacuum': VACUUM INTO (copia compattata)")
+        sub.add_argument('--no-compress', action='store_true', help='non comprimere con gzip')
+        sub.add_argument('--keep', type=int, default=KEEP, help='copie da conservare per database')
+    subparsers.add_parser('list', help='copie disponibili')
+    check = subparsers.add_parser('verify', help="verifica l'integrità di una copia")
+    check.add_argument('file')
+    back = subparsers.add_parser('restore', help='ripristina una copia')
+    back.add_argument('file')
+    back.add_argument('--target', help='database da sovrascrivere (predefinito: quello di origine)')
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        for result in create_backup(args.method, not args.no_compress, args.keep):
+            print(f"{result.path} ({result.size / 1024:.0f} KB, {result.elapsed:.1f} s)")
+    elif args.command == 'schedule':
+        schedule(args.interval, args.method, not args.no_compress, args.keep)
+    elif args.command == 'list':
+        for stem, ts, path, size in list_backups():
+            print(f"{ts:%d/%m/%Y %H:%M:%S} {stem}: {path} ({size / 1024:.0f} KB)")
+    elif args.command == 'verify':
+        ok, message = verify(args.file)
+        print(message)
+        raise SystemExit(0 if ok else 1)
+    else:
+        print(f"Ripristino completato; stato precedente salvato in {restore(args.file, args.target)}")
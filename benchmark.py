@@ -0,0 +1,290 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import connection
+
+# Benchmark dei percorsi reali dell'applicazione su database sintetici.
+# I dataset generati vengono conservati in BENCH_DIR e riutilizzati tra un'esecuzione e l'altra.
+BENCH_DIR = os.environ.get('PLANNER_BENCH_DIR', os.path.join(tempfile.gettempdir(), 'planner_bench'))
+
+# Ultimo giorno dei dati generati: fisso, così dataset e finestre dei report sono riproducibili
+END_DATE = date(2025, 12, 31)
+
+# Una voce è segnalata come regressione se la mediana supera quella di riferimento di oltre
+# TOLERANCE (frazione) e di almeno MIN_DELTA_MS, per ignorare il rumore sui tempi molto brevi
+TOLERANCE = 0.25
+MIN_DELTA_MS = 1.0
+
+_FIRST_NAMES = ['Marco', 'Giulia', 'Luca', 'Sara', 'Matteo', 'Chiara', 'Andrea', 'Francesca', 'Davide', 'Elena',
+                'Simone', 'Martina', 'Alessandro', 'Valentina', 'Federico', 'Alice', 'Lorenzo', 'Giorgia']
+_LAST_NAMES = ['Rossi', 'Russo', 'Ferrari', 'Esposito', 'Bianchi', 'Romano', 'Colombo', 'Ricci', 'Marino',
+               'Greco', 'Bruno', 'Gallo', 'Conti', 'De Luca', 'Costa', 'Giordano', 'Mancini', 'Rizzo']
+_SUBJECTS = ['Matematica', 'Fisica', 'Chimica', 'Italiano', 'Latino', 'Inglese', 'Storia', 'Filosofia',
+             'Biologia', 'Informatica', 'Economia', 'Diritto', 'Francese', 'Spagnolo', 'Geografia']
+_TOPICS = ['derivate', 'integrali', 'equazioni', 'limiti', 'vettori', 'cinematica', 'dinamica', 'ottica',
+           'stechiometria', 'analisi del testo', 'versione', 'grammatica', 'verbi irregolari', 'ripasso',
+           'verifica', 'esercizi', 'compiti', 'tema', 'interrogazione', 'problemi', 'geometria', 'probabilità']
+
+
+def dataset_path(lessons, students, subjects, seed):
+    return os.path.join(BENCH_DIR, f'bench_{lessons}_{students}_{subjects}_{seed}.db')
+
+
+def generate(path, lessons=10000, students=100, subjects=10, teachers=3, years=3, seed=0, progress=None):
+    # Crea un database sintetico con lo schema corrente: studenti, materie di più insegnanti e
+    # lezioni distribuite negli ultimi `years` anni fino a END_DATE, nei giorni feriali dalle 8
+    # alle 20. Le lezioni passano dai trigger (riepilogo, ricerca, giornale) come quelle reali.
+    rng = random.Random(seed)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection.configure(path)
+
+    from auth import LOCKED_PASSWORD
+    from database import init_db
+    init_db()
+
+    first_day = END_DATE - timedelta(days=365 * years)
+    days = [first_day + timedelta(days=i) for i in range((END_DATE - first_day).days + 1)]
+    days = [d.isoformat() for d in days if d.weekday() < 5]
+
+    with connection.transaction() as conn:
+        # Gli insegnanti aggiuntivi hanno un account bloccato: servono solo come teacher_id
+        conn.executemany("INSERT INTO users (username, password, role) VALUES (?, ?, 'insegnante')",
+                         [(f'insegnante{i}@bench', LOCKED_PASSWORD) for i in range(1, teachers)])
+        teacher_ids = [r[0] for r in conn.execute("SELECT id FROM users WHERE role = 'insegnante'")]
+        conn.executemany('INSERT INTO students (name, email, hourly_cost) VALUES (?, ?, ?)',
+                         [(f'{rng.choice(_FIRST_NAMES)} {rng.choice(_LAST_NAMES)}', f'studente{i}@bench',
+                           rng.choice([15.0, 18.0, 20.0, 25.0, 30.0])) for i in range(students)])
+        conn.executemany('INSERT INTO subjects (name, teacher_id) VALUES (?, ?)',
+                         [(f'{_SUBJECTS[i % len(_SUBJECTS)]}' + (f' {i // len(_SUBJECTS) + 1}' if i >= len(_SUBJECTS) else ''),
+                           teacher_ids[i % len(teacher_ids)]) for i in range(subjects)])
+
+    chunk = 50000
+    for offset in range(0, lessons, chunk):
+        rows = []
+        for _ in range(min(chunk, lessons - offset)):
+            notes = ', '.join(rng.sample(_TOPICS, rng.randint(1, 3))) if rng.random() < 0.8 else None
+            rows.append((rng.randint(1, students), rng.randint(1, subjects), rng.choice(days),
+                         f'{rng.randint(8, 19):02d}:{rng.choice((0, 30)):02d}', rng.choice((1.0, 1.0, 1.5, 2.0)),
+                         notes))
+        with connection.transaction() as conn:
+            conn.executemany('''INSERT INTO lessons (student_id, subject_id, date, start_time, duration, notes)
+                                VALUES (?, ?, ?, ?, ?, ?)''', rows)
+        if progress:
+            progress(offset + len(rows), lessons)
+
+    with connection.transaction() as conn:
+        conn.execute('ANALYZE')
+    connection.close_all()
+    return path
+
+
+# --- Casi misurati ---
+
+def _cold():
+    # Ogni ripetizione parte con le cache applicative vuote
+    import calendar_data
+    import query_cache
+    query_cache.clear()
+    calendar_data.invalidate()
+
+
+def _cases(rng):
+    # Restituisce (nome, preparazione, funzione): la preparazione non viene misurata
+    import calendar_data
+    import database
+    import export
+    import pagination
+    import query_cache
+    import reports
+    import search
+
+    with connection.get_connection() as conn:
+        students = conn.execute('SELECT COUNT(*) FROM students').fetchone()[0]
+        subjects = conn.execute('SELECT COUNT(*) FROM subjects').fetchone()[0]
+    month = (date(END_DATE.year, END_DATE.month, 1), END_DATE)
+    year = (date(END_DATE.year, 1, 1), END_DATE)
+    state = {}
+
+    def lesson_args():
+        # Un giorno feriale con lezioni già presenti, in un orario libero (i dati finiscono alle 22)
+        day = END_DATE - timedelta(days=rng.randint(0, 300))
+        while day.weekday() >= 5:
+            day -= timedelta(days=1)
+        return rng.randint(1, students), rng.randint(1, subjects), day.isoformat(), 0.5, 'benchmark', '23:00'
+
+    def cleanup():
+        # Rimuove le righe create dalla ripetizione precedente, fuori dalla misura
+        _cold()
+        with connection.transaction() as conn:
+            conn.execute("DELETE FROM lessons WHERE notes = 'benchmark'")
+        if state.get('student'):
+            database.delete_student(state.pop('student'))
+        _cold()
+
+    def prepare_lesson():
+        cleanup()
+        args = lesson_args()
+        database.add_lesson(*args)
+        with connection.get_connection() as conn:
+            state['lesson'] = (conn.execute('SELECT MAX(id) FROM lessons').fetchone()[0], args)
+        _cold()
+
+    def prepare_student():
+        cleanup()
+        state['student'] = database.add_student('Benchmark', f'benchmark{rng.random()}@bench', 20.0)
+        _cold()
+
+    def add_student():
+        state['student'] = database.add_student('Benchmark', f'benchmark{rng.random()}@bench', 20.0)
+
+    def update_lesson():
+        lesson_id, (student_id, subject_id, day, _, notes, start_time) = state['lesson']
+        database.update_lesson(lesson_id, student_id, subject_id, day, 1.0, notes, start_time)
+
+    def prepare_export():
+        # Nuova generazione di lessons: il file non viene riutilizzato dalla cache delle esportazioni
+        _cold()
+        query_cache.invalidate('lessons')
+
+    cases = [
+        ('crud.add_lesson', cleanup, lambda: database.add_lesson(*lesson_args())),
+        ('crud.update_lesson', prepare_lesson, update_lesson),
+        ('crud.delete_lesson', prepare_lesson, lambda: database.delete_lesson(state['lesson'][0])),
+        ('crud.add_student', cleanup, add_student),
+        ('crud.update_student', prepare_student,
+         lambda: database.update_student(state['student'], 'Benchmark 2', f'b{rng.random()}@bench', 21.0)),
+        ('crud.delete_student', prepare_student, lambda: database.delete_student(state.pop('student'))),
+        ('crud.get_lesson', _cold, lambda: database.get_lesson(rng.randint(1, 1000))),
+        ('list.lessons_first_page', _cold, lambda: pagination.fetch_page('lessons', 'Data', True, limit=25)),
+        ('list.lessons_search', _cold, lambda: pagination.fetch_page('lessons', 'Data', True, 'Rossi', limit=25)),
+        ('list.students_first_page', _cold, lambda: pagination.fetch_page('students', 'Nome', limit=25)),
+        ('search.fts_notes', _cold, lambda: search.search_lessons('derivate esercizi')),
+        ('report.lessons_month', _cold, lambda: reports.get_lessons_in_range(*month)),
+        ('report.lessons_year', _cold, lambda: reports.get_lessons_in_range(*year)),
+        ('calendar.month_summary', _cold, lambda: calendar_data.get_month_summary(END_DATE)),
+        ('dashboard.student_summary', _cold, lambda: reports.get_student_summary(rng.randint(1, students))),
+        ('export.xlsx_month', prepare_export, lambda: export.export_lessons(*month, fmt='xlsx')),
+        ('export.xlsx_year', prepare_export, lambda: export.export_lessons(*year, fmt='xlsx')),
+    ]
+    for period in reports.PERIODS:
+        cases.append((f'report.totals_sql_year_{period.lower()}', _cold,
+                      lambda period=period: reports.get_report_totals(*year, period)))
+        cases.append((f'report.totals_pandas_year_{period.lower()}', _cold,
+                      lambda period=period: reports.get_report_totals_pandas(*year, period)))
+    return cases
+
+
+def run(path, repeats=5, only=None, seed=0):
+    # Esegue i casi su una copia del database (le scritture misurate non alterano il dataset)
+    # e restituisce {nome: statistiche in millisecondi}
+    work_dir = tempfile.mkdtemp(prefix='planner_bench_')
+    work_path = os.path.join(work_dir, 'bench.db')
+    shutil.copyfile(path, work_path)
+    connection.configure(work_path)
+    from database import init_db
+    init_db()
+
+    results = {}
+    try:
+        for name, prepare, func in _cases(random.Random(seed)):
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            samples = []
+            for _ in range(repeats):
+                prepare()
+                started = time.perf_counter()
+                func()
+                samples.append((time.perf_counter() - started) * 1000)
+            results[name] = {'median_ms': round(statistics.median(samples), 3), 'min_ms': round(min(samples), 3),
+                             'mean_ms': round(statistics.fmean(samples), 3), 'repeats': repeats}
+    finally:
+        connection.close_all()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE, min_delta_ms=MIN_DELTA_MS):
+    # Voci più lente del riferimento: lista di (nome, mediana di riferimento, mediana attuale)
+    regressions = []
+    for name, current in results.items():
+        reference = baseline.get('results', {}).get(name)
+        if reference is None:
+            continue
+        before, after = reference['median_ms'], current['median_ms']
+        if after > before * (1 + tolerance) and after - before >= min_delta_ms:
+            regressions.append((name, before, after))
+    return regressions
+
+
+def _metadata(path):
+    with sqlite3.connect(path) as conn:
+        counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                  for table in ('lessons', 'students', 'subjects')}
+    return dict(counts, database=os.path.abspath(path), python=platform.python_version(),
+                sqlite=sqlite3.sqlite_version, platform=platform.platform(),
+                timestamp=datetime.now().isoformat(timespec='seconds'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark del planner su dati sintetici')
+    parser.add_argument('--lessons', type=int, default=10000)
+    parser.add_argument('--students', type=int, default=100)
+    parser.add_argument('--subjects', type=int, default=10)
+    parser.add_argument('--teachers', type=int, default=3)
+    parser.add_argument('--years', type=int, default=3, help='anni coperti dalle lezioni generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help='database esistente da misurare invece di uno generato')
+    parser.add_argument('--regenerate', action='store_true', help='rigenera il dataset anche se esiste')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--only', action='append', help='esegue solo i casi con questo prefisso (ripetibile)')
+    parser.add_argument('--output', help='file JSON dei risultati (predefinito: standard output)')
+    parser.add_argument('--baseline', help='risultati di riferimento con cui confrontare')
+    parser.add_argument('--save-baseline', help='salva i risultati anche come nuovo riferimento')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='rallentamento ammesso (frazione)')
+    args = parser.parse_args()
+
+    path = args.db
+    if path is None:
+        path = dataset_path(args.lessons, args.students, args.subjects, args.seed)
+        if args.regenerate or not os.path.exists(path):
+            started = time.perf_counter()
+            generate(path, args.lessons, args.students, args.subjects, args.teachers, args.years, args.seed,
+                     progress=lambda n, total: print(f"\rGenerazione: {n}/{total} lezioni", end='',
+                                                     file=sys.stderr, flush=True))
+            print(f"\nDataset generato in {time.perf_counter() - started:.1f} s: {path}", file=sys.stderr)
+
+    report = {'metadata': _metadata(path), 'results': run(path, args.repeats, args.only, args.seed)}
+    for name, result in report['results'].items():
+        print(f"{name:<40} {result['median_ms']:>10.2f} ms", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report['results'], json.load(f), args.tolerance)
+        report['regressions'] = [{'name': name, 'baseline_ms': before, 'current_ms': after}
+                                 for name, before, after in regressions]
+        for name, before, after in regressions:
+            print(f"REGRESSIONE {name}: {before:.2f} ms -> {after:.2f} ms", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(output + '\n')
+    sys.exit(1 if report.get('regressions') else 0)
@@ -0,0 +1,92 @@
+import argparse
+
+import pandas as pd
+
+import query_cache
+from connection import get_connection, transaction
+from tenancy import current_tenant
+
+# billing_summary è mantenuta dai trigger su lessons e students (migrazione 5):
+# i totali mensili si leggono senza scorrere le singole lezioni.
+
+_AGGREGATE = '''
+    SELECT lessons.student_id, substr(lessons.date, 1, 7), SUM(duration),
+           SUM(duration * students.hourly_cost), COUNT(*), lessons.tenant_id
+    FROM lessons JOIN students ON lessons.student_id = students.id
+    GROUP BY lessons.student_id, substr(lessons.date, 1, 7)
+'''
+
+_TABLES = ('billing_summary', 'lessons', 'students')
+
+
+def month_key(day):
+    return f'{day.year:04d}-{day.month:02d}'
+
+
+def rebuild():
+    # Ricalcola da zero il riepilogo (dopo modifiche fatte con i trigger disattivati o per
+    # eliminare gli arrotondamenti accumulati) per tutti i tenant del database; restituisce il numero di righe
+    with transaction() as conn:
+        conn.execute('DELETE FROM billing_summary')
+        conn.execute('INSERT INTO billing_summary (student_id, month, hours, cost, lessons, tenant_id)' + _AGGREGATE)
+        count = conn.execute('SELECT COUNT(*) FROM billing_summary').fetchone()[0]
+    query_cache.invalidate('billing_summary')
+    return count
+
+
+def check(tolerance=1e-6):
+    # Righe del riepilogo che differiscono dal ricalcolo completo: (student_id, month)
+    with get_connection() as conn:
+        expected = {(r[0], r[1]): r[2:] for r in conn.execute(_AGGREGATE)}
+        stored = {(r[0], r[1]): r[2:] for r in conn.execute(
+            'SELECT student_id, month, hours, cost, lessons, tenant_id FROM billing_summary')}
+    return sorted(key for key in expected.keys() | stored.keys()
+                  if key not in expected or key not in stored
+                  or any(abs(a - b) > tolerance for a, b in zip(expected[key], stored[key])))
+
+
+@query_cache.cached(*_TABLES)
+def get_monthly_totals(first_month, last_month, student_id=None):
+    # Totali per mese ('AAAA-MM') tra first_month e last_month inclusi
+    query = '''
+        SELECT month, SUM(hours) as duration, SUM(cost) as costo, SUM(lessons) as lezioni
+        FROM billing_summary
+        WHERE tenant_id = ? AND month >= ? AND month <= ?
+    '''
+    params = [current_tenant(), first_month, last_month]
+    if student_id is not None:
+        query += ' AND student_id = ?'
+        params.append(int(student_id))
+    with get_connection() as conn:
+        return pd.read_sql_query(query + ' GROUP BY month ORDER BY month', conn, params=params)
+
+
+@query_cache.cached(*_TABLES)
+def get_month_billing(month):
+    # Riepilogo per studente di un mese, base per le fatture mensili
+    with get_connection() as conn:
+        return pd.read_sql_query('''
+            SELECT billing_summary.student_id, students.name as studente, students.email,
+                   students.hourly_cost, hours as duration, cost as costo, lessons as lezioni
+            FROM billing_summary
+            JOIN students ON billing_summary.student_id = students.id
+            WHERE billing_summary.tenant_id = ? AND month = ?
+            ORDER BY students.name
+        ''', conn, params=(current_tenant(), month))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Riepilogo di fatturazione per studente e mese')
+    parser.add_argument('command', choices=['rebuild', 'check'])
+    args = parser.parse_args()
+
+    from database import init_db
+    init_db()
+
+    if args.command == 'rebuild':
+        print(f"Riepilogo ricostruito: {rebuild()} righe")
+    else:
+        differences = check()
+        for student_id, month in differences:
+            print(f"Differenza per studente {student_id}, mese {month}")
+        print("Riepilogo allineato" if not differences else f"{len(differences)} righe da ricostruire")
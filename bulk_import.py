@@ -0,0 +1,306 @@
+import argparse
+import math
+import os
+import sqlite3
+from collections import namedtuple
+from datetime import date, datetime
+
+import pandas as pd
+
+import calendar_data
+import query_cache
+from conflicts import CONFLICT_LABELS, BatchChecker, format_time
+from connection import get_connection, transaction
+from database import provision_accounts
+from tenancy import current_tenant, directory
+
+CHUNK_SIZE = 5000
+
+ImportResult = namedtuple('ImportResult', ['inserted', 'errors'])
+
+# Colonne attese per ogni tipo di importazione (le alternative sono separate da '|')
+COLUMNS = {
+    'students': ['name', 'email', 'hourly_cost'],
+    'subjects': ['name', 'teacher_id?'],
+    'lessons': ['student_id|student_email', 'subject_id|subject_name', 'date', 'start_time?', 'duration', 'notes?'],
+}
+
+
+class RowError(ValueError):
+    pass
+
+
+def _read_chunks(source, filename, chunk_size):
+    # Legge CSV o XLSX a blocchi di chunk_size righe, come liste di dizionari
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise RuntimeError("Per importare file Excel è necessario installare openpyxl")
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else '' for h in next(rows, [])]
+        chunk = []
+        for values in rows:
+            if all(v is None for v in values):
+                continue
+            chunk.append(dict(zip(header, values)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        workbook.close()
+    else:
+        for frame in pd.read_csv(source, chunksize=chunk_size, dtype=str, keep_default_na=False,
+                                 skipinitialspace=True):
+            frame.columns = [c.strip() for c in frame.columns]
+            yield frame.to_dict('records')
+
+
+def _text(row, column, required=True):
+    value = row.get(column)
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        value = ''
+    value = str(value).strip()
+    if required and not value:
+        raise RowError(f"campo '{column}' mancante")
+    return value or None
+
+
+def _number(row, column):
+    value = _text(row, column)
+    try:
+        number = float(value.replace(',', '.'))
+    except ValueError:
+        raise RowError(f"valore non numerico per '{column}': {value}")
+    if number < 0 or math.isnan(number):
+        raise RowError(f"valore non valido per '{column}': {value}")
+    return number
+
+
+def _date(row, column):
+    value = row.get(column)
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    value = _text(row, column)
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            pass
+    raise RowError(f"data non valida: {value}")
+
+
+def _integer(row, column):
+    value = _text(row, column)
+    try:
+        return int(float(value))
+    except ValueError:
+        raise RowError(f"identificativo non valido per '{column}': {value}")
+
+
+class _Importer:
+    # Mappe in memoria degli identificativi esistenti, per validare le righe senza query
+
+    def __init__(self, kind, teacher_id):
+        self.kind = kind
+        self.teacher_id = teacher_id
+        tenant = current_tenant()
+        if kind == 'subjects':
+            with directory(), get_connection() as conn:
+                self.teacher_ids = {r[0] for r in conn.execute(
+                    "SELECT id FROM users WHERE tenant_id = ? AND role = 'insegnante'", (tenant,))}
+        with get_connection() as conn:
+            if kind == 'students':
+                self.emails = {r[0] for r in conn.execute('SELECT email FROM students WHERE tenant_id = ?', (tenant,))}
+            elif kind == 'lessons':
+                self.students = {}
+                for student_id, email in conn.execute('SELECT id, email FROM students WHERE tenant_id = ?', (tenant,)):
+                    self.students[student_id] = student_id
+                    self.students[email.lower()] = student_id
+                self.subjects = {}
+                self.ambiguous_subjects = set()
+                for subject_id, name in conn.execute('SELECT id, name FROM subjects WHERE tenant_id = ?', (tenant,)):
+                    self.subjects[subject_id] = subject_id
+                    name = name.lower()
+                    if name in self.subjects:
+                        self.ambiguous_subjects.add(name)
+                    self.subjects[name] = subject_id
+
+    def parse(self, row):
+        if self.kind == 'students':
+            email = _text(row, 'email')
+            if email in self.emails:
+                raise RowError(f"email già esistente: {email}")
+            values = (_text(row, 'name'), email, _number(row, 'hourly_cost'))
+            self.emails.add(email)
+            return values
+
+        if self.kind == 'subjects':
+            teacher_id = self.teacher_id
+            if _text(row, 'teacher_id', required=False):
+                teacher_id = _integer(row, 'teacher_id')
+            if teacher_id not in self.teacher_ids:
+                raise RowError(f"insegnante inesistente: {teacher_id}")
+            return _text(row, 'name'), teacher_id
+
+        if _text(row, 'student_id', required=False):
+            student_id = self.students.get(_integer(row, 'student_id'))
+        else:
+            student_id = self.students.get(_text(row, 'student_email').lower())
+        if student_id is None:
+            raise RowError("studente inesistente")
+
+        if _text(row, 'subject_id', required=False):
+            subject_id = self.subjects.get(_integer(row, 'subject_id'))
+        else:
+            subject_name = _text(row, 'subject_name').lower()
+            if subject_name in self.ambiguous_subjects:
+                raise RowError(f"nome materia ambiguo: {subject_name}, usare subject_id")
+            subject_id = self.subjects.get(subject_name)
+        if subject_id is None:
+            raise RowError("materia inesistente")
+
+        duration = _number(row, 'duration')
+        if duration == 0:
+            raise RowError("la durata deve essere maggiore di zero")
+        start_time = row.get('start_time')
+        if not hasattr(start_time, 'hour'):
+            start_time = _text(row, 'start_time', required=False)
+        try:
+            start_time = format_time(start_time)
+        except ValueError:
+            raise RowError(f"orario non valido: {start_time}")
+        return (student_id, subject_id, _date(row, 'date'), start_time, duration,
+                _text(row, 'notes', required=False))
+
+
+# L'ultimo parametro di ogni insert è il tenant corrente
+_INSERTS = {
+    'students': 'INSERT INTO students (name, email, hourly_cost, tenant_id) VALUES (?, ?, ?, ?)',
+    'subjects': 'INSERT INTO subjects (name, teacher_id, tenant_id) VALUES (?, ?, ?)',
+    'lessons': '''INSERT INTO lessons (student_id, subject_id, date, start_time, duration, notes, tenant_id)
+                  VALUES (?, ?, ?, ?, ?, ?, ?)''',
+}
+
+
+def _insert_rows(kind, values, errors):
+    inserted = 0
+    with transaction() as conn:
+        for row in values:
+            try:
+                conn.execute(_INSERTS[kind], row + (current_tenant(),))
+                inserted += 1
+            except sqlite3.IntegrityError as e:
+                errors.append((None, f"{row}: {e}"))
+    return inserted
+
+
+def _provision(conn, emails, errors):
+    # Account bloccati per gli studenti appena inseriti; lo studente resta anche se il suo
+    # username è già usato da un altro account del tenant, e l'errore viene riportato
+    students = conn.execute(f'''SELECT id, email FROM students
+                                WHERE tenant_id = ? AND email IN ({','.join('?' * len(emails))})''',
+                            [current_tenant()] + emails).fetchall()
+    for _, email in provision_accounts(students):
+        errors.append((None, f"{email}: account non creato, username già in uso"))
+
+
+def _without_conflicts(conn, values, errors):
+    # Scarta le lezioni sovrapposte a lezioni esistenti o ad altre righe dello stesso file
+    days = [v[2] for _, v in values]
+    checker = BatchChecker(conn, min(days), max(days))
+    accepted = []
+    for row_number, (student_id, subject_id, day, start_time, duration, notes) in values:
+        kinds = checker.check(student_id, subject_id, day, start_time, duration)
+        if kinds:
+            errors.append((row_number, "conflitto di orario per " + ' e '.join(CONFLICT_LABELS[k] for k in kinds)))
+        else:
+            accepted.append((row_number, (student_id, subject_id, day, start_time, duration, notes)))
+    return accepted
+
+
+def _import_chunks(kind, chunks, teacher_id, progress):
+    # Ogni blocco è inserito con executemany in un'unica transazione; le righe non valide
+    # vengono saltate e riportate in errors come (numero di riga, messaggio).
+    if kind not in _INSERTS:
+        raise ValueError(f"Tipo di importazione sconosciuto: {kind}")
+
+    importer = _Importer(kind, teacher_id)
+    inserted = 0
+    errors = []
+    row_number = 1  # la riga 1 è l'intestazione
+
+    for chunk in chunks:
+        values = []
+        for row in chunk:
+            row_number += 1
+            try:
+                values.append((row_number, importer.parse(row)))
+            except RowError as e:
+                errors.append((row_number, str(e)))
+        if values:
+            try:
+                with transaction() as conn:
+                    if kind == 'lessons':
+                        values = _without_conflicts(conn, values, errors)
+                    conn.executemany(_INSERTS[kind], [v + (current_tenant(),) for _, v in values])
+                    if kind == 'students':
+                        _provision(conn, [v[1] for _, v in values], errors)
+                inserted += len(values)
+            except sqlite3.IntegrityError:
+                # Vincolo violato da una scrittura concorrente: il blocco viene ripetuto riga per riga
+                inserted += _insert_rows(kind, [v for _, v in values], errors)
+                if kind == 'students':
+                    with transaction() as conn:
+                        _provision(conn, [v[1] for _, v in values], errors)
+        if progress:
+            progress(inserted, len(errors))
+
+    errors.sort(key=lambda e: e[0] or 0)
+    query_cache.invalidate(kind)
+    if kind == 'students':
+        query_cache.invalidate('users')
+    if kind == 'lessons':
+        calendar_data.invalidate()
+    return ImportResult(inserted, errors)
+
+
+def import_file(kind, source, filename=None, teacher_id=1, chunk_size=CHUNK_SIZE, progress=None):
+    # Importa un file CSV/XLSX di studenti, materie o lezioni
+    if filename is None:
+        filename = getattr(source, 'name', str(source))
+    return _import_chunks(kind, _read_chunks(source, filename, chunk_size), teacher_id, progress)
+
+
+def import_rows(kind, rows, teacher_id=1, chunk_size=CHUNK_SIZE):
+    # Come import_file, per righe già lette (dizionari con le colonne di COLUMNS),
+    # ad esempio il corpo di una richiesta all'API. I numeri di riga partono da 2 come nei file.
+    chunks = (rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size))
+    return _import_chunks(kind, chunks, teacher_id, None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Importazione massiva di studenti, materie o lezioni')
+    parser.add_argument('kind', choices=list(_INSERTS))
+    parser.add_argument('file', help='file CSV o XLSX')
+    parser.add_argument('--teacher-id', type=int, default=1,
+                        help='insegnante assegnato alle materie senza teacher_id')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file):
+        parser.error(f"File non trovato: {args.file}")
+
+    from database import init_db
+    init_db()
+
+    result = import_file(args.kind, args.file, teacher_id=args.teacher_id, chunk_size=args.chunk_size,
+                         progress=lambda n, e: print(f"\r{n} righe importate, {e} errori", end='', flush=True))
+    print()
+    for row_number, message in result.errors:
+        print(f"Riga {row_number}: {message}")
+    print(f"Importate {result.inserted} righe, {len(result.errors)} scartate")
@@ -0,0 +1,68 @@
+import threading
+from collections import namedtuple
+from datetime import date, datetime
+
+import query_cache
+import recurrence
+from connection import get_connection
+from reports import month_bounds, date_bounds
+from tenancy import current_tenant
+
+DaySummary = namedtuple('DaySummary', ['lessons', 'hours', 'cost'])
+
+# Riepiloghi per mese condivisi tra le sessioni: (tenant, anno, mese) -> ({giorno: DaySummary}, generazione).
+# La generazione di lesson_series rende obsoleti i mesi quando cambiano le serie ricorrenti.
+_month_cache = {}
+_lock = threading.Lock()
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def get_month_summary(day):
+    # Lezioni, ore e costo per ogni giorno del mese che contiene day, con una sola GROUP BY
+    # più le ripetizioni delle serie ricorrenti non ancora materializzate
+    key = (current_tenant(), day.year, day.month)
+    series_generation = query_cache.generation('lesson_series')
+    with _lock:
+        cached = _month_cache.get(key)
+    if cached is not None and cached[1] == series_generation:
+        return cached[0]
+
+    first, last = month_bounds(day)
+    with get_connection() as conn:
+        rows = conn.execute('''
+            SELECT date(lessons.date), COUNT(*), SUM(duration), SUM(duration * students.hourly_cost)
+            FROM lessons
+            JOIN students ON lessons.student_id = students.id
+            WHERE lessons.tenant_id = ? AND lessons.date >= ? AND lessons.date < ?
+            GROUP BY date(lessons.date)
+        ''', (key[0],) + date_bounds(first, last)).fetchall()
+    summary = {int(d[8:10]): DaySummary(count, hours, cost) for d, count, hours, cost in rows}
+
+    for lesson_date, _, _, duration, cost, *_ in recurrence.expand(first, last):
+        lessons, hours, total = summary.get(lesson_date.day, DaySummary(0, 0.0, 0.0))
+        summary[lesson_date.day] = DaySummary(lessons + 1, hours + duration, total + cost)
+
+    with _lock:
+        _month_cache[key] = (summary, series_generation)
+    return summary
+
+
+def invalidate(*days):
+    # Scarta i mesi del tenant corrente che contengono le date indicate;
+    # senza argomenti svuota tutta la cache
+    with _lock:
+        if not days:
+            _month_cache.clear()
+            return
+        for day in days:
+            if day is None:
+                continue
+            day = _to_date(day)
+            _month_cache.pop((current_tenant(), day.year, day.month), None)
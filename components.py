@@ -0,0 +1,178 @@
+import mimetypes
+import os
+
+import streamlit as st
+
+import jobs
+import metrics
+from pagination import PAGE_SIZES, TABLES
+from search import search_lessons
+from storage import get_repository
+
+# Intervallo (secondi) con cui si aggiorna lo stato di un'attività in corso
+JOB_POLL_SECONDS = 1.0
+
+
+def _reset_pages(key):
+    st.session_state[f'{key}_cursors'] = [None]
+
+
+# Le tabelle e la ricerca sono frammenti: cambiare pagina, ordinamento o testo cercato
+# riesegue solo il frammento. I pulsanti che modificano i dati usano st.rerun() per
+# aggiornare tutta la pagina.
+@st.fragment
+@metrics.timed()
+def render_paginated_table(key, table, title, headers, widths, render_row,
+                           default_sort=None, descending=False, page_size=25):
+    # Tabella paginata lato SQL: vengono lette e disegnate solo le righe della pagina visibile.
+    # render_row(row, cols) riempie le colonne di una riga (valori e pulsanti).
+    sort_options = list(TABLES[table]['sort'])
+    cursors_key = f'{key}_cursors'
+    if cursors_key not in st.session_state:
+        _reset_pages(key)
+
+    # Controlli di ricerca, ordinamento e dimensione pagina
+    col1, col2, col3, col4 = st.columns([3, 2, 1, 1])
+    with col1:
+        search = st.text_input('Cerca', key=f'{key}_search', on_change=_reset_pages, args=(key,))
+    with col2:
+        sort = st.selectbox('Ordina per', sort_options,
+                            index=sort_options.index(default_sort) if default_sort else 0,
+                            key=f'{key}_sort', on_change=_reset_pages, args=(key,))
+    with col3:
+        descending = st.toggle('Decrescente', value=descending, key=f'{key}_desc',
+                               on_change=_reset_pages, args=(key,))
+    with col4:
+        limit = st.selectbox('Righe', PAGE_SIZES, index=PAGE_SIZES.index(page_size),
+                             key=f'{key}_size', on_change=_reset_pages, args=(key,))
+
+    # Pila dei cursori: l'ultimo elemento è l'inizio della pagina corrente
+    cursors = st.session_state[cursors_key]
+    page_df, next_cursor = get_repository().fetch_page(table, sort, descending, search.strip() or None,
+                                                       cursors[-1], limit)
+
+    if page_df.empty:
+        if len(cursors) > 1:
+            # La pagina si è svuotata (es. dopo un'eliminazione): torna alla precedente
+            cursors.pop()
+            st.rerun()
+        if search:
+            st.info('Nessun risultato')
+        return
+
+    if title:
+        st.subheader(title)
+
+    cols = st.columns(widths)
+    for col, header in zip(cols, headers):
+        with col:
+            st.write(header)
+
+    for _, row in page_df.iterrows():
+        render_row(row, st.columns(widths))
+
+    # Navigazione tra le pagine
+    col1, col2, col3 = st.columns([1, 3, 1])
+    with col1:
+        st.button('◀ Precedente', key=f'{key}_prev', disabled=len(cursors) == 1, on_click=cursors.pop)
+    with col2:
+        st.write(f"Pagina {len(cursors)}")
+    with col3:
+        st.button('Successiva ▶', key=f'{key}_next', disabled=next_cursor is None,
+                  on_click=cursors.append, args=(next_cursor,))
+
+
+def _first_page(page_key):
+    st.session_state[page_key] = 0
+
+
+def _move_page(page_key, step):
+    st.session_state[page_key] += step
+
+
+@st.fragment
+@metrics.timed()
+def render_lesson_search(key, start=None, end=None, student_id=None):
+    # Ricerca testuale nelle note e nei nomi, con risultati ordinati per pertinenza e paginati
+    page_key = f'{key}_page'
+    text = st.text_input('Cerca nelle lezioni', key=f'{key}_text', placeholder='es. derivate',
+                         on_change=_first_page, args=(page_key,))
+    if not text.strip():
+        return
+    page = st.session_state.setdefault(page_key, 0)
+    results, has_more = search_lessons(text, start, end, student_id, page)
+    if results.empty:
+        st.info('Nessun risultato')
+        return
+
+    for _, row in results.iterrows():
+        orario = f" {row['start_time']}" if row['start_time'] else ''
+        notes = (row['notes'] or '').replace('\n', ' ')
+        st.markdown(f"**{row['date']:%d/%m/%Y}{orario}** · {row['studente']} · {row['materia']} "
+                    f"({row['duration']:g} ore)  \n{notes}")
+
+    col1, col2, col3 = st.columns([1, 3, 1])
+    with col1:
+        st.button('◀ Precedente', key=f'{key}_prev', disabled=page == 0,
+                  on_click=_move_page, args=(page_key, -1))
+    with col2:
+        st.write(f"Pagina {page + 1}")
+    with col3:
+        st.button('Successiva ▶', key=f'{key}_next', disabled=not has_more,
+                  on_click=_move_page, args=(page_key, 1))
+
+
+def _cancel_job(key):
+    jobs.cancel(st.session_state[key])
+
+
+def _read_result(path):
+    # Letto solo quando l'utente scarica il file; il file viene chiuso subito
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _job_status(key, label, file_name, cancellable, polling):
+    job = jobs.get_job(st.session_state[key])
+    if polling and job.status not in jobs.ACTIVE:
+        # Attività terminata: la pagina viene aggiornata per mostrarne il risultato
+        st.rerun()
+
+    if job.status in jobs.ACTIVE:
+        testo = f"{label}: {jobs.STATUSES[job.status]}" + (f" — {job.message}" if job.message else '')
+        st.progress(job.progress or 0.0, text=testo)
+        if cancellable:
+            st.button('Annulla', key=f'{key}_cancel', on_click=_cancel_job, args=(key,))
+    elif job.status == 'done':
+        st.success(f"{label}: {job.message}")
+        if file_name:
+            extension = os.path.splitext(job.result_path)[1]
+            st.download_button(
+                label=f'Scarica {extension[1:]}',
+                data=lambda path=job.result_path: _read_result(path),
+                file_name=file_name + extension,
+                mime=mimetypes.guess_type(job.result_path)[0] or 'application/octet-stream',
+                key=f'{key}_download'
+            )
+    elif job.status == 'failed':
+        st.error(f"{label} non riuscita: {job.message}")
+    else:
+        st.info(f"{label} annullata")
+
+
+@metrics.timed()
+def render_job(key, label, file_name=None, cancellable=True):
+    # Stato dell'attività in background il cui id è in st.session_state[key]: avanzamento e
+    # annullamento finché è in corso, poi il file da scaricare (file_name senza estensione).
+    # Solo questo frammento si aggiorna ogni JOB_POLL_SECONDS. Restituisce l'attività.
+    if st.session_state.get(key) is None:
+        return None
+    job = jobs.get_job(st.session_state[key])
+    if job is None:
+        # Attività scaduta e rimossa da jobs.cleanup()
+        del st.session_state[key]
+        return None
+    polling = job.status in jobs.ACTIVE
+    st.fragment(_job_status, run_every=JOB_POLL_SECONDS if polling else None)(key, label, file_name,
+                                                                              cancellable, polling)
+    return job
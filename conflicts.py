@@ -0,0 +1,217 @@
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import date, datetime
+
+from tenancy import current_tenant
+
+# Le lezioni senza orario di inizio non occupano una fascia oraria e non generano conflitti
+
+Conflict = namedtuple('Conflict', ['kind', 'lesson_id', 'date', 'start_time', 'duration', 'student', 'subject'])
+
+CONFLICT_LABELS = {'student': 'lo studente', 'teacher': "l'insegnante"}
+
+
+def to_minutes(start_time):
+    # Accetta 'HH:MM', 'HH:MM:SS' o datetime.time; restituisce i minuti dalla mezzanotte
+    if start_time is None or start_time == '':
+        return None
+    if hasattr(start_time, 'hour'):
+        return start_time.hour * 60 + start_time.minute
+    hours, minutes = str(start_time).split(':')[:2]
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Orario non valido: {start_time}")
+    return hours * 60 + minutes
+
+
+def format_time(start_time):
+    # Normalizza l'orario nel formato 'HH:MM' usato nel database
+    minutes = to_minutes(start_time)
+    if minutes is None:
+        return None
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+def _iso(day):
+    if isinstance(day, datetime):
+        day = day.date()
+    if isinstance(day, date):
+        return day.isoformat()
+    return str(day)[:10]
+
+
+def describe(conflict):
+    return (f"{CONFLICT_LABELS[conflict.kind].capitalize()} ha già una lezione il "
+            f"{datetime.strptime(conflict.date, '%Y-%m-%d').strftime('%d/%m/%Y')} alle {conflict.start_time} "
+            f"({conflict.student} - {conflict.subject}, {conflict.duration} ore)")
+
+
+class IntervalIndex:
+    # Indice in memoria degli intervalli occupati per (risorsa, giorno).
+    # Ogni lista è ordinata per inizio; la ricerca parte dalla posizione trovata con bisect
+    # e risale solo finché un intervallo precedente potrebbe ancora sovrapporsi.
+
+    def __init__(self):
+        self._starts = {}
+        self._items = {}
+        self._longest = {}
+
+    def add(self, key, start, end, ref=None):
+        starts = self._starts.setdefault(key, [])
+        items = self._items.setdefault(key, [])
+        position = bisect_left(starts, start)
+        starts.insert(position, start)
+        items.insert(position, (start, end, ref))
+        self._longest[key] = max(self._longest.get(key, 0), end - start)
+
+    def overlaps(self, key, start, end):
+        starts = self._starts.get(key)
+        if not starts:
+            return []
+        found = []
+        position = bisect_left(starts, end)
+        items = self._items[key]
+        longest = self._longest[key]
+        for i in range(position - 1, -1, -1):
+            item_start, item_end, ref = items[i]
+            if item_start + longest <= start:
+                break
+            if item_end > start:
+                found.append(ref)
+        return found
+
+
+def _overlap(start, end, other_start, other_duration):
+    other_start = to_minutes(other_start)
+    return other_start < end and other_start + other_duration * 60 > start
+
+
+def find_conflicts(conn, student_id, subject_id, day, start_time, duration, exclude_lesson_id=None):
+    # Lezioni (e ripetizioni di serie non materializzate) dello stesso studente o dello stesso
+    # insegnante che si sovrappongono all'intervallo indicato.
+    # Le due ricerche usano gli indici (student_id, date) e (subject_id, date).
+    start = to_minutes(start_time)
+    if start is None:
+        return []
+    end = start + duration * 60
+    day = _iso(day)
+    tenant = current_tenant()
+
+    rows = conn.execute('''
+        SELECT 'student', lessons.id, lessons.date, lessons.start_time, lessons.duration,
+               students.name, subjects.name
+        FROM lessons
+        JOIN students ON lessons.student_id = students.id
+        JOIN subjects ON lessons.subject_id = subjects.id
+        WHERE lessons.student_id = ? AND lessons.date = ? AND lessons.start_time IS NOT NULL
+          AND lessons.tenant_id = ?
+        UNION ALL
+        SELECT 'teacher', lessons.id, lessons.date, lessons.start_time, lessons.duration,
+               students.name, subjects.name
+        FROM lessons
+        JOIN students ON lessons.student_id = students.id
+        JOIN subjects ON lessons.subject_id = subjects.id
+        WHERE lessons.subject_id IN (
+                  SELECT id FROM subjects
+                  WHERE tenant_id = ? AND teacher_id = (SELECT teacher_id FROM subjects WHERE id = ?))
+          AND lessons.date = ? AND lessons.start_time IS NOT NULL AND lessons.tenant_id = ?
+    ''', (int(student_id), day, tenant, tenant, int(subject_id), day, tenant)).fetchall()
+
+    conflicts = []
+    seen = set()
+    for kind, lesson_id, lesson_date, lesson_start, lesson_duration, student, subject in rows:
+        if lesson_id == exclude_lesson_id or lesson_id in seen:
+            continue
+        if _overlap(start, end, lesson_start, lesson_duration):
+            seen.add(lesson_id)
+            conflicts.append(Conflict(kind, lesson_id, lesson_date, lesson_start, lesson_duration, student, subject))
+
+    conflicts.extend(_series_conflicts(conn, student_id, subject_id, day, start, end))
+    return conflicts
+
+
+def _series_conflicts(conn, student_id, subject_id, day, start, end):
+    import recurrence
+
+    tenant = current_tenant()
+    teacher = conn.execute('SELECT teacher_id FROM subjects WHERE id = ? AND tenant_id = ?',
+                           (int(subject_id), tenant)).fetchone()
+    teacher_subjects = set()
+    if teacher:
+        teacher_subjects = {r[0] for r in conn.execute('SELECT id FROM subjects WHERE tenant_id = ? AND teacher_id = ?',
+                                                       (tenant, teacher[0]))}
+
+    conflicts = []
+    for (lesson_date, student, subject, duration, _, _, s_student, s_subject, series_id,
+         lesson_start) in recurrence.expand(day, day):
+        if lesson_start is None or not _overlap(start, end, lesson_start, duration):
+            continue
+        if s_student == int(student_id):
+            kind = 'student'
+        elif s_subject in teacher_subjects:
+            kind = 'teacher'
+        else:
+            continue
+        conflicts.append(Conflict(kind, None, lesson_date.isoformat(), lesson_start, duration, student, subject))
+    return conflicts
+
+
+class BatchChecker:
+    # Verifica dei conflitti per inserimenti multipli (importazione, serie, pianificazione automatica):
+    # carica una sola volta le lezioni esistenti del periodo e controlla ogni nuova lezione
+    # sull'IntervalIndex, aggiungendola all'indice se accettata.
+
+    def __init__(self, conn, first_day, last_day, exclude_series=()):
+        import recurrence
+
+        tenant = current_tenant()
+        self.teacher_of = dict(conn.execute('SELECT id, teacher_id FROM subjects WHERE tenant_id = ?', (tenant,)))
+        self.index = IntervalIndex()
+        for lesson_id, student_id, subject_id, day, start_time, duration in conn.execute('''
+                SELECT id, student_id, subject_id, date, start_time, duration FROM lessons
+                WHERE tenant_id = ? AND date >= ? AND date <= ? AND start_time IS NOT NULL
+                ''', (tenant, _iso(first_day), _iso(last_day))):
+            self._add(student_id, subject_id, day, to_minutes(start_time), duration, lesson_id)
+
+        # Ripetizioni delle serie non ancora materializzate (tranne quelle in corso di inserimento)
+        for (day, _, _, duration, _, _, student_id, subject_id, series_id,
+             start_time) in recurrence.expand(first_day, last_day):
+            if start_time is not None and series_id not in exclude_series:
+                self._add(student_id, subject_id, day, to_minutes(start_time), duration, None)
+
+    @classmethod
+    def from_busy(cls, teacher_of, busy):
+        # Come il costruttore, per impegni già letti da un altro archivio (PostgreSQL):
+        # busy contiene (student_id, subject_id, giorno, orario di inizio, durata)
+        checker = cls.__new__(cls)
+        checker.teacher_of = teacher_of
+        checker.index = IntervalIndex()
+        for student_id, subject_id, day, start_time, duration in busy:
+            if start_time is not None:
+                checker._add(student_id, subject_id, day, to_minutes(start_time), duration, None)
+        return checker
+
+    def _keys(self, student_id, subject_id, day):
+        # Una materia senza insegnante noto non occupa la fascia di nessun insegnante
+        keys = [('student', student_id, day)]
+        teacher_id = self.teacher_of.get(subject_id)
+        if teacher_id is not None:
+            keys.append(('teacher', teacher_id, day))
+        return keys
+
+    def _add(self, student_id, subject_id, day, start, duration, ref):
+        for key in self._keys(student_id, subject_id, _iso(day)):
+            self.index.add(key, start, start + duration * 60, ref)
+
+    def check(self, student_id, subject_id, day, start_time, duration, ref=None):
+        # Restituisce i tipi di conflitto trovati ('student'/'teacher'); se non ce ne sono
+        # la lezione viene registrata nell'indice
+        start = to_minutes(start_time)
+        if start is None:
+            return []
+        end = start + duration * 60
+        kinds = [key[0] for key in self._keys(student_id, subject_id, _iso(day))
+                 if self.index.overlaps(key, start, end)]
+        if not kinds:
+            self._add(student_id, subject_id, day, start, duration, ref)
+        return kinds
@@ -0,0 +1,433 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import connection
+import storage
+from tenancy import tenant_scope
+
+# Verifica e benchmark comuni alle implementazioni di storage.Repository: gli stessi passi vengono
+# eseguiti su ogni archivio, partendo ogni volta da un archivio vuoto (file temporaneo per SQLite,
+# schema dedicato per PostgreSQL). Senza un DSN, PostgreSQL viene avviato in locale in una
+# directory temporanea con initdb e pg_ctl.
+
+# Directory con initdb e pg_ctl; vuoto = cercarli nel PATH
+PG_BIN = os.environ.get('PLANNER_PG_BIN', '')
+
+# Schema usato su un PostgreSQL esistente: viene creato all'inizio e rimosso alla fine
+SCHEMA = 'planner_conformance'
+
+# Periodo coperto dalle lezioni del benchmark e thread usati per le scritture concorrenti
+BENCH_YEAR = 2025
+THREADS = 4
+
+
+@contextmanager
+def local_postgres(bin_dir=PG_BIN):
+    # Istanza PostgreSQL temporanea raggiungibile solo dal socket nella sua directory dei dati.
+    # initdb non può essere eseguito dall'utente root.
+    initdb = shutil.which('initdb', path=bin_dir or None)
+    pg_ctl = shutil.which('pg_ctl', path=bin_dir or None)
+    if initdb is None or pg_ctl is None:
+        raise RuntimeError("initdb e pg_ctl non trovati: installare PostgreSQL o impostare PLANNER_PG_BIN")
+    data_dir = tempfile.mkdtemp(prefix='planner_pg_')
+    try:
+        subprocess.run([initdb, '-D', data_dir, '-U', 'planner', '--auth=trust', '-E', 'UTF8', '--no-sync'],
+                       check=True, capture_output=True, text=True)
+        subprocess.run([pg_ctl, '-D', data_dir, '-l', os.path.join(data_dir, 'server.log'), '-w',
+                        '-o', f"-k {data_dir} -c listen_addresses='' -c fsync=off", 'start'],
+                       check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        shutil.rmtree(data_dir, ignore_errors=True)
+        raise RuntimeError(f"Avvio di PostgreSQL non riuscito: {(e.stderr or e.stdout).strip()}")
+    try:
+        yield f'host={data_dir} user=planner dbname=postgres'
+    finally:
+        subprocess.run([pg_ctl, '-D', data_dir, '-m', 'fast', '-w', 'stop'], capture_output=True)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def _drop_schema(dsn):
+    import psycopg
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        conn.execute(f'DROP SCHEMA IF EXISTS "{SCHEMA}" CASCADE')
+
+
+@contextmanager
+def empty_repository(backend, dsn=None):
+    if backend == 'sqlite':
+        work_dir = tempfile.mkdtemp(prefix='planner_storage_')
+        previous = connection.DB_PATH
+        connection.configure(os.path.join(work_dir, 'planner.db'))
+        repo = storage.SQLiteRepository()
+        try:
+            yield repo
+        finally:
+            repo.close()
+            connection.configure(previous)
+            shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        _drop_schema(dsn)
+        repo = storage.PostgresRepository(dsn, schema=SCHEMA)
+        try:
+            yield repo
+        finally:
+            repo.close()
+            _drop_schema(dsn)
+
+
+# --- Verifica ---
+
+def _rejected(operation, *args):
+    # Messaggio del ValueError sollevato dall'operazione, oppure 'accettata'
+    try:
+        operation(*args)
+    except ValueError as e:
+        return str(e)
+    return 'accettata'
+
+
+def check(repo):
+    # Restituisce una lista di (verifica, errore o None); si ferma alla prima eccezione
+    results = []
+
+    def expect(name, condition, detail=''):
+        results.append((name, None if condition else (detail or 'risultato inatteso')))
+
+    try:
+        anna = repo.add_student('Anna Rossi', 'anna@esempio.it', 20.0)
+        luca = repo.add_student('Luca Bianchi', 'luca@esempio.it', 30.0)
+        expect('add_student restituisce l\'id', isinstance(anna, int) and isinstance(luca, int) and anna != luca,
+               f'{anna!r}, {luca!r}')
+        expect('add_student rifiuta un\'email già registrata',
+               repo.add_student('Altra Anna', 'anna@esempio.it', 10.0) is False)
+
+        student = repo.get_student(anna)
+        expect('get_student', student is not None and (student['name'], student['email'], student['hourly_cost'])
+               == ('Anna Rossi', 'anna@esempio.it', 20.0), str(student))
+        expect('get_student di uno studente inesistente', repo.get_student(anna + luca + 1000) is None)
+        expect('update_student', repo.update_student(anna, 'Anna Rossi', 'anna@esempio.it', 25.0) is True
+               and repo.get_student(anna)['hourly_cost'] == 25.0)
+        expect('update_student rifiuta un\'email già registrata',
+               repo.update_student(luca, 'Luca Bianchi', 'anna@esempio.it', 30.0) is False
+               and repo.get_student(luca)['email'] == 'luca@esempio.it')
+
+        # Due materie dello stesso insegnante e una di un altro
+        math = repo.add_subject('Matematica', 1)
+        physics = repo.add_subject('Fisica', 1)
+        latin = repo.add_subject('Latino', 2)
+        subject = repo.get_subject(math)
+        expect('add_subject e get_subject', subject is not None and (subject['name'], subject['teacher_id'])
+               == ('Matematica', 1), str(subject))
+        expect('update_subject', repo.update_subject(latin, 'Latino e greco', 2) is True
+               and repo.get_subject(latin)['name'] == 'Latino e greco')
+
+        day = date(2025, 3, 10)
+        ok, message = repo.add_lesson(anna, math, day, 1.5, 'derivate', '15:00')
+        expect('add_lesson', ok and message == 'Lezione programmata con successo!', message)
+        ok, message = repo.add_lesson(anna, latin, day, 1.0, None, '16:00')
+        expect('add_lesson: sovrapposizione per lo studente', not ok and message.startswith('Lo studente')
+               and '10/03/2025 alle 15:00' in message, message)
+        ok, message = repo.add_lesson(luca, physics, day, 1.0, None, '14:30')
+        expect("add_lesson: sovrapposizione per l'insegnante", not ok and message.startswith("L'insegnante"),
+               message)
+        ok, message = repo.add_lesson(luca, physics, day, 1.0, None, '16:30')
+        expect('add_lesson: lezioni adiacenti', ok, message)
+        ok, message = repo.add_lesson(luca, latin, day, 1.0, 'senza orario')
+        expect('add_lesson senza orario', ok, message)
+        ok, message = repo.add_lesson(luca, latin, day, 1.0, None, '15:00')
+        expect('add_lesson: altro studente e altro insegnante', ok, message)
+        ok, message = repo.add_lesson(anna, latin, date(2025, 4, 2), 2.0, 'versione', '9:00')
+        expect('add_lesson in un altro mese', ok, message)
+
+        lessons = repo.get_lessons_in_range(date(2025, 3, 1), date(2025, 4, 30))
+        expect('get_lessons_in_range', len(lessons) == 5 and list(lessons.columns) == [
+            'id', 'date', 'start_time', 'studente', 'materia', 'duration', 'costo', 'notes', 'student_id', 'subject_id'],
+               f'{len(lessons)} righe, colonne {list(lessons.columns)}')
+        # Le lezioni senza orario precedono le altre dello stesso giorno
+        times = [row.start_time if isinstance(row.start_time, str) else None for row in lessons.itertuples()]
+        expect('get_lessons_in_range: ordine per data e orario',
+               times == [None, '15:00', '15:00', '16:30', '09:00'], str(times))
+        expect('get_lessons_in_range: costo', sorted(lessons['costo'].tolist()) == [30.0, 30.0, 30.0, 37.5, 50.0],
+               str(sorted(lessons['costo'].tolist())))
+        expect('get_lessons_in_range per studente',
+               len(repo.get_lessons_in_range(date(2025, 3, 1), date(2025, 4, 30), anna)) == 2)
+        expect('get_lessons_in_range: estremi inclusi',
+               len(repo.get_lessons_in_range(day, day)) == 4 and repo.get_lessons_in_range(
+                   date(2025, 3, 11), date(2025, 4, 1)).empty)
+
+        lesson_id = int(lessons[lessons['notes'] == 'derivate']['id'].iloc[0])
+        lesson = repo.get_lesson(lesson_id)
+        expect('get_lesson', lesson is not None and (lesson['date'], lesson['start_time'], lesson['duration'],
+                                                    lesson['notes']) == ('2025-03-10', '15:00', 1.5, 'derivate'),
+               str(lesson))
+        ok, message = repo.update_lesson(lesson_id, anna, math, day, 1.5, 'derivate', '16:00')
+        expect("update_lesson: sovrapposizione per l'insegnante", not ok, message)
+        ok, message = repo.update_lesson(lesson_id, anna, math, day, 1.5, 'derivate e limiti', '15:00')
+        expect('update_lesson ignora la lezione stessa',
+               ok and repo.get_lesson(lesson_id)['notes'] == 'derivate e limiti', message)
+        ok, message = repo.update_lesson(lesson_id, anna, math, date(2025, 3, 12), 2.0, 'integrali', '10:00')
+        expect('update_lesson', ok and repo.get_lesson(lesson_id)['date'] == '2025-03-12', message)
+
+        expected = {
+            'Giornaliero': [('2025-03-10', 3, 3.0), ('2025-03-11', 0, 0.0), ('2025-03-12', 1, 2.0)],
+            'Settimanale': [('2025-03-10', 3, 3.0), ('2025-03-17', 1, 2.0), ('2025-03-24', 0, 0.0),
+                            ('2025-03-31', 0, 0.0), ('2025-04-07', 1, 2.0)],
+            'Mensile': [('2025-03-31', 4, 5.0), ('2025-04-30', 1, 2.0)],
+        }
+        for period, rows in expected.items():
+            totals = repo.get_report_totals(date(2025, 3, 10), date(2025, 4, 30), period)
+            if period == 'Giornaliero':
+                totals = totals.loc[:'2025-03-12']
+            found = [(index.date().isoformat(), int(row.lezioni), float(row.duration))
+                     for index, row in totals.iterrows()]
+            expect(f'get_report_totals {period.lower()}', found == rows, str(found))
+        totals = repo.get_report_totals(date(2025, 3, 1), date(2025, 3, 31), 'Mensile', anna)
+        expect('get_report_totals per studente', totals['costo'].tolist() == [50.0], str(totals['costo'].tolist()))
+
+        # Serie ricorrente di Luca, lunedì e mercoledì alle 17 con un giorno escluso: le ripetizioni
+        # entrano nei conflitti e nei totali del report insieme alle lezioni
+        ok, message = repo.add_series(luca, physics, date(2025, 5, 5), [0, 2], 1.0, None,
+                                      end_date=date(2025, 6, 30), start_time='17:00')
+        expect('add_series', ok, message)
+        # L'archivio parte vuoto: è la serie con id 1
+        repo.add_exception(1, date(2025, 5, 14))
+        ok, message = repo.add_series(anna, math, date(2025, 5, 1), [0], 1.0, None,
+                                      end_date=date(2025, 5, 31), start_time='17:30')
+        expect("add_series: sovrapposizione per l'insegnante",
+               not ok and message == 'Conflitto di orario il 05/05/2025 alle 17:30', message)
+        ok, message = repo.add_lesson(luca, latin, date(2025, 5, 12), 1.0, None, '17:30')
+        expect('add_lesson: sovrapposizione con una serie', not ok and message.startswith('Lo studente')
+               and '12/05/2025 alle 17:00' in message, message)
+        ok, message = repo.add_lesson(luca, latin, date(2025, 5, 14), 1.0, None, '17:00')
+        expect('add_lesson nel giorno escluso dalla serie', ok, message)
+        expected = {
+            'Settimanale': [('2025-05-05', 1, 1.0), ('2025-05-12', 2, 2.0), ('2025-05-19', 1, 1.0)],
+            'Mensile': [('2025-05-31', 8, 8.0), ('2025-06-30', 9, 9.0)],
+        }
+        for period, rows in expected.items():
+            end = date(2025, 5, 18) if period == 'Settimanale' else date(2025, 6, 30)
+            totals = repo.get_report_totals(date(2025, 5, 5), end, period)
+            found = [(index.date().isoformat(), int(row.lezioni), float(row.duration))
+                     for index, row in totals.iterrows()]
+            expect(f'get_report_totals {period.lower()} con una serie', found == rows, str(found))
+        totals = repo.get_report_totals(date(2025, 5, 1), date(2025, 5, 31), 'Mensile', luca)
+        expect('get_report_totals per studente con una serie', totals['costo'].tolist() == [240.0],
+               str(totals['costo'].tolist()))
+
+        # Pagine: ricerca senza distinzione di maiuscole, ordinamento e cursore
+        page, cursor = repo.fetch_page('students', 'Nome', search='ANNA', limit=1)
+        expect('fetch_page con ricerca', page['name'].tolist() == ['Anna Rossi'] and cursor is None,
+               f"{page['name'].tolist()}, {cursor}")
+        page, cursor = repo.fetch_page('lessons', 'Data', limit=2)
+        rest, last = repo.fetch_page('lessons', 'Data', after=cursor, limit=10)
+        expect('fetch_page con cursore', page['date'].tolist() == ['2025-03-10', '2025-03-10'] and len(rest) == 4
+               and rest['date'].tolist()[-1] == '2025-05-14' and last is None,
+               f"{page['date'].tolist()} {rest['date'].tolist()} {last}")
+
+        # Account: quello dello studente è bloccato finché non viene generata una password
+        expect("authenticate_user: account dello studente bloccato",
+               repo.authenticate_user('anna@esempio.it', '!') is None)
+        ok, message = repo.create_teacher('docente@esempio.it', 'segreta', 1)
+        teacher = repo.authenticate_user('docente@esempio.it', 'segreta')
+        expect('create_teacher e authenticate_user', ok and teacher is not None
+               and teacher[1:] == ('insegnante', None, 1), f'{message}, {teacher}')
+        expect('create_teacher rifiuta uno username esistente',
+               repo.create_teacher('docente@esempio.it', 'altra', 1)[0] is False)
+        expect("add_student rifiuta l'email di un account esistente",
+               repo.add_student('Docente', 'docente@esempio.it', 10.0) is False)
+        expect('is_teacher', teacher is not None and repo.is_teacher(teacher[0])
+               and not repo.is_teacher(teacher[0] + 1000))
+
+        with tenant_scope(2):
+            expect('isolamento dei tenant', repo.get_student(anna) is None and repo.get_lesson(lesson_id) is None
+                   and repo.get_lessons_in_range(date(2025, 1, 1), date(2025, 12, 31)).empty
+                   and repo.fetch_page('students', 'ID')[0].empty
+                   and not (teacher and repo.is_teacher(teacher[0])))
+            # Lo stesso insegnante alla stessa ora, ma in un altro tenant: nessun conflitto
+            other = repo.add_student('Anna Verdi', 'verdi@esempio.it', 20.0)
+            expect("add_student: email unica solo nel tenant",
+                   isinstance(repo.add_student('Anna Rossi', 'anna@esempio.it', 20.0), int))
+            other_subject = repo.add_subject('Matematica', 1)
+            ok, message = repo.add_lesson(other, other_subject, day, 1.0, None, '16:30')
+            expect('add_lesson: conflitti verificati nel tenant', ok, message)
+            # Studenti e materie di un altro tenant non possono essere usati
+            expect('add_lesson rifiuta uno studente di un altro tenant',
+                   _rejected(repo.add_lesson, anna, math, date(2025, 5, 5), 1.0, None) == f'Studente inesistente: {anna}')
+        expect('update_lesson rifiuta una materia di un altro tenant',
+               _rejected(repo.update_lesson, lesson_id, anna, other_subject, day, 1.5, None, '15:00')
+               == f'Materia inesistente: {other_subject}')
+
+        ok, message = repo.delete_student(anna)
+        expect('delete_student con lezioni', not ok and message ==
+               'Impossibile eliminare lo studente: ci sono 2 lezioni associate', message)
+        ok, message = repo.delete_subject(math)
+        expect('delete_subject con lezioni', not ok and message ==
+               'Impossibile eliminare la materia: ci sono 1 lezioni associate', message)
+        for lesson in repo.get_lessons_in_range(date(2025, 1, 1), date(2025, 12, 31), anna).itertuples():
+            repo.delete_lesson(int(lesson.id))
+        expect('delete_lesson', repo.get_lesson(lesson_id) is None)
+        expect('delete_student', repo.delete_student(anna) == (True, 'Studente eliminato con successo')
+               and repo.get_student(anna) is None)
+        # L'account dello studente è stato eliminato: lo username è di nuovo libero
+        expect("delete_student elimina l'account", repo.create_teacher('anna@esempio.it', 'segreta', 1)[0])
+        expect('delete_subject', repo.delete_subject(math) == (True, 'Materia eliminata con successo')
+               and repo.get_subject(math) is None)
+    except Exception as e:
+        results.append(('eccezione', f'{type(e).__name__}: {e}'))
+    return results
+
+
+# --- Benchmark ---
+
+def _schedule(rng, count, students, subjects):
+    # Lezioni casuali nei giorni feriali di BENCH_YEAR, dalle 8 alle 20
+    first = date(BENCH_YEAR, 1, 1)
+    days = [first + timedelta(days=i) for i in range(365)]
+    days = [d for d in days if d.weekday() < 5]
+    return [(rng.choice(students), rng.choice(subjects), rng.choice(days),
+             rng.choice((1.0, 1.0, 1.5, 2.0)), None, f'{rng.randint(8, 19):02d}:{rng.choice((0, 30)):02d}')
+            for _ in range(count)]
+
+
+def _stats(samples):
+    return {'median_ms': round(statistics.median(samples), 3), 'min_ms': round(min(samples), 3),
+            'mean_ms': round(statistics.fmean(samples), 3), 'repeats': len(samples)}
+
+
+def bench(repo, lessons=2000, repeats=5, seed=0):
+    # Scritture e letture tramite l'interfaccia; restituisce ({nome: statistiche}, lezioni accettate)
+    rng = random.Random(seed)
+    results = {}
+    students = [repo.add_student(f'Studente {i}', f'studente{i}@bench', rng.choice([15.0, 20.0, 25.0, 30.0]))
+                for i in range(max(lessons // 20, 10))]
+    subjects = [repo.add_subject(f'Materia {i}', i % 3 + 1) for i in range(10)]
+
+    # Inserimenti uno per volta, ciascuno con la verifica dei conflitti
+    accepted = 0
+    samples = []
+    for lesson in _schedule(rng, lessons, students, subjects):
+        started = time.perf_counter()
+        accepted += repo.add_lesson(*lesson)[0]
+        samples.append((time.perf_counter() - started) * 1000)
+    results['add_lesson'] = _stats(samples)
+
+    # Gli stessi inserimenti da più thread: con SQLite si alternano sul lock di scrittura
+    batches = [_schedule(rng, lessons // THREADS // 4, students, subjects) for _ in range(THREADS)]
+    samples = []
+
+    def insert(batch):
+        for lesson in batch:
+            started = time.perf_counter()
+            repo.add_lesson(*lesson)
+            samples.append((time.perf_counter() - started) * 1000)
+
+    threads = [threading.Thread(target=insert, args=(batch,)) for batch in batches]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    results[f'add_lesson_{THREADS}_threads'] = dict(_stats(samples), per_second=round(len(samples) / elapsed, 1))
+
+    ids = repo.get_lessons_in_range(date(BENCH_YEAR, 1, 1), date(BENCH_YEAR, 12, 31))['id'].tolist()
+    sample_ids = rng.sample(ids, min(200, len(ids)))
+    cases = [('get_lesson', lambda: [repo.get_lesson(int(i)) for i in sample_ids]),
+             ('lessons_in_range_year', lambda: repo.get_lessons_in_range(date(BENCH_YEAR, 1, 1),
+                                                                         date(BENCH_YEAR, 12, 31))),
+             ('lessons_in_range_student', lambda: repo.get_lessons_in_range(date(BENCH_YEAR, 1, 1),
+                                                                            date(BENCH_YEAR, 12, 31), students[0]))]
+    for period in ('Giornaliero', 'Settimanale', 'Mensile'):
+        cases.append((f'report_totals_{period.lower()}',
+                      lambda period=period: repo.get_report_totals(date(BENCH_YEAR, 1, 1),
+                                                                   date(BENCH_YEAR, 12, 31), period)))
+    for name, func in cases:
+        samples = []
+        for _ in range(repeats):
+            repo.clear_cache()
+            started = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - started) * 1000)
+        results[name] = _stats(samples)
+    return results, accepted
+
+
+def _run(backends, dsn, action):
+    # Esegue action(archivio) su un archivio vuoto di ogni backend; restituisce {backend: esito}
+    outcome = {}
+    for backend in backends:
+        if backend == 'postgres' and not dsn:
+            with local_postgres() as local_dsn:
+                with empty_repository(backend, local_dsn) as repo:
+                    outcome[backend] = action(repo)
+        else:
+            with empty_repository(backend, dsn) as repo:
+                outcome[backend] = action(repo)
+    return outcome
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verifica e benchmark degli archivi SQLite e PostgreSQL')
+    parser.add_argument('command', choices=['check', 'bench'])
+    parser.add_argument('--backend', choices=storage.BACKENDS, action='append',
+                        help='archivio da provare (ripetibile; predefinito: tutti)')
+    parser.add_argument('--dsn', default=storage.PG_DSN,
+                        help='PostgreSQL esistente (predefinito: PLANNER_PG_DSN, altrimenti istanza locale)')
+    parser.add_argument('--lessons', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file JSON dei risultati del benchmark (predefinito: standard output)')
+    parser.add_argument('--baseline', help='risultati di riferimento con cui confrontare')
+    args = parser.parse_args()
+    backends = args.backend or list(storage.BACKENDS)
+
+    if args.command == 'check':
+        failed = 0
+        for backend, (results, unavailable) in _run(backends, args.dsn,
+                                                    lambda repo: (check(repo), repo.UNAVAILABLE)).items():
+            for name, error in results:
+                failed += error is not None
+                print(f"{backend:<9} {'OK' if error is None else 'ERRORE':<7} {name}"
+                      + (f": {error}" if error else ''))
+            # Limiti noti dell'archivio: segnalati ma non contati come errori
+            for feature in unavailable:
+                print(f"{backend:<9} {'ASSENTE':<7} {feature}")
+        sys.exit(1 if failed else 0)
+
+    outcome = _run(backends, args.dsn, lambda repo: bench(repo, args.lessons, args.repeats, args.seed))
+    report = {'metadata': {'lessons': args.lessons, 'python': platform.python_version(),
+                           'platform': platform.platform(), 'timestamp': datetime.now().isoformat(timespec='seconds'),
+                           'accepted': {backend: accepted for backend, (_, accepted) in outcome.items()}},
+              'results': {f'{backend}.{name}': result
+                          for backend, (results, _) in outcome.items() for name, result in results.items()}}
+    for name, result in report['results'].items():
+        print(f"{name:<40} {result['median_ms']:>10.2f} ms", file=sys.stderr)
+
+    if args.baseline:
+        from benchmark import compare
+        with open(args.baseline) as f:
+            regressions = compare(report['results'], json.load(f))
+        report['regressions'] = [{'name': name, 'baseline_ms': before, 'current_ms': after}
+                                 for name, before, after in regressions]
+        for name, before, after in regressions:
+            print(f"REGRESSIONE {name}: {before:.2f} ms -> {after:.2f} ms", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    sys.exit(1 if report.get('regressions') else 0)
@@ -0,0 +1,182 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import metrics
+import tenancy
+
+# Percorso del database, configurabile tramite variabile d'ambiente o configure()
+DB_PATH = os.environ.get('PLANNER_DB_PATH', 'planner.db')
+
+# Dimensione massima del pool e della cache degli statement preparati per connessione
+POOL_SIZE = int(os.environ.get('PLANNER_DB_POOL_SIZE', '8'))
+STATEMENT_CACHE_SIZE = 256
+
+# Pragma applicati a ogni nuova connessione
+PRAGMAS = {
+    'synchronous': 'NORMAL',       # sicuro in modalità WAL, evita un fsync per commit
+    'cache_size': -20000,          # ~20 MB di page cache per connessione
+    'mmap_size': 268435456,        # 256 MB di I/O memory-mapped
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+
+
+def _open_connection(path):
+    # isolation_level=None: le transazioni sono gestite esplicitamente da transaction().
+    # Con la strumentazione attiva la connessione misura ogni statement (vedi metrics.py).
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                           cached_statements=STATEMENT_CACHE_SIZE, factory=metrics.connection_factory())
+    if path != ':memory:':
+        conn.execute('PRAGMA journal_mode=WAL')
+    for name, value in PRAGMAS.items():
+        conn.execute(f'PRAGMA {name}={value}')
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return _open_connection(self.path)
+                except Exception:
+                    self._opened -= 1
+                    raise
+        # Pool esaurito: attende che un altro thread rilasci una connessione
+        return self._idle.get()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = None
+        self._idle.put_nowait(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+
+# Un pool per file: il database principale e, se attivi, gli shard dei tenant
+_pools = {}
+_migrating = {}
+_pool_lock = threading.RLock()
+_local = threading.local()
+
+
+def configure(path=None, pool_size=None):
+    # Cambia percorso o dimensione del pool; le connessioni esistenti vengono chiuse
+    global DB_PATH, POOL_SIZE
+    with _pool_lock:
+        if path is not None:
+            DB_PATH = path
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+        with _watcher_lock:
+            for watcher in _watchers.values():
+                watcher.close()
+            _watchers.clear()
+
+
+def get_pool():
+    # Pool del database del contesto corrente (vedi tenancy.database_path)
+    path = tenancy.database_path(DB_PATH)
+    pool = _pools.get(path)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(path) or _migrating.get(path)
+            if pool is None:
+                pool = ConnectionPool(path, POOL_SIZE)
+                if path != DB_PATH:
+                    # Primo accesso a uno shard: lo schema viene creato o aggiornato prima di
+                    # rendere il pool visibile agli altri thread
+                    from migrations import migrate
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    _migrating[path] = pool
+                    try:
+                        migrate()
+                    finally:
+                        del _migrating[path]
+                _pools[path] = pool
+    return pool
+
+
+def close_all():
+    configure()
+
+
+# Connessioni dedicate a PRAGMA data_version, una per file: il valore cambia solo quando
+# un'altra connessione (anche di un altro processo) esegue un commit sul database
+_watchers = {}
+_watcher_lock = threading.Lock()
+
+
+def data_version():
+    # Restituisce (percorso, versione) per il database del contesto corrente
+    path = get_pool().path
+    with _watcher_lock:
+        watcher = _watchers.get(path)
+        if watcher is None:
+            watcher = _watchers[path] = _open_connection(path)
+        return path, watcher.execute('PRAGMA data_version').fetchone()[0]
+
+
+@contextmanager
+def get_connection():
+    # Connessione del thread corrente: le chiamate annidate sullo stesso database riusano la stessa connessione
+    pool = get_pool()
+    connections = _local.__dict__.setdefault('connections', {})
+    conn = connections.get(pool.path)
+    if conn is not None:
+        yield conn
+        return
+
+    conn = pool.acquire()
+    connections[pool.path] = conn
+    try:
+        yield conn
+    finally:
+        del connections[pool.path]
+        pool.release(conn)
+
+
+@contextmanager
+def transaction():
+    # Transazione di scrittura: commit all'uscita, rollback in caso di eccezione.
+    # Le transazioni annidate confluiscono in quella più esterna.
+    with get_connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
@@ -1,216 +1,299 @@
 import sqlite3
 
+import calendar_data
+import query_cache
+from auth import LOCKED_PASSWORD, dummy_verify, generate_password, hash_password, login_throttle, verify_password
+from conflicts import describe, find_conflicts, format_time
+from connection import get_connection, transaction
+from migrations import migrate
+from tenancy import current_tenant, directory
+
 def init_db():
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
-    
-    # Tabella Utenti
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-              (id INTEGER PRIMARY KEY AUTOINCREMENT,
-              username TEXT UNIQUE NOT NULL,
-              password TEXT NOT NULL,
-              role TEXT NOT NULL)''')
-    
-    # Tabella Studenti
-    c.execute('''CREATE TABLE IF NOT EXISTS students
-              (id INTEGER PRIMARY KEY AUTOINCREMENT,
-              name TEXT NOT NULL,
-              email TEXT UNIQUE NOT NULL,
-              hourly_cost REAL NOT NULL)''')
-    
-    # Tabella Materie
-    c.execute('''CREATE TABLE IF NOT EXISTS subjects
-              (id INTEGER PRIMARY KEY AUTOINCREMENT,
-              name TEXT NOT NULL,
-              teacher_id INTEGER NOT NULL,
-              FOREIGN KEY(teacher_id) REFERENCES users(id))''')
-    
-    # Tabella Lezioni
-    c.execute('''CREATE TABLE IF NOT EXISTS lessons
-              (id INTEGER PRIMARY KEY AUTOINCREMENT,
-              student_id INTEGER NOT NULL,
-              subject_id INTEGER NOT NULL,
-              date DATE NOT NULL,
-              duration REAL NOT NULL,
-              notes TEXT,
-              FOREIGN KEY(student_id) REFERENCES students(id),
-              FOREIGN KEY(subject_id) REFERENCES subjects(id))''')
+    # Crea o aggiorna lo schema tramite le migrazioni versionate (gli shard dei tenant
+    # vengono aggiornati al primo accesso)
+    with directory():
+        migrate()
     
-    # Inserimento utente admin di default
-    try:
-        c.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                ('admin', 'admin', 'insegnante'))
-    except sqlite3.IntegrityError:
-        pass
-    
-    conn.commit()
-    conn.close()
+    # Inserimento utente admin di default (tenant 1)
+    with directory(), transaction() as conn:
+        if conn.execute("SELECT 1 FROM users WHERE username='admin' AND tenant_id=1").fetchone() is None:
+            conn.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                         ('admin', hash_password('admin'), 'insegnante'))
 
 
 def authenticate_user(username, password):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM users WHERE username=? AND password=?', (username, password))
-    user = c.fetchone()
-    conn.close()
-    return user
+    # Restituisce (id, ruolo, id dello studente collegato, tenant) con una sola query, oppure None.
+    # Gli utenti bloccati per troppi tentativi vengono respinti prima di calcolare l'hash.
+    # Lo username è unico solo nel tenant: vale il primo account la cui password corrisponde.
+    if login_throttle.retry_after(username):
+        return None
+    with directory(), get_connection() as conn:
+        users = conn.execute('SELECT id, role, student_id, tenant_id, password FROM users WHERE username=? '
+                             'ORDER BY id', (username,)).fetchall()
+    if not users:
+        dummy_verify(password)
+        login_throttle.failure(username)
+        return None
+
+    for user_id, role, student_id, tenant_id, stored in users:
+        valid, needs_update = verify_password(password, stored)
+        if valid:
+            break
+    else:
+        login_throttle.failure(username)
+        return None
+    login_throttle.success(username)
+    if needs_update:
+        with directory(), transaction() as conn:
+            conn.execute('UPDATE users SET password=? WHERE id=?', (hash_password(password), user_id))
+    return user_id, role, student_id, tenant_id
+
+
+def create_teacher(username, password, tenant_id=None):
+    # Nuovo account insegnante; senza tenant_id viene creato un nuovo tenant
+    try:
+        with directory(), transaction() as conn:
+            if tenant_id is None:
+                tenant_id = conn.execute('SELECT COALESCE(MAX(tenant_id), 0) + 1 FROM users').fetchone()[0]
+            conn.execute("INSERT INTO users (username, password, role, tenant_id) VALUES (?, ?, 'insegnante', ?)",
+                         (username, hash_password(password), tenant_id))
+        query_cache.invalidate('users')
+        return True, f"Insegnante {username} creato nel tenant {tenant_id}"
+    except sqlite3.IntegrityError:
+        return False, "Username già esistente"
 
 
 def get_user_role(username):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
-    c.execute('SELECT role FROM users WHERE username=?', (username,))
-    role = c.fetchone()
-    conn.close()
+    with directory(), get_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT role FROM users WHERE username=? AND tenant_id=?', (username, current_tenant()))
+        role = c.fetchone()
     return role[0] if role else None
 
 
+def get_user_id(username):
+    with directory(), get_connection() as conn:
+        c = conn.cursor()
+        c.execute('SELECT id FROM users WHERE username=? AND tenant_id=?', (username, current_tenant()))
+        user = c.fetchone()
+    return user[0] if user else None
+
+
+def is_teacher(user_id):
+    # Vero se user_id è un insegnante del tenant corrente
+    with directory(), get_connection() as conn:
+        return conn.execute("SELECT 1 FROM users WHERE id=? AND tenant_id=? AND role='insegnante'",
+                            (user_id, current_tenant())).fetchone() is not None
+
+
+def provision_accounts(students):
+    # Account di accesso per gli studenti indicati come (id, email): username = email,
+    # password bloccata finché l'insegnante non ne genera una. Un account già esistente con
+    # la stessa email viene collegato invece che duplicato. Senza shard la scrittura confluisce
+    # nella transazione del chiamante; con gli shard avviene sul database principale.
+    # Restituisce gli studenti (id, email) per cui lo username è già usato da un altro account del tenant.
+    tenant = current_tenant()
+    failed = []
+    with directory(), transaction() as conn:
+        conn.executemany('''UPDATE users SET student_id = ?
+                            WHERE username = ? AND tenant_id = ? AND student_id IS NULL
+                              AND role != 'insegnante' ''',
+                         [(student_id, email, tenant) for student_id, email in students])
+        for student_id, email in students:
+            try:
+                conn.execute('''INSERT INTO users (username, password, role, student_id, tenant_id)
+                                SELECT ?, ?, 'studente', ?, ?
+                                WHERE NOT EXISTS (SELECT 1 FROM users WHERE tenant_id = ? AND student_id = ?)''',
+                             (email, LOCKED_PASSWORD, student_id, tenant, tenant, student_id))
+            except sqlite3.IntegrityError:
+                failed.append((student_id, email))
+    return failed
+
+
 def add_student(name, email, hourly_cost):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
+    # Restituisce l'id del nuovo studente, o False se l'email è già registrata nel tenant
     try:
-        c.execute('INSERT INTO students (name, email, hourly_cost) VALUES (?, ?, ?)',
-                (name, email, hourly_cost))
-        conn.commit()
-        return True
+        with transaction() as conn:
+            student_id = conn.execute('INSERT INTO students (name, email, hourly_cost, tenant_id) VALUES (?, ?, ?, ?)',
+                    (name, email, hourly_cost, current_tenant())).lastrowid
+            if provision_accounts([(student_id, email)]):
+                # Username già usato da un altro account del tenant: lo studente non viene creato
+                raise sqlite3.IntegrityError(f"Username già esistente: {email}")
+        query_cache.invalidate('students', 'users')
+        return student_id
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
+
+
+def reset_student_password(student_id):
+    # Genera una nuova password per l'account dello studente; restituisce (username, password)
+    student = get_student(student_id)
+    if student is None:
+        return None, None
+    if provision_accounts([(student_id, student['email'])]):
+        return None, None
+    password = generate_password()
+    with directory(), transaction() as conn:
+        conn.execute('UPDATE users SET password=? WHERE tenant_id=? AND student_id=?',
+                     (hash_password(password), current_tenant(), student_id))
+        username = conn.execute('SELECT username FROM users WHERE tenant_id=? AND student_id=?',
+                                (current_tenant(), student_id)).fetchone()
+    query_cache.invalidate('users')
+    return (username[0], password) if username else (None, None)
 
 
 def add_subject(name, teacher_id):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO subjects (name, teacher_id) VALUES (?, ?)',
-            (name, teacher_id))
-    conn.commit()
-    conn.close()
+    # Restituisce l'id della nuova materia
+    with transaction() as conn:
+        subject_id = conn.execute('INSERT INTO subjects (name, teacher_id, tenant_id) VALUES (?, ?, ?)',
+                (name, teacher_id, current_tenant())).lastrowid
+    query_cache.invalidate('subjects')
+    return subject_id
+
+
+def check_references(conn, student_id, subject_id):
+    # Studente e materia devono appartenere al tenant corrente, come in bulk_import
+    tenant = current_tenant()
+    if conn.execute('SELECT 1 FROM students WHERE id=? AND tenant_id=?', (int(student_id), tenant)).fetchone() is None:
+        raise ValueError(f"Studente inesistente: {student_id}")
+    if conn.execute('SELECT 1 FROM subjects WHERE id=? AND tenant_id=?', (int(subject_id), tenant)).fetchone() is None:
+        raise ValueError(f"Materia inesistente: {subject_id}")
+
+
+def add_lesson(student_id, subject_id, date, duration, notes, start_time=None):
+    start_time = format_time(start_time)
+    with transaction() as conn:
+        check_references(conn, student_id, subject_id)
+        # Verifica sovrapposizioni per lo studente e per l'insegnante della materia
+        conflicts = find_conflicts(conn, student_id, subject_id, date, start_time, duration)
+        if conflicts:
+            return False, describe(conflicts[0])
+        
+        conn.execute('''INSERT INTO lessons (student_id, subject_id, date, start_time, duration, notes, tenant_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (student_id, subject_id, date, start_time, duration, notes, current_tenant()))
+    query_cache.invalidate('lessons')
+    calendar_data.invalidate(date)
+    return True, "Lezione programmata con successo!"
 
 
-def add_lesson(student_id, subject_id, date, duration, notes):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO lessons (student_id, subject_id, date, duration, notes) VALUES (?, ?, ?, ?, ?)',
-            (student_id, subject_id, date, duration, notes))
-    conn.commit()
-    conn.close()
+def _lesson_date(conn, lesson_id):
+    row = conn.execute('SELECT date FROM lessons WHERE id=? AND tenant_id=?', (lesson_id, current_tenant())).fetchone()
+    return row[0] if row else None
 
 
 def get_student(student_id):
-    conn = sqlite3.connect('planner.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM students WHERE id=?', (student_id,))
-    student = c.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute('SELECT * FROM students WHERE id=? AND tenant_id=?', (student_id, current_tenant()))
+        student = c.fetchone()
     return dict(student) if student else None
 
 
 def update_student(student_id, name, email, hourly_cost):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
     try:
-        c.execute('UPDATE students SET name=?, email=?, hourly_cost=? WHERE id=?',
-                (name, email, hourly_cost, student_id))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute('UPDATE students SET name=?, email=?, hourly_cost=? WHERE id=? AND tenant_id=?',
+                    (name, email, hourly_cost, student_id, current_tenant()))
+        query_cache.invalidate('students')
+        # Il costo orario incide sui costi di tutti i mesi
+        calendar_data.invalidate()
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 
 def delete_student(student_id):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
-    
-    # Verifica se lo studente ha lezioni associate
-    c.execute('SELECT COUNT(*) FROM lessons WHERE student_id=?', (student_id,))
-    count = c.fetchone()[0]
-    
-    if count > 0:
-        conn.close()
-        return False, f"Impossibile eliminare lo studente: ci sono {count} lezioni associate"
-    
-    # Elimina lo studente se non ha lezioni associate
-    c.execute('DELETE FROM students WHERE id=?', (student_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        
+        # Verifica se lo studente ha lezioni associate
+        c.execute('SELECT COUNT(*) FROM lessons WHERE student_id=? AND tenant_id=?', (student_id, current_tenant()))
+        count = c.fetchone()[0]
+        
+        if count > 0:
+            return False, f"Impossibile eliminare lo studente: ci sono {count} lezioni associate"
+        
+        # Elimina lo studente se non ha lezioni associate, insieme al suo account
+        if c.execute('DELETE FROM students WHERE id=? AND tenant_id=?', (student_id, current_tenant())).rowcount:
+            with directory(), transaction() as users:
+                users.execute('DELETE FROM users WHERE tenant_id=? AND student_id=?', (current_tenant(), student_id))
+    query_cache.invalidate('students', 'users')
     return True, "Studente eliminato con successo"
 
 
 def get_subject(subject_id):
-    conn = sqlite3.connect('planner.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM subjects WHERE id=?', (subject_id,))
-    subject = c.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute('SELECT * FROM subjects WHERE id=? AND tenant_id=?', (subject_id, current_tenant()))
+        subject = c.fetchone()
     return dict(subject) if subject else None
 
 
 def update_subject(subject_id, name, teacher_id):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
     try:
-        c.execute('UPDATE subjects SET name=?, teacher_id=? WHERE id=?',
-                (name, teacher_id, subject_id))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute('UPDATE subjects SET name=?, teacher_id=? WHERE id=? AND tenant_id=?',
+                    (name, teacher_id, subject_id, current_tenant()))
+        query_cache.invalidate('subjects')
         return True
     except sqlite3.Error:
         return False
-    finally:
-        conn.close()
 
 
 def delete_subject(subject_id):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
-    
-    # Verifica se la materia ha lezioni associate
-    c.execute('SELECT COUNT(*) FROM lessons WHERE subject_id=?', (subject_id,))
-    count = c.fetchone()[0]
-    
-    if count > 0:
-        conn.close()
-        return False, f"Impossibile eliminare la materia: ci sono {count} lezioni associate"
-    
-    # Elimina la materia se non ha lezioni associate
-    c.execute('DELETE FROM subjects WHERE id=?', (subject_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        
+        # Verifica se la materia ha lezioni associate
+        c.execute('SELECT COUNT(*) FROM lessons WHERE subject_id=? AND tenant_id=?', (subject_id, current_tenant()))
+        count = c.fetchone()[0]
+        
+        if count > 0:
+            return False, f"Impossibile eliminare la materia: ci sono {count} lezioni associate"
+        
+        # Elimina la materia se non ha lezioni associate
+        c.execute('DELETE FROM subjects WHERE id=? AND tenant_id=?', (subject_id, current_tenant()))
+    query_cache.invalidate('subjects')
     return True, "Materia eliminata con successo"
 
 
 def get_lesson(lesson_id):
-    conn = sqlite3.connect('planner.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM lessons WHERE id=?', (lesson_id,))
-    lesson = c.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        c.execute('SELECT * FROM lessons WHERE id=? AND tenant_id=?', (lesson_id, current_tenant()))
+        lesson = c.fetchone()
     return dict(lesson) if lesson else None
 
 
-def update_lesson(lesson_id, student_id, subject_id, date, duration, notes):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
+def update_lesson(lesson_id, student_id, subject_id, date, duration, notes, start_time=None):
+    start_time = format_time(start_time)
     try:
-        c.execute('UPDATE lessons SET student_id=?, subject_id=?, date=?, duration=?, notes=? WHERE id=?',
-                (student_id, subject_id, date, duration, notes, lesson_id))
-        conn.commit()
-        return True
+        with transaction() as conn:
+            check_references(conn, student_id, subject_id)
+            conflicts = find_conflicts(conn, student_id, subject_id, date, start_time, duration,
+                                       exclude_lesson_id=lesson_id)
+            if conflicts:
+                return False, describe(conflicts[0])
+            
+            old_date = _lesson_date(conn, lesson_id)
+            conn.execute('''UPDATE lessons SET student_id=?, subject_id=?, date=?, start_time=?, duration=?, notes=?
+                            WHERE id=? AND tenant_id=?''',
+                    (student_id, subject_id, date, start_time, duration, notes, lesson_id, current_tenant()))
+        query_cache.invalidate('lessons')
+        calendar_data.invalidate(old_date, date)
+        return True, "Lezione aggiornata con successo"
     except sqlite3.Error:
-        return False
-    finally:
-        conn.close()
+        return False, "Errore durante l'aggiornamento della lezione"
 
 
 def delete_lesson(lesson_id):
-    conn = sqlite3.connect('planner.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM lessons WHERE id=?', (lesson_id,))
-    conn.commit()
-    conn.close()
-    return True, "Lezione eliminata con successo"
\ No newline at end of file
+    with transaction() as conn:
+        old_date = _lesson_date(conn, lesson_id)
+        conn.execute('DELETE FROM lessons WHERE id=? AND tenant_id=?', (lesson_id, current_tenant()))
+    query_cache.invalidate('lessons')
+    calendar_data.invalidate(old_date)
+    return True, "Lezione eliminata con successo"
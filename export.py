@@ -0,0 +1,155 @@
+import csv
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+import uuid
+
+import query_cache
+from connection import get_connection
+from reports import date_bounds
+from tenancy import current_tenant
+
+# Directory dei file esportati, riutilizzati finché i dati non cambiano
+EXPORT_DIR = os.environ.get('PLANNER_EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'planner_exports'))
+FETCH_SIZE = 2000
+
+FORMATS = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+HEADERS = ['id', 'date', 'start_time', 'studente', 'materia', 'duration', 'costo', 'notes', 'student_id', 'subject_id']
+
+_TABLES = ('lessons', 'students', 'subjects')
+
+# Le generazioni delle tabelle ripartono da zero a ogni avvio: il token distingue i file
+# prodotti da un processo precedente, che non vanno riutilizzati
+_PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+
+def _query(start, end, student_id):
+    query = '''
+        SELECT lessons.id, lessons.date, lessons.start_time, students.name, subjects.name,
+               duration, (duration * students.hourly_cost), notes,
+               lessons.student_id, lessons.subject_id
+        FROM lessons
+        JOIN students ON lessons.student_id = students.id
+        JOIN subjects ON lessons.subject_id = subjects.id
+        WHERE lessons.tenant_id = ? AND lessons.date >= ? AND lessons.date < ?
+    '''
+    params = [current_tenant(), *date_bounds(start, end)]
+    if student_id is not None:
+        query += ' AND lessons.student_id = ?'
+        params.append(int(student_id))
+    return query + ' ORDER BY lessons.date, lessons.start_time, lessons.id', params
+
+
+class _Counting:
+    # Cursore che segnala l'avanzamento a ogni blocco letto: progress(righe lette, totale)
+    def __init__(self, cursor, total, progress):
+        self.cursor = cursor
+        self.total = total
+        self.progress = progress
+        self.done = 0
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        self.done += len(rows)
+        self.progress(self.done, self.total)
+        return rows
+
+
+def _batches(cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        yield rows
+
+
+def _write_xlsx(cursor, path):
+    import xlsxwriter
+
+    # constant_memory scrive ogni riga su disco appena completata
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    sheet = workbook.add_worksheet()
+    sheet.write_row(0, 0, HEADERS)
+    row_number = 1
+    for rows in _batches(cursor):
+        for row in rows:
+            sheet.write_row(row_number, 0, row)
+            row_number += 1
+    workbook.close()
+
+
+def _write_csv(cursor, path):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADERS)
+        for rows in _batches(cursor):
+            writer.writerows(rows)
+
+
+def _write_parquet(cursor, path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Per esportare in Parquet è necessario installare pyarrow")
+
+    schema = pa.schema([
+        ('id', pa.int64()), ('date', pa.string()), ('start_time', pa.string()),
+        ('studente', pa.string()), ('materia', pa.string()),
+        ('duration', pa.float64()), ('costo', pa.float64()), ('notes', pa.string()),
+        ('student_id', pa.int64()), ('subject_id', pa.int64()),
+    ])
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in _batches(cursor):
+            columns = list(zip(*rows))
+            writer.write_batch(pa.record_batch([pa.array(c, type=f.type) for c, f in zip(columns, schema)],
+                                               schema=schema))
+
+
+_WRITERS = {'xlsx': _write_xlsx, 'csv': _write_csv, 'parquet': _write_parquet}
+
+
+def export_lessons(start, end, student_id=None, fmt='xlsx', export_dir=EXPORT_DIR, progress=None):
+    # Esporta le lezioni del periodo leggendo il cursore a blocchi, senza costruire un DataFrame.
+    # Il file è identificato dai parametri del filtro e dalla generazione delle tabelle:
+    # finché i dati non cambiano, la stessa richiesta restituisce il file già prodotto.
+    if fmt not in _WRITERS:
+        raise ValueError(f"Formato non supportato: {fmt}")
+    os.makedirs(export_dir, exist_ok=True)
+
+    filters = hashlib.sha1(repr((current_tenant(), str(start), str(end), student_id)).encode()).hexdigest()[:16]
+    generations = _PROCESS_TOKEN + '-' + '-'.join(str(query_cache.generation(t)) for t in _TABLES)
+    path = os.path.join(export_dir, f'lezioni_{filters}_{generations}.{fmt}')
+    if os.path.exists(path):
+        return path
+
+    # Le esportazioni dello stesso filtro basate su dati ormai modificati vengono rimosse
+    for old in glob.glob(os.path.join(export_dir, f'lezioni_{filters}_*.{fmt}')):
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+    query, params = _query(start, end, student_id)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with get_connection() as conn:
+        total = conn.execute(f'SELECT COUNT(*) FROM ({query})', params).fetchone()[0] if progress else None
+        cursor = conn.execute(query, params)
+        try:
+            _WRITERS[fmt](_Counting(cursor, total, progress) if progress else cursor, tmp_path)
+        except BaseException:
+            # Esportazione interrotta (errore o annullamento): il cursore va chiuso prima di
+            # restituire la connessione al pool, e il file parziale non va lasciato
+            cursor.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+    return path
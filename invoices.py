@@ -0,0 +1,244 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+
+from connection import get_connection, transaction
+from reports import date_bounds, month_bounds
+from tenancy import DEFAULT_TENANT, current_tenant
+
+INVOICE_DIR = os.environ.get('PLANNER_INVOICE_DIR', 'invoices')
+
+# Sotto questa soglia le fatture vengono generate nel processo corrente:
+# avviare il pool costerebbe più del rendering
+PARALLEL_THRESHOLD = 50
+RECORD_BATCH = 200
+
+InvoiceResult = namedtuple('InvoiceResult', ['created', 'skipped', 'paths', 'zip_path'])
+
+# Dati necessari al rendering, passati ai processi del pool
+Invoice = namedtuple('Invoice', ['student_id', 'number', 'student', 'email', 'hourly_cost',
+                                 'period_start', 'period_end', 'lines', 'total', 'checksum', 'path'])
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def invoice_number(student_id, period_start):
+    # Con gli shard gli id degli studenti si ripetono tra tenant: il prefisso del tenant
+    # mantiene distinti numeri e file delle fatture
+    number = f'{period_start:%Y%m}-{student_id:05d}'
+    tenant = current_tenant()
+    return number if tenant == DEFAULT_TENANT else f'{tenant}-{number}'
+
+
+def _collect(start, end, student_ids=None):
+    # Una sola lettura ordinata delle lezioni del periodo, raggruppata per studente
+    query = '''
+        SELECT students.id, students.name, students.email, students.hourly_cost,
+               lessons.date, lessons.start_time, subjects.name, lessons.duration,
+               lessons.duration * students.hourly_cost
+        FROM lessons
+        JOIN students ON lessons.student_id = students.id
+        JOIN subjects ON lessons.subject_id = subjects.id
+        WHERE lessons.tenant_id = ? AND lessons.date >= ? AND lessons.date < ?
+    '''
+    params = [current_tenant(), *date_bounds(start, end)]
+    if student_ids is not None:
+        query += f" AND lessons.student_id IN ({','.join('?' * len(student_ids))})"
+        params.extend(int(s) for s in student_ids)
+    query += ' ORDER BY students.id, lessons.date, lessons.start_time, lessons.id'
+
+    students = {}
+    with get_connection() as conn:
+        for student_id, name, email, hourly_cost, day, start_time, subject, duration, cost in conn.execute(query, params):
+            students.setdefault(student_id, ((name, email, hourly_cost), []))[1].append(
+                (day[:10], start_time or '', subject, duration, cost))
+    return students
+
+
+def _invoices(start, end, output_dir, student_ids=None):
+    for student_id, ((name, email, hourly_cost), lines) in _collect(start, end, student_ids).items():
+        number = invoice_number(student_id, start)
+        total = round(sum(line[4] for line in lines), 2)
+        checksum = hashlib.sha1(repr((name, email, hourly_cost, lines)).encode()).hexdigest()
+        yield Invoice(student_id, number, name, email, hourly_cost, start.isoformat(), end.isoformat(),
+                      lines, total, checksum, os.path.join(output_dir, f'fattura_{number}.pdf'))
+
+
+# --- PDF minimale (solo testo, font standard Helvetica) ---
+
+_PAGE_WIDTH, _PAGE_HEIGHT = 595, 842
+_LINES_PER_PAGE = 40
+
+
+def _pdf_text(text):
+    # WinAnsiEncoding corrisponde a cp1252, che comprende lettere accentate e simbolo dell'euro
+    encoded = str(text).encode('cp1252', errors='replace')
+    return b'(' + encoded.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def _pdf(pages):
+    # pages: lista di pagine, ognuna lista di (x, y, font, dimensione, testo)
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>']
+    kids = []
+    for items in pages:
+        stream = b''.join(b'BT /F%d %d Tf %d %d Td %s Tj ET\n' % (font, size, x, y, _pdf_text(text))
+                          for x, y, font, size, text in items)
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+                       b'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>'
+                       % (_PAGE_WIDTH, _PAGE_HEIGHT, len(objects)))
+        kids.append(len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % k for k in kids), len(kids))
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _format_date(iso):
+    return datetime.strptime(iso, '%Y-%m-%d').strftime('%d/%m/%Y')
+
+
+def _layout(invoice):
+    header = [
+        (50, 790, 2, 16, f'Fattura N. {invoice.number}'),
+        (50, 765, 1, 10, f'Periodo: {_format_date(invoice.period_start)} - {_format_date(invoice.period_end)}'),
+        (50, 750, 1, 10, f'Studente: {invoice.student}'),
+        (50, 735, 1, 10, f'Email: {invoice.email}'),
+        (50, 720, 1, 10, f'Costo orario: € {invoice.hourly_cost:.2f}'),
+    ]
+    columns = [(50, 'Data'), (130, 'Ora'), (180, 'Materia'), (420, 'Ore'), (480, 'Importo')]
+
+    pages = []
+    for first in range(0, max(len(invoice.lines), 1), _LINES_PER_PAGE):
+        items = list(header) + [(x, 690, 2, 10, title) for x, title in columns]
+        y = 672
+        for day, start_time, subject, duration, cost in invoice.lines[first:first + _LINES_PER_PAGE]:
+            items += [(50, y, 1, 10, _format_date(day)), (130, y, 1, 10, start_time),
+                      (180, y, 1, 10, subject[:40]), (420, y, 1, 10, f'{duration:g}'),
+                      (480, y, 1, 10, f'€ {cost:.2f}')]
+            y -= 15
+        pages.append(items)
+    hours = sum(line[3] for line in invoice.lines)
+    pages[-1] += [(330, y - 15, 2, 11, f'Totale: {hours:g} ore'), (480, y - 15, 2, 11, f'€ {invoice.total:.2f}')]
+    return pages
+
+
+def render(invoice):
+    # Eseguita nei processi del pool: scrive il PDF su un file temporaneo e lo rinomina,
+    # così un'interruzione non lascia fatture incomplete
+    tmp_path = f'{invoice.path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_pdf(_layout(invoice)))
+    os.replace(tmp_path, invoice.path)
+    return invoice
+
+
+def _record(done):
+    with transaction() as conn:
+        conn.executemany('''INSERT OR REPLACE INTO invoices
+                            (student_id, period_start, period_end, number, total, checksum, path)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         [(i.student_id, i.period_start, i.period_end, i.number, i.total, i.checksum, i.path)
+                          for i in done])
+
+
+def generate_invoices(start, end, student_ids=None, output_dir=INVOICE_DIR, workers=None, zip_path=None,
+                      progress=None):
+    # Genera le fatture del periodo, una per studente con lezioni.
+    # Idempotente: le fatture già registrate con gli stessi dati (checksum) e ancora presenti su
+    # disco vengono saltate, quindi un'esecuzione interrotta può essere ripresa rilanciandola.
+    start, end = _to_date(start), _to_date(end)
+    os.makedirs(output_dir, exist_ok=True)
+    with get_connection() as conn:
+        existing = dict(conn.execute(
+            '''SELECT invoices.student_id, checksum FROM invoices
+               JOIN students ON invoices.student_id = students.id
+               WHERE students.tenant_id = ? AND period_start = ? AND period_end = ?''',
+            (current_tenant(), start.isoformat(), end.isoformat())))
+
+    paths = []
+    pending = []
+    for invoice in _invoices(start, end, output_dir, student_ids):
+        paths.append(invoice.path)
+        if existing.get(invoice.student_id) != invoice.checksum or not os.path.exists(invoice.path):
+            pending.append(invoice)
+    skipped = len(paths) - len(pending)
+
+    done = []
+    unrecorded = []
+
+    def completed(invoice):
+        done.append(invoice)
+        unrecorded.append(invoice)
+        # Registrazione a blocchi: una ripresa non rigenera le fatture già scritte
+        if len(unrecorded) >= RECORD_BATCH:
+            _record(unrecorded)
+            unrecorded.clear()
+        if progress:
+            progress(len(done), len(pending))
+
+    if len(pending) < PARALLEL_THRESHOLD or workers == 1:
+        for invoice in pending:
+            completed(render(invoice))
+    else:
+        # spawn: i processi figli non ereditano connessioni e thread del processo principale
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for future in as_completed([pool.submit(render, invoice) for invoice in pending]):
+                completed(future.result())
+    if unrecorded:
+        _record(unrecorded)
+
+    if zip_path is not None:
+        tmp_zip = f'{zip_path}.{os.getpid()}.tmp'
+        with zipfile.ZipFile(tmp_zip, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for path in paths:
+                archive.write(path, os.path.basename(path))
+        os.replace(tmp_zip, zip_path)
+    return InvoiceResult(len(done), skipped, paths, zip_path)
+
+
+def generate_month(day, **kwargs):
+    first, last = month_bounds(_to_date(day))
+    return generate_invoices(first, last, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generazione delle fatture per studente')
+    parser.add_argument('month', help='mese da fatturare (AAAA-MM)')
+    parser.add_argument('--output-dir', default=INVOICE_DIR)
+    parser.add_argument('--workers', type=int, help='processi di rendering (predefinito: numero di CPU)')
+    parser.add_argument('--zip', help='crea anche un archivio zip con tutte le fatture')
+    args = parser.parse_args()
+
+    from database import init_db
+    init_db()
+
+    result = generate_month(f'{args.month}-01', output_dir=args.output_dir, workers=args.workers,
+                            zip_path=args.zip,
+                            progress=lambda n, total: print(f"\r{n}/{total} fatture", end='', flush=True))
+    print()
+    print(f"Fatture generate: {result.created}, già aggiornate: {result.skipped}")
+    if result.zip_path:
+        print(f"Archivio: {result.zip_path}")
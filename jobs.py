@@ -0,0 +1,327 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from connection import get_connection, get_pool, transaction
+from tenancy import current_tenant, directory, tenant_scope
+
+# Attività lunghe (esportazioni, fatture, report su periodi lunghi, importazioni) eseguite in
+# un pool di thread fuori dallo script Streamlit. Lo stato è nella tabella jobs del database
+# principale (migrazione 12), così l'interfaccia può interrogarlo da qualsiasi sessione;
+# i risultati sono file in JOB_DIR, rimossi da cleanup() dopo RESULT_TTL_HOURS.
+JOB_DIR = os.environ.get('PLANNER_JOB_DIR', os.path.join(tempfile.gettempdir(), 'planner_jobs'))
+WORKERS = int(os.environ.get('PLANNER_JOB_WORKERS', '2'))
+RESULT_TTL_HOURS = float(os.environ.get('PLANNER_JOB_TTL_HOURS', '24'))
+
+# Intervallo minimo (secondi) tra due aggiornamenti dell'avanzamento nel database
+PROGRESS_INTERVAL = 0.5
+CLEANUP_INTERVAL = 600
+
+ACTIVE = ('queued', 'running')
+STATUSES = {'queued': 'In coda', 'running': 'In corso', 'done': 'Completata',
+            'failed': 'Non riuscita', 'cancelled': 'Annullata'}
+
+Job = namedtuple('Job', ['id', 'kind', 'status', 'progress', 'message', 'result_path', 'created_at',
+                         'finished_at'])
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# --- Tipi di attività: handler(params, workdir, progress) -> (percorso del risultato, messaggio) ---
+# progress(frazione, messaggio) aggiorna lo stato e solleva JobCancelled se è stato chiesto
+# l'annullamento; frazione None indica un avanzamento di cui non si conosce il totale.
+
+def _export(params, workdir, progress):
+    from export import export_lessons
+
+    path = export_lessons(params['start'], params['end'], params.get('student_id'), params['fmt'],
+                          export_dir=workdir,
+                          progress=lambda n, total: progress(n / total if total else 1.0, f"{n}/{total} righe"))
+    return path, 'Esportazione pronta'
+
+
+def _report(params, workdir, progress):
+    from reports import get_report_totals
+
+    progress(None, 'Calcolo dei totali')
+    grouped = get_report_totals(params['start'], params['end'], params['period'], params.get('student_id'))
+    path = os.path.join(workdir, 'report.pkl')
+    grouped.to_pickle(path)
+    return path, f"totali di {len(grouped)} periodi"
+
+
+def _invoices(params, workdir, progress):
+    from invoices import generate_month
+
+    zip_path = os.path.join(workdir, f"fatture_{params['month']}.zip")
+    result = generate_month(f"{params['month']}-01", zip_path=zip_path,
+                            progress=lambda n, total: progress(n / total, f"{n}/{total} fatture"))
+    return result.zip_path, f"Fatture generate: {result.created}, già aggiornate: {result.skipped}"
+
+
+def _import(params, workdir, progress):
+    from bulk_import import import_file
+
+    upload = _upload_path(workdir, params['filename'])
+    result = import_file(params['kind'], upload, filename=params['filename'], teacher_id=params['teacher_id'],
+                         progress=lambda n, e: progress(None, f"{n} righe importate, {e} errori"))
+    os.remove(upload)
+    path = os.path.join(workdir, 'import.pkl')
+    with open(path, 'wb') as f:
+        pickle.dump(result, f)
+    return path, f"Importate {result.inserted} righe"
+
+
+# Tipo -> (handler, risultato riutilizzabile finché i dati non cambiano)
+KINDS = {
+    'export': (_export, True),
+    'report': (_report, True),
+    'invoices': (_invoices, True),
+    'import': (_import, False),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_last_cleanup = 0.0
+
+
+def _workdir(job_id):
+    return os.path.join(JOB_DIR, f'job_{job_id}')
+
+
+def _upload_path(workdir, filename):
+    return os.path.join(workdir, 'upload_' + os.path.basename(filename))
+
+
+def fingerprint():
+    # Ultima voce del giornale delle modifiche: cambia a ogni scrittura su studenti, materie,
+    # lezioni e serie, anche da altri processi, e sopravvive ai riavvii
+    with get_connection() as conn:
+        return conn.execute('SELECT id, ts FROM journal ORDER BY id DESC LIMIT 1').fetchone()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _recover():
+    # Attività rimaste in coda o in corso in un processo terminato (o in una precedente
+    # esecuzione di questo processo) non verranno mai completate
+    with directory(), transaction() as conn:
+        stale = [job_id for job_id, pid in conn.execute(
+                     "SELECT id, owner_pid FROM jobs WHERE status IN ('queued', 'running')")
+                 if pid is None or pid == os.getpid() or not _pid_alive(pid)]
+        conn.executemany('''UPDATE jobs SET status = 'failed', message = 'Interrotta: il processo è terminato',
+                                finished_at = strftime('%Y-%m-%d %H:%M:%S', 'now'),
+                                expires_at = strftime('%Y-%m-%d %H:%M:%S', 'now', ?)
+                            WHERE id = ?''', [(f'+{RESULT_TTL_HOURS * 3600:.0f} seconds', job_id) for job_id in stale])
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _recover()
+            _executor = ThreadPoolExecutor(WORKERS, thread_name_prefix='planner-job')
+        return _executor
+
+
+@contextmanager
+def _status_update():
+    # Scrittura dello stato su una connessione presa a parte: quella del thread può avere una
+    # lettura in corso (ad esempio il cursore di un'esportazione) e in modalità WAL non potrebbe
+    # avviare una scrittura dopo un commit di un'altra connessione
+    with directory():
+        pool = get_pool()
+    conn = pool.acquire()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        yield conn
+        conn.commit()
+    finally:
+        pool.release(conn)
+
+
+def _finish(job_id, status, message, result_path=None):
+    with _status_update() as conn:
+        conn.execute('''UPDATE jobs SET status = ?, message = ?, result_path = ?,
+                            progress = CASE WHEN ? = 'done' THEN 1.0 ELSE progress END,
+                            finished_at = strftime('%Y-%m-%d %H:%M:%S', 'now'),
+                            expires_at = strftime('%Y-%m-%d %H:%M:%S', 'now', ?)
+                        WHERE id = ?''',
+                     (status, message, result_path, status, f'+{RESULT_TTL_HOURS * 3600:.0f} seconds', job_id))
+
+
+def _run(job_id, kind, params, tenant_id):
+    with _status_update() as conn:
+        started = conn.execute('''UPDATE jobs SET status = 'running', started_at = strftime('%Y-%m-%d %H:%M:%S', 'now')
+                                  WHERE id = ? AND status = 'queued' ''', (job_id,)).rowcount
+    if not started:
+        return  # annullata mentre era in coda
+
+    last_update = [0.0]
+
+    def progress(fraction=None, message=None):
+        now = time.monotonic()
+        if now - last_update[0] < PROGRESS_INTERVAL:
+            return
+        last_update[0] = now
+        with _status_update() as conn:
+            conn.execute('UPDATE jobs SET progress = COALESCE(?, progress), message = COALESCE(?, message) WHERE id = ?',
+                         (fraction, message, job_id))
+            cancelled = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+        if cancelled:
+            raise JobCancelled()
+
+    workdir = _workdir(job_id)
+    handler, _ = KINDS[kind]
+    try:
+        with tenant_scope(tenant_id):
+            result_path, message = handler(params, workdir, progress)
+    except JobCancelled:
+        _finish(job_id, 'cancelled', 'Annullata')
+        shutil.rmtree(workdir, ignore_errors=True)
+    except Exception as e:
+        _finish(job_id, 'failed', str(e))
+    else:
+        _finish(job_id, 'done', message, result_path)
+
+
+def submit(kind, params, upload=None):
+    # Accoda un'attività per il tenant corrente e ne restituisce l'id. Se la stessa attività
+    # (tipo e parametri) è già in corso o ha un risultato valido sugli stessi dati, viene
+    # restituito l'id esistente. upload = (nome file, contenuto) per le importazioni.
+    if kind not in KINDS:
+        raise ValueError(f"Tipo di attività sconosciuto: {kind}")
+    _, cacheable = KINDS[kind]
+    tenant_id = current_tenant()
+    cache_key = None
+    if cacheable:
+        cache_key = hashlib.sha1(json.dumps([tenant_id, kind, params, fingerprint()], sort_keys=True,
+                                            default=str).encode()).hexdigest()
+    executor = _get_executor()
+    _maybe_cleanup()
+
+    with directory(), transaction() as conn:
+        if cache_key is not None:
+            for job_id, status, result_path in conn.execute(
+                    '''SELECT id, status, result_path FROM jobs
+                       WHERE cache_key = ? AND (status IN ('queued', 'running')
+                             OR (status = 'done' AND expires_at > strftime('%Y-%m-%d %H:%M:%S', 'now')))
+                       ORDER BY id DESC''', (cache_key,)):
+                if status != 'done' or os.path.exists(result_path):
+                    return job_id
+        job_id = conn.execute('INSERT INTO jobs (tenant_id, kind, params, cache_key, owner_pid) VALUES (?, ?, ?, ?, ?)',
+                              (tenant_id, kind, json.dumps(params, default=str), cache_key, os.getpid())).lastrowid
+
+    workdir = _workdir(job_id)
+    os.makedirs(workdir, exist_ok=True)
+    if upload is not None:
+        filename, content = upload
+        with open(_upload_path(workdir, filename), 'wb') as f:
+            f.write(content)
+    executor.submit(_run, job_id, kind, params, tenant_id)
+    return job_id
+
+
+def get_job(job_id):
+    with directory(), get_connection() as conn:
+        row = conn.execute('''SELECT id, kind, status, progress, message, result_path, created_at, finished_at
+                              FROM jobs WHERE id = ? AND tenant_id = ?''', (int(job_id), current_tenant())).fetchone()
+    return Job(*row) if row else None
+
+
+def list_jobs(limit=20):
+    with directory(), get_connection() as conn:
+        rows = conn.execute('''SELECT id, kind, status, progress, message, result_path, created_at, finished_at
+                               FROM jobs WHERE tenant_id = ? ORDER BY id DESC LIMIT ?''',
+                            (current_tenant(), limit)).fetchall()
+    return [Job(*row) for row in rows]
+
+
+def cancel(job_id):
+    # Un'attività in coda viene annullata subito, una in corso al prossimo aggiornamento
+    # dell'avanzamento. Le importazioni mantengono i blocchi di righe già salvati.
+    with directory(), transaction() as conn:
+        queued = conn.execute('''UPDATE jobs SET status = 'cancelled', message = 'Annullata',
+                                     finished_at = strftime('%Y-%m-%d %H:%M:%S', 'now'),
+                                     expires_at = strftime('%Y-%m-%d %H:%M:%S', 'now', ?)
+                                 WHERE id = ? AND tenant_id = ? AND status = 'queued' ''',
+                              (f'+{RESULT_TTL_HOURS * 3600:.0f} seconds', int(job_id), current_tenant())).rowcount
+        running = conn.execute('''UPDATE jobs SET cancel_requested = 1
+                                  WHERE id = ? AND tenant_id = ? AND status = 'running' ''',
+                               (int(job_id), current_tenant())).rowcount
+    if queued:
+        shutil.rmtree(_workdir(job_id), ignore_errors=True)
+    return bool(queued or running)
+
+
+def load_result(job):
+    # Risultato di un'attività completata: DataFrame per i report, ImportResult per le
+    # importazioni, percorso del file per esportazioni e fatture
+    if job.result_path.endswith('.pkl'):
+        with open(job.result_path, 'rb') as f:
+            return pickle.load(f)
+    return job.result_path
+
+
+def cleanup():
+    # Rimuove le attività scadute e i loro file; restituisce il numero di attività rimosse
+    with directory(), transaction() as conn:
+        expired = [row[0] for row in conn.execute(
+            "SELECT id FROM jobs WHERE expires_at < strftime('%Y-%m-%d %H:%M:%S', 'now')")]
+        conn.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in expired])
+    for job_id in expired:
+        shutil.rmtree(_workdir(job_id), ignore_errors=True)
+    return len(expired)
+
+
+def _maybe_cleanup():
+    global _last_cleanup
+    now = time.monotonic()
+    if now - _last_cleanup >= CLEANUP_INTERVAL:
+        _last_cleanup = now
+        cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Attività in background')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='ultime attività del tenant')
+    stop = subparsers.add_parser('cancel', help="annulla un'attività")
+    stop.add_argument('job_id', type=int)
+    subparsers.add_parser('cleanup', help='rimuove attività e risultati scaduti')
+    parser.add_argument('--tenant', type=int, help='tenant da consultare (predefinito: PLANNER_TENANT)')
+    args = parser.parse_args()
+
+    import tenancy
+    from database import init_db
+    init_db()
+    if args.tenant is not None:
+        tenancy.activate(args.tenant)
+
+    if args.command == 'list':
+        for job in list_jobs():
+            avanzamento = f" {job.progress:.0%}" if job.progress is not None else ''
+            print(f"{job.id} {job.kind} {STATUSES[job.status]}{avanzamento} {job.message or ''}")
+    elif args.command == 'cancel':
+        print('Annullamento richiesto' if cancel(args.job_id) else 'Attività non attiva')
+    else:
+        print(f"Attività rimosse: {cleanup()}")
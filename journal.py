@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+from datetime import date, datetime, timedelta, timezone
+
+from connection import get_connection, transaction
+from migrations import JOURNAL_COLUMNS
+from tenancy import current_tenant
+
+# Il giornale (tabella journal, migrazione 11) è scritto dai trigger su studenti, materie,
+# lezioni e serie, nella stessa transazione di ogni scrittura. Qui si trovano le letture
+# e la compattazione delle voci più vecchie del periodo di conservazione.
+RETENTION_DAYS = int(os.environ.get('PLANNER_JOURNAL_RETENTION_DAYS', '730'))
+
+OPERATIONS = {'I': 'Inserimento', 'U': 'Modifica', 'D': 'Cancellazione', 'S': 'Stato conservato'}
+
+
+def _timestamp(value):
+    # Istanti del giornale: UTC nel formato di strftime('%Y-%m-%d %H:%M:%f').
+    # Date e datetime senza fuso sono intesi nell'ora locale, come nel resto dell'applicazione.
+    # Una data senza orario indica la fine di quel giorno.
+    if isinstance(value, str):
+        value = date.fromisoformat(value) if len(value) == 10 else datetime.fromisoformat(value)
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime.combine(value, datetime.max.time())
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:23]
+
+
+def _check_table(table):
+    if table not in JOURNAL_COLUMNS:
+        raise ValueError(f"Tabella non registrata nel giornale: {table}")
+
+
+def _local(ts):
+    return datetime.fromisoformat(ts).replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+
+def history(table, row_id):
+    # Tutte le voci di una riga, dalla più vecchia: (istante locale, operazione, prima, dopo)
+    _check_table(table)
+    with get_connection() as conn:
+        rows = conn.execute('''SELECT ts, op, before, after FROM journal
+                               WHERE table_name = ? AND row_id = ? AND tenant_id = ?
+                               ORDER BY ts, id''', (table, int(row_id), current_tenant())).fetchall()
+    return [(_local(ts), op, json.loads(before) if before else None, json.loads(after) if after else None)
+            for ts, op, before, after in rows]
+
+
+def state_at(table, row_id, at):
+    # Stato della riga all'istante at (dizionario delle colonne registrate), oppure None se
+    # in quel momento non esisteva. Legge al massimo due voci tramite idx_journal_row.
+    _check_table(table)
+    ts = _timestamp(at)
+    params = (table, int(row_id), current_tenant(), ts)
+    with get_connection() as conn:
+        last = conn.execute('''SELECT op, after FROM journal
+                               WHERE table_name = ? AND row_id = ? AND tenant_id = ? AND ts <= ?
+                               ORDER BY ts DESC, id DESC LIMIT 1''', params).fetchone()
+        if last is not None:
+            op, after = last
+            return None if op == 'D' else json.loads(after)
+
+        # Nessuna voce fino ad at: lo stato si ricava dalla prima voce successiva
+        following = conn.execute('''SELECT op, before, after FROM journal
+                                    WHERE table_name = ? AND row_id = ? AND tenant_id = ? AND ts > ?
+                                    ORDER BY ts, id LIMIT 1''', params).fetchone()
+        if following is None:
+            # Riga mai modificata da quando esiste il giornale: vale lo stato attuale
+            columns = JOURNAL_COLUMNS[table]
+            current = conn.execute(f'SELECT {", ".join(columns)} FROM {table} WHERE id = ? AND tenant_id = ?',
+                                   (int(row_id), current_tenant())).fetchone()
+            return dict(zip(columns, current)) if current else None
+    op, before, after = following
+    if op == 'I':
+        return None
+    if op == 'D':
+        return json.loads(before)
+    if op == 'U':
+        # before contiene solo le colonne cambiate
+        return {**json.loads(after), **json.loads(before)}
+    # Istantanea della compattazione: gli stati precedenti non sono più disponibili
+    return None
+
+
+def compact(retention_days=RETENTION_DAYS, now=None):
+    # Rimuove le voci più vecchie del periodo di conservazione, per tutti i tenant del database.
+    # Per ogni riga ancora esistente resta la voce più recente, trasformata in istantanea (S):
+    # gli stati successivi all'inizio del periodo restano ricostruibili.
+    # Restituisce il numero di voci rimosse.
+    cutoff = _timestamp((now or datetime.now()) - timedelta(days=retention_days))
+    with transaction() as conn:
+        # Primo id dentro il periodo: le voci più vecchie hanno id minori
+        first = conn.execute('SELECT id FROM journal WHERE ts >= ? ORDER BY id LIMIT 1', (cutoff,)).fetchone()
+        limit = first[0] if first else conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM journal').fetchone()[0]
+
+        conn.execute("INSERT INTO journal_maintenance (started_at) VALUES (strftime('%Y-%m-%d %H:%M:%f', 'now'))")
+        try:
+            removed = conn.execute('''DELETE FROM journal WHERE id < ? AND id NOT IN
+                                        (SELECT MAX(id) FROM journal WHERE id < ? GROUP BY table_name, row_id)''',
+                                   (limit, limit)).rowcount
+            # Righe cancellate prima del periodo: non resta nulla da ricostruire
+            removed += conn.execute("DELETE FROM journal WHERE id < ? AND op = 'D'", (limit,)).rowcount
+            conn.execute('''UPDATE journal SET op = 'S', before = NULL
+                            WHERE id < ? AND op != 'S' ''', (limit,))
+        finally:
+            conn.execute('DELETE FROM journal_maintenance')
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Giornale delle modifiche')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    show = subparsers.add_parser('history', help='voci di una riga')
+    show.add_argument('table', choices=list(JOURNAL_COLUMNS))
+    show.add_argument('row_id', type=int)
+    at = subparsers.add_parser('at', help='stato di una riga a un istante')
+    at.add_argument('table', choices=list(JOURNAL_COLUMNS))
+    at.add_argument('row_id', type=int)
+    at.add_argument('timestamp', help='AAAA-MM-GG[ HH:MM[:SS]] (ora locale)')
+    clean = subparsers.add_parser('compact', help='compatta le voci più vecchie')
+    clean.add_argument('--days', type=int, default=RETENTION_DAYS, help='giorni di conservazione')
+    parser.add_argument('--tenant', type=int, help='tenant da consultare (predefinito: PLANNER_TENANT)')
+    args = parser.parse_args()
+
+    import tenancy
+    from database import init_db
+    init_db()
+    if args.tenant is not None:
+        tenancy.activate(args.tenant)
+
+    if args.command == 'history':
+        for ts, op, before, after in history(args.table, args.row_id):
+            print(f"{ts:%d/%m/%Y %H:%M:%S} {OPERATIONS[op]}: {before or ''} -> {after or ''}")
+    elif args.command == 'at':
+        print(state_at(args.table, args.row_id, args.timestamp))
+    else:
+        print(f"Voci rimosse: {compact(args.days)}")
@@ -0,0 +1,263 @@
+import argparse
+import bisect
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Strumentazione di query e pagine, disattivata per impostazione predefinita. Da spenta le
+# connessioni sono sqlite3.Connection normali e timed() restituisce la funzione originale:
+# il costo è nullo. Va attivata all'avvio del processo, prima di aprire le connessioni.
+ENABLED = os.environ.get('PLANNER_METRICS', '0') == '1'
+
+# Statement più lenti di questa soglia finiscono nel log, con parametri e piano di esecuzione
+SLOW_QUERY_MS = float(os.environ.get('PLANNER_SLOW_QUERY_MS', '100'))
+SLOW_QUERY_LOG = os.environ.get('PLANNER_SLOW_QUERY_LOG', 'slow_queries.log')
+
+# Porta dell'endpoint locale in formato Prometheus (solo 127.0.0.1); vuoto = nessun endpoint
+PORT = int(os.environ.get('PLANNER_METRICS_PORT', '0'))
+
+# Limiti superiori (secondi) dei bucket degli istogrammi
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Numero massimo di serie per tipo: gli statement oltre il limite confluiscono in 'altro'
+MAX_SERIES = 500
+
+_series = {}  # (tipo, nome) -> [conteggi per bucket..., +Inf, somma, massimo]
+_lock = threading.Lock()
+_log_lock = threading.Lock()
+_server = None
+
+
+def _label(sql):
+    # Testo dello statement su una riga: i parametri sono '?', quindi il numero di serie resta limitato
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+def observe(kind, name, seconds):
+    with _lock:
+        series = _series.get((kind, name))
+        if series is None:
+            if sum(1 for k, _ in _series if k == kind) >= MAX_SERIES:
+                name = 'altro'
+                series = _series.get((kind, name))
+            if series is None:
+                series = _series[(kind, name)] = [0] * (len(BUCKETS) + 1) + [0.0, 0.0]
+        series[bisect.bisect_left(BUCKETS, seconds)] += 1
+        series[-2] += seconds
+        series[-1] = max(series[-1], seconds)
+
+
+class _Timer:
+    __slots__ = ('kind', 'name', 'started')
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.kind, self.name, time.perf_counter() - self.started)
+
+
+_disabled = nullcontext()
+
+
+def timer(kind, name):
+    # Context manager che registra la durata del blocco
+    if not ENABLED:
+        return _disabled
+    return _Timer(kind, _label(name) if kind in ('sql', 'pandas') else name)
+
+
+def timed(kind='render'):
+    # Decoratore per le funzioni render_*: una serie per nome di funzione
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(kind, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _loggable(params):
+    if isinstance(params, dict):
+        return {k: _loggable(v) for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [_loggable(v) for v in params]
+    if isinstance(params, bytes):
+        return f'<{len(params)} byte>'
+    if isinstance(params, str) and len(params) > 200:
+        return params[:200] + '…'
+    return params if isinstance(params, (int, float, type(None))) else str(params)
+
+
+def _log_slow(conn, sql, params, seconds, many=False):
+    plan = []
+    if not many:
+        # Il piano viene chiesto sulla stessa connessione (stessa transazione e schema),
+        # con un cursore non strumentato
+        try:
+            plan = [row[3] for row in sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params)]
+        except sqlite3.Error:
+            pass
+    record = {'ts': datetime.now().isoformat(timespec='milliseconds'), 'ms': round(seconds * 1000, 3),
+              'sql': _label(sql), 'params': _loggable(params) if not many else None,
+              'executemany': many, 'plan': plan}
+    with _log_lock, open(SLOW_QUERY_LOG, 'a', encoding='utf-8') as log:
+        log.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def _finish(conn, sql, params, started, many=False):
+    seconds = time.perf_counter() - started
+    observe('sql', _label(sql), seconds)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        _log_slow(conn, sql, params, seconds, many)
+
+
+# Cursore e connessione strumentati. Il tempo misurato è quello di execute(): per le SELECT
+# comprende la preparazione e il calcolo della prima riga, non la lettura delle successive.
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _finish(self.connection, sql, parameters, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _finish(self.connection, sql, None, started, many=True)
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    # Classe da passare a sqlite3.connect(factory=...)
+    return TimedConnection if ENABLED else sqlite3.Connection
+
+
+def reset():
+    with _lock:
+        _series.clear()
+
+
+def _quantile(counts, total, q):
+    # Limite superiore del bucket che contiene il quantile q
+    target = q * total
+    running = 0
+    for bound, count in zip(BUCKETS + (float('inf'),), counts):
+        running += count
+        if running >= target:
+            return bound
+    return float('inf')
+
+
+def summary(kind=None):
+    # Righe per il pannello di amministrazione, dalla serie con più tempo totale
+    with _lock:
+        items = [(k, n, list(s)) for (k, n), s in _series.items() if kind is None or k == kind]
+    rows = []
+    for k, name, series in items:
+        counts, total_time, maximum = series[:-2], series[-2], series[-1]
+        count = sum(counts)
+        rows.append({'tipo': k, 'nome': name, 'chiamate': count, 'totale_ms': total_time * 1000,
+                     'media_ms': total_time * 1000 / count, 'p95_ms': _quantile(counts, count, 0.95) * 1000,
+                     'max_ms': maximum * 1000})
+    return sorted(rows, key=lambda row: row['totale_ms'], reverse=True)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def exposition():
+    # Testo nel formato di esposizione di Prometheus
+    lines = ['# HELP planner_duration_seconds Durata di statement SQL, letture pandas e render Streamlit',
+             '# TYPE planner_duration_seconds histogram']
+    with _lock:
+        items = sorted((k, n, list(s)) for (k, n), s in _series.items())
+    for kind, name, series in items:
+        labels = f'kind="{_escape(kind)}",name="{_escape(name)}"'
+        running = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), series[:-2]):
+            running += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'planner_duration_seconds_bucket{{{labels},le="{le}"}} {running}')
+        lines.append(f'planner_duration_seconds_sum{{{labels}}} {series[-2]!r}')
+        lines.append(f'planner_duration_seconds_count{{{labels}}} {running}')
+    return '\n'.join(lines) + '\n'
+
+
+def slow_queries(limit=50):
+    # Ultime voci del log delle query lente, dalla più recente
+    try:
+        with open(SLOW_QUERY_LOG, encoding='utf-8') as log:
+            lines = log.readlines()[-limit:]
+    except FileNotFoundError:
+        return []
+    return [json.loads(line) for line in reversed(lines) if line.strip()]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=PORT):
+    # Endpoint /metrics locale in un thread separato; le chiamate successive non fanno nulla
+    global _server
+    with _lock:
+        if _server is None and ENABLED and port:
+            _server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Log delle query lente')
+    parser.add_argument('--limit', type=int, default=20, help='numero di voci da mostrare')
+    args = parser.parse_args()
+
+    for record in slow_queries(args.limit):
+        print(f"{record['ts']} {record['ms']:.1f} ms: {record['sql']}")
+        if record['params']:
+            print(f"    parametri: {record['params']}")
+        for step in record['plan']:
+            print(f"    {step}")
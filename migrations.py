@@ -0,0 +1,438 @@
+from auth import LOCKED_PASSWORD, hash_password, is_hashed
+from connection import transaction
+
+# Migrazioni dello schema, in ordine di versione. Ogni passo è una lista di
+# statement SQL oppure una funzione che riceve la connessione.
+# Le nuove modifiche allo schema vanno aggiunte in fondo con versione crescente.
+
+
+def _initial_schema(conn):
+    # Tabella Utenti
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              username TEXT UNIQUE NOT NULL,
+              password TEXT NOT NULL,
+              role TEXT NOT NULL)''')
+
+    # Tabella Studenti
+    conn.execute('''CREATE TABLE IF NOT EXISTS students
+              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              name TEXT NOT NULL,
+              email TEXT UNIQUE NOT NULL,
+              hourly_cost REAL NOT NULL)''')
+
+    # Tabella Materie
+    conn.execute('''CREATE TABLE IF NOT EXISTS subjects
+              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              name TEXT NOT NULL,
+              teacher_id INTEGER NOT NULL,
+              FOREIGN KEY(teacher_id) REFERENCES users(id))''')
+
+    # Tabella Lezioni
+    conn.execute('''CREATE TABLE IF NOT EXISTS lessons
+              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              student_id INTEGER NOT NULL,
+              subject_id INTEGER NOT NULL,
+              date DATE NOT NULL,
+              duration REAL NOT NULL,
+              notes TEXT,
+              FOREIGN KEY(student_id) REFERENCES students(id),
+              FOREIGN KEY(subject_id) REFERENCES subjects(id))''')
+
+
+def _hash_passwords(conn):
+    # Conversione una tantum delle password salvate in chiaro
+    users = conn.execute('SELECT id, password FROM users').fetchall()
+    conn.executemany('UPDATE users SET password=? WHERE id=?',
+                     [(hash_password(password), user_id) for user_id, password in users
+                      if not is_hashed(password) and password != LOCKED_PASSWORD])
+
+
+def _rebuild_table(conn, table, create):
+    # SQLite non permette di cambiare i vincoli di una tabella: la tabella viene ricreata con lo
+    # schema indicato ({table} = nome), copiando righe, indici, trigger e sequenza di AUTOINCREMENT.
+    # Le chiavi esterne non sono attive, quindi le tabelle collegate non vengono toccate.
+    saved = [sql for (sql,) in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL",
+        (table,))]
+    sequence = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    columns = ', '.join(r[1] for r in conn.execute(f'PRAGMA table_info({table})'))
+    conn.execute(create.format(table=f'{table}_new'))
+    conn.execute(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}')
+    conn.execute(f'DROP TABLE {table}')
+    # Con la sintassi moderna la rinomina rifiuta i trigger di altre tabelle che citano quella
+    # appena eliminata; i riferimenti per nome restano validi dopo la rinomina
+    conn.execute('PRAGMA legacy_alter_table=ON')
+    try:
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    finally:
+        conn.execute('PRAGMA legacy_alter_table=OFF')
+    if sequence is not None:
+        conn.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (sequence[0], table))
+    for sql in saved:
+        conn.execute(sql)
+
+
+def _tenant_unique(conn):
+    # Email degli studenti e username degli account sono unici nel tenant, non in tutto il database
+    _rebuild_table(conn, 'users', '''CREATE TABLE {table}
+              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              username TEXT NOT NULL,
+              password TEXT NOT NULL,
+              role TEXT NOT NULL,
+              student_id INTEGER REFERENCES students(id),
+              tenant_id INTEGER NOT NULL DEFAULT 1,
+              UNIQUE(tenant_id, username))''')
+    _rebuild_table(conn, 'students', '''CREATE TABLE {table}
+              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              name TEXT NOT NULL,
+              email TEXT NOT NULL,
+              hourly_cost REAL NOT NULL,
+              tenant_id INTEGER NOT NULL DEFAULT 1,
+              UNIQUE(tenant_id, email))''')
+    # Il login cerca l'account per username in tutti i tenant
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)')
+
+
+# Colonne registrate nel giornale delle modifiche per ogni tabella (schema della versione 11).
+# materialized_until delle serie cambia a ogni lettura del calendario e non viene registrata.
+JOURNAL_COLUMNS = {
+    'students': ['name', 'email', 'hourly_cost'],
+    'subjects': ['name', 'teacher_id'],
+    'lessons': ['student_id', 'subject_id', 'date', 'start_time', 'duration', 'notes', 'series_id'],
+    'lesson_series': ['student_id', 'subject_id', 'start_date', 'end_date', 'weekdays', 'interval_weeks',
+                      'duration', 'notes', 'start_time'],
+}
+
+
+def _journal_triggers(table, columns):
+    # Trigger che registrano inserimenti, modifiche e cancellazioni nella stessa transazione
+    # della scrittura. Nelle modifiche before contiene solo le colonne cambiate, after la riga
+    # completa: lo stato a un istante si legge da una sola voce del giornale.
+    def row(prefix):
+        return 'json_object(' + ', '.join(f"'{c}', {prefix}.{c}" for c in columns) + ')'
+    changed = ' OR '.join(f'OLD.{c} IS NOT NEW.{c}' for c in columns)
+    unchanged = ', '.join(f"CASE WHEN OLD.{c} IS NEW.{c} THEN '$.{c}' ELSE '$.-' END" for c in columns)
+    return [
+        f'''CREATE TRIGGER IF NOT EXISTS journal_{table}_insert AFTER INSERT ON {table} BEGIN
+              INSERT INTO journal (table_name, row_id, op, tenant_id, after)
+              VALUES ('{table}', NEW.id, 'I', NEW.tenant_id, {row('NEW')});
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS journal_{table}_update AFTER UPDATE ON {table} WHEN {changed} BEGIN
+              INSERT INTO journal (table_name, row_id, op, tenant_id, before, after)
+              VALUES ('{table}', NEW.id, 'U', NEW.tenant_id, json_remove({row('OLD')}, {unchanged}), {row('NEW')});
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS journal_{table}_delete AFTER DELETE ON {table} BEGIN
+              INSERT INTO journal (table_name, row_id, op, tenant_id, before)
+              VALUES ('{table}', OLD.id, 'D', OLD.tenant_id, {row('OLD')});
+           END''',
+    ]
+
+
+MIGRATIONS = [
+    (1, 'Schema iniziale', _initial_schema),
+    (2, 'Indici sulle lezioni', [
+        # Dashboard studente, report per studente e verifica in delete_student
+        'CREATE INDEX IF NOT EXISTS idx_lessons_student_date ON lessons (student_id, date)',
+        # Verifica in delete_subject
+        'CREATE INDEX IF NOT EXISTS idx_lessons_subject ON lessons (subject_id)',
+        # Filtri per periodo di report e calendario
+        'CREATE INDEX IF NOT EXISTS idx_lessons_date ON lessons (date)',
+    ]),
+    (3, 'Serie di lezioni ricorrenti', [
+        # Regola settimanale: giorni della settimana (0 = lunedì) e intervallo in settimane.
+        # materialized_until è l'ultima data già copiata in lessons.
+        '''CREATE TABLE IF NOT EXISTS lesson_series
+              (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              student_id INTEGER NOT NULL,
+              subject_id INTEGER NOT NULL,
+              start_date DATE NOT NULL,
+              end_date DATE,
+              weekdays TEXT NOT NULL,
+              interval_weeks INTEGER NOT NULL DEFAULT 1,
+              duration REAL NOT NULL,
+              notes TEXT,
+              materialized_until DATE,
+              FOREIGN KEY(student_id) REFERENCES students(id),
+              FOREIGN KEY(subject_id) REFERENCES subjects(id))''',
+        # Date escluse dalla serie (festività, lezioni annullate)
+        '''CREATE TABLE IF NOT EXISTS lesson_series_exceptions
+              (series_id INTEGER NOT NULL,
+              date DATE NOT NULL,
+              PRIMARY KEY(series_id, date),
+              FOREIGN KEY(series_id) REFERENCES lesson_series(id)) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_series_period ON lesson_series (start_date, end_date)',
+        'ALTER TABLE lessons ADD COLUMN series_id INTEGER REFERENCES lesson_series(id)',
+    ]),
+    (4, 'Orario di inizio e indici per i conflitti', [
+        # Orario di inizio 'HH:MM'; NULL per le lezioni senza orario
+        'ALTER TABLE lessons ADD COLUMN start_time TEXT',
+        'ALTER TABLE lesson_series ADD COLUMN start_time TEXT',
+        # Lezioni di un insegnante in un giorno: materie dell'insegnante, poi (subject_id, date)
+        'CREATE INDEX IF NOT EXISTS idx_subjects_teacher ON subjects (teacher_id)',
+        'CREATE INDEX IF NOT EXISTS idx_lessons_subject_date ON lessons (subject_id, date)',
+        # Sostituito dal precedente, che ha lo stesso prefisso
+        'DROP INDEX IF EXISTS idx_lessons_subject',
+    ]),
+    (5, 'Riepilogo di fatturazione per studente e mese', [
+        # Ore, costo e numero di lezioni per (studente, mese 'AAAA-MM'), aggiornati dai trigger
+        '''CREATE TABLE IF NOT EXISTS billing_summary
+              (student_id INTEGER NOT NULL,
+              month TEXT NOT NULL,
+              hours REAL NOT NULL DEFAULT 0,
+              cost REAL NOT NULL DEFAULT 0,
+              lessons INTEGER NOT NULL DEFAULT 0,
+              PRIMARY KEY(student_id, month)) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_billing_month ON billing_summary (month)',
+        '''CREATE TRIGGER IF NOT EXISTS billing_lesson_insert AFTER INSERT ON lessons BEGIN
+              INSERT OR IGNORE INTO billing_summary (student_id, month)
+              VALUES (NEW.student_id, substr(NEW.date, 1, 7));
+              UPDATE billing_summary
+              SET hours = hours + NEW.duration,
+                  cost = cost + NEW.duration * (SELECT hourly_cost FROM students WHERE id = NEW.student_id),
+                  lessons = lessons + 1
+              WHERE student_id = NEW.student_id AND month = substr(NEW.date, 1, 7);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS billing_lesson_delete AFTER DELETE ON lessons BEGIN
+              UPDATE billing_summary
+              SET hours = hours - OLD.duration,
+                  cost = cost - OLD.duration * (SELECT hourly_cost FROM students WHERE id = OLD.student_id),
+                  lessons = lessons - 1
+              WHERE student_id = OLD.student_id AND month = substr(OLD.date, 1, 7);
+              DELETE FROM billing_summary
+              WHERE student_id = OLD.student_id AND month = substr(OLD.date, 1, 7) AND lessons <= 0;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS billing_lesson_update
+           AFTER UPDATE OF student_id, date, duration ON lessons BEGIN
+              UPDATE billing_summary
+              SET hours = hours - OLD.duration,
+                  cost = cost - OLD.duration * (SELECT hourly_cost FROM students WHERE id = OLD.student_id),
+                  lessons = lessons - 1
+              WHERE student_id = OLD.student_id AND month = substr(OLD.date, 1, 7);
+              DELETE FROM billing_summary
+              WHERE student_id = OLD.student_id AND month = substr(OLD.date, 1, 7) AND lessons <= 0;
+              INSERT OR IGNORE INTO billing_summary (student_id, month)
+              VALUES (NEW.student_id, substr(NEW.date, 1, 7));
+              UPDATE billing_summary
+              SET hours = hours + NEW.duration,
+                  cost = cost + NEW.duration * (SELECT hourly_cost FROM students WHERE id = NEW.student_id),
+                  lessons = lessons + 1
+              WHERE student_id = NEW.student_id AND month = substr(NEW.date, 1, 7);
+           END''',
+        # Il costo orario si applica a tutte le lezioni dello studente
+        '''CREATE TRIGGER IF NOT EXISTS billing_student_cost AFTER UPDATE OF hourly_cost ON students BEGIN
+              UPDATE billing_summary SET cost = hours * NEW.hourly_cost WHERE student_id = NEW.id;
+           END''',
+        '''INSERT INTO billing_summary (student_id, month, hours, cost, lessons)
+           SELECT lessons.student_id, substr(lessons.date, 1, 7), SUM(duration),
+                  SUM(duration * students.hourly_cost), COUNT(*)
+           FROM lessons JOIN students ON lessons.student_id = students.id
+           GROUP BY lessons.student_id, substr(lessons.date, 1, 7)''',
+    ]),
+    (6, 'Registro delle fatture', [
+        # Una fattura per studente e periodo; checksum identifica i dati da cui è stata generata
+        '''CREATE TABLE IF NOT EXISTS invoices
+              (student_id INTEGER NOT NULL,
+              period_start DATE NOT NULL,
+              period_end DATE NOT NULL,
+              number TEXT NOT NULL UNIQUE,
+              total REAL NOT NULL,
+              checksum TEXT NOT NULL,
+              path TEXT NOT NULL,
+              created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+              PRIMARY KEY(student_id, period_start, period_end),
+              FOREIGN KEY(student_id) REFERENCES students(id)) WITHOUT ROWID''',
+    ]),
+    (7, 'Hash delle password', _hash_passwords),
+    (8, 'Account collegati agli studenti', [
+        'ALTER TABLE users ADD COLUMN student_id INTEGER REFERENCES students(id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_users_student ON users (student_id)',
+        # Gli account esistenti erano associati agli studenti tramite l'email usata come username
+        '''UPDATE users SET student_id = (SELECT id FROM students WHERE students.email = users.username)
+           WHERE role != 'insegnante' ''',
+        # Account bloccati per gli altri studenti, da attivare generando una password
+        '''INSERT OR IGNORE INTO users (username, password, role, student_id)
+           SELECT email, '!', 'studente', id FROM students
+           WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.student_id = students.id)''',
+    ]),
+    (9, 'Separazione dei dati per tenant', [
+        # I dati esistenti appartengono al tenant 1
+        'ALTER TABLE users ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE students ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE subjects ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE lessons ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE lesson_series ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE billing_summary ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT 1',
+        # Con gli shard gli id degli studenti si ripetono tra tenant diversi
+        'DROP INDEX IF EXISTS idx_users_student',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_users_tenant_student ON users (tenant_id, student_id)',
+        # Ogni lettura filtra per tenant: gli indici iniziano con tenant_id
+        'CREATE INDEX IF NOT EXISTS idx_students_tenant_name ON students (tenant_id, name)',
+        'CREATE INDEX IF NOT EXISTS idx_subjects_tenant_name ON subjects (tenant_id, name)',
+        'CREATE INDEX IF NOT EXISTS idx_lessons_tenant_date ON lessons (tenant_id, date)',
+        'DROP INDEX IF EXISTS idx_lessons_date',
+        'CREATE INDEX IF NOT EXISTS idx_series_tenant_period ON lesson_series (tenant_id, start_date, end_date)',
+        'DROP INDEX IF EXISTS idx_series_period',
+        'CREATE INDEX IF NOT EXISTS idx_billing_tenant_month ON billing_summary (tenant_id, month)',
+        'DROP INDEX IF EXISTS idx_billing_month',
+        # Le righe di riepilogo create dai trigger ereditano il tenant della lezione
+        'DROP TRIGGER IF EXISTS billing_lesson_insert',
+        'DROP TRIGGER IF EXISTS billing_lesson_update',
+        '''CREATE TRIGGER billing_lesson_insert AFTER INSERT ON lessons BEGIN
+              INSERT OR IGNORE INTO billing_summary (student_id, month, tenant_id)
+              VALUES (NEW.student_id, substr(NEW.date, 1, 7), NEW.tenant_id);
+              UPDATE billing_summary
+              SET hours = hours + NEW.duration,
+                  cost = cost + NEW.duration * (SELECT hourly_cost FROM students WHERE id = NEW.student_id),
+                  lessons = lessons + 1
+              WHERE student_id = NEW.student_id AND month = substr(NEW.date, 1, 7);
+           END''',
+        '''CREATE TRIGGER billing_lesson_update
+           AFTER UPDATE OF student_id, date, duration ON lessons BEGIN
+              UPDATE billing_summary
+              SET hours = hours - OLD.duration,
+                  cost = cost - OLD.duration * (SELECT hourly_cost FROM students WHERE id = OLD.student_id),
+                  lessons = lessons - 1
+              WHERE student_id = OLD.student_id AND month = substr(OLD.date, 1, 7);
+              DELETE FROM billing_summary
+              WHERE student_id = OLD.student_id AND month = substr(OLD.date, 1, 7) AND lessons <= 0;
+              INSERT OR IGNORE INTO billing_summary (student_id, month, tenant_id)
+              VALUES (NEW.student_id, substr(NEW.date, 1, 7), NEW.tenant_id);
+              UPDATE billing_summary
+              SET hours = hours + NEW.duration,
+                  cost = cost + NEW.duration * (SELECT hourly_cost FROM students WHERE id = NEW.student_id),
+                  lessons = lessons + 1
+              WHERE student_id = NEW.student_id AND month = substr(NEW.date, 1, 7);
+           END''',
+    ]),
+    (10, 'Ricerca testuale sulle lezioni', [
+        # Indice FTS5 su note, nome dello studente e della materia; rowid = lessons.id.
+        # I nomi sono copiati nell'indice, così la ricerca non richiede join per il ranking.
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS lessons_fts USING fts5
+              (notes, student, subject, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+        '''CREATE TRIGGER IF NOT EXISTS search_lesson_insert AFTER INSERT ON lessons BEGIN
+              INSERT INTO lessons_fts (rowid, notes, student, subject)
+              VALUES (NEW.id, NEW.notes,
+                      (SELECT name FROM students WHERE id = NEW.student_id),
+                      (SELECT name FROM subjects WHERE id = NEW.subject_id));
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS search_lesson_delete AFTER DELETE ON lessons BEGIN
+              DELETE FROM lessons_fts WHERE rowid = OLD.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS search_lesson_update
+           AFTER UPDATE OF notes, student_id, subject_id ON lessons BEGIN
+              UPDATE lessons_fts
+              SET notes = NEW.notes,
+                  student = (SELECT name FROM students WHERE id = NEW.student_id),
+                  subject = (SELECT name FROM subjects WHERE id = NEW.subject_id)
+              WHERE rowid = NEW.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS search_student_name AFTER UPDATE OF name ON students BEGIN
+              UPDATE lessons_fts SET student = NEW.name
+              WHERE rowid IN (SELECT id FROM lessons WHERE student_id = NEW.id);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS search_subject_name AFTER UPDATE OF name ON subjects BEGIN
+              UPDATE lessons_fts SET subject = NEW.name
+              WHERE rowid IN (SELECT id FROM lessons WHERE subject_id = NEW.id);
+           END''',
+        '''INSERT INTO lessons_fts (rowid, notes, student, subject)
+           SELECT lessons.id, lessons.notes, students.name, subjects.name
+           FROM lessons
+           JOIN students ON lessons.student_id = students.id
+           JOIN subjects ON lessons.subject_id = subjects.id''',
+    ]),
+    (11, 'Giornale delle modifiche', [
+        # Solo in aggiunta: op è I (inserimento), U (modifica), D (cancellazione) oppure
+        # S (istantanea lasciata dalla compattazione al posto delle voci più vecchie)
+        '''CREATE TABLE IF NOT EXISTS journal
+              (id INTEGER PRIMARY KEY,
+              ts TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+              table_name TEXT NOT NULL,
+              row_id INTEGER NOT NULL,
+              op TEXT NOT NULL,
+              tenant_id INTEGER NOT NULL,
+              before TEXT,
+              after TEXT)''',
+        # Stato di una riga a un istante: una ricerca sull'indice, senza scorrere il giornale
+        'CREATE INDEX IF NOT EXISTS idx_journal_row ON journal (table_name, row_id, ts)',
+        # Modifiche e cancellazioni sono consentite solo alla compattazione, che inserisce
+        # una riga in journal_maintenance per la durata della propria transazione
+        'CREATE TABLE IF NOT EXISTS journal_maintenance (started_at TEXT NOT NULL)',
+        '''CREATE TRIGGER IF NOT EXISTS journal_no_update BEFORE UPDATE ON journal
+           WHEN NOT EXISTS (SELECT 1 FROM journal_maintenance) BEGIN
+              SELECT RAISE(ABORT, 'Il giornale delle modifiche non può essere modificato');
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS journal_no_delete BEFORE DELETE ON journal
+           WHEN NOT EXISTS (SELECT 1 FROM journal_maintenance) BEGIN
+              SELECT RAISE(ABORT, 'Il giornale delle modifiche non può essere modificato');
+           END''',
+    ] + [statement for table, columns in JOURNAL_COLUMNS.items() for statement in _journal_triggers(table, columns)]),
+    (12, 'Attività in background', [
+        # status: queued, running, done, failed, cancelled. Gli istanti sono in UTC.
+        '''CREATE TABLE IF NOT EXISTS jobs
+              (id INTEGER PRIMARY KEY,
+              tenant_id INTEGER NOT NULL,
+              kind TEXT NOT NULL,
+              params TEXT NOT NULL,
+              cache_key TEXT,
+              status TEXT NOT NULL DEFAULT 'queued',
+              progress REAL,
+              message TEXT,
+              result_path TEXT,
+              cancel_requested INTEGER NOT NULL DEFAULT 0,
+              owner_pid INTEGER,
+              created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now')),
+              started_at TEXT,
+              finished_at TEXT,
+              expires_at TEXT)''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_cache ON jobs (cache_key, status)',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs (expires_at)',
+    ]),
+    (13, 'Email e username unici per tenant', _tenant_unique),
+]
+
+
+def _ensure_version_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+              (version INTEGER PRIMARY KEY,
+              name TEXT NOT NULL,
+              applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)''')
+
+
+def current_version(conn):
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def migrate(target=None):
+    # Applica in ordine le migrazioni mancanti, ognuna nella propria transazione.
+    # Restituisce la lista delle versioni applicate.
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with transaction() as conn:
+            _ensure_version_table(conn)
+            # Ricontrollo dentro la transazione: un altro processo potrebbe averla già applicata
+            if current_version(conn) >= version:
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for statement in step:
+                    conn.execute(statement)
+            conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (version, name))
+        applied.append(version)
+
+    if applied:
+        with transaction() as conn:
+            conn.execute('ANALYZE')
+    return applied
+
+
+if __name__ == '__main__':
+    versions = migrate()
+    if versions:
+        print(f"Migrazioni applicate: {', '.join(str(v) for v in versions)}")
+    else:
+        print("Schema già aggiornato")
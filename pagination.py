@@ -0,0 +1,109 @@
+import pandas as pd
+
+from connection import get_connection
+from query_cache import get_or_compute
+from tenancy import current_tenant
+
+PAGE_SIZES = [10, 25, 50, 100]
+
+# Tabelle paginabili: query di base, colonna del tenant, chiave univoca, colonne di ricerca e di ordinamento.
+# Le pagine lette restano in cache finché una delle tabelle indicate non viene modificata.
+# Chiave e ordinamenti sono coppie (espressione SQL, nome della colonna nel risultato).
+# L'ordinamento è sempre completato dalla chiave, così (valore, id) identifica ogni riga
+# e la pagina successiva si ottiene con una condizione sulla tupla invece che con OFFSET.
+TABLES = {
+    'students': {
+        'query': 'SELECT id, name, email, hourly_cost FROM students',
+        'tenant': 'tenant_id',
+        'key': ('id', 'id'),
+        'tables': ('students',),
+        'search': ['name', 'email'],
+        'sort': {'Nome': ('name', 'name'), 'Email': ('email', 'email'),
+                 'Costo Orario': ('hourly_cost', 'hourly_cost'), 'ID': ('id', 'id')},
+    },
+    'subjects': {
+        'query': 'SELECT id, name FROM subjects',
+        'tenant': 'tenant_id',
+        'key': ('id', 'id'),
+        'tables': ('subjects',),
+        'search': ['name'],
+        'sort': {'Nome': ('name', 'name'), 'ID': ('id', 'id')},
+    },
+    'lessons': {
+        'query': '''
+            SELECT lessons.id, students.name as studente, subjects.name as materia,
+            lessons.date, lessons.start_time, lessons.duration, lessons.notes,
+            lessons.student_id, lessons.subject_id
+            FROM lessons
+            JOIN students ON lessons.student_id = students.id
+            JOIN subjects ON lessons.subject_id = subjects.id
+        ''',
+        'tenant': 'lessons.tenant_id',
+        'key': ('lessons.id', 'id'),
+        'tables': ('lessons', 'students', 'subjects'),
+        'search': ['students.name', 'subjects.name', 'lessons.notes'],
+        'sort': {'Data': ('lessons.date', 'date'), 'Studente': ('students.name', 'studente'),
+                 'Materia': ('subjects.name', 'materia'), 'Durata': ('lessons.duration', 'duration'),
+                 'ID': ('lessons.id', 'id')},
+    },
+}
+
+
+def page_query(table, sort, descending=False, search=None, after=None, limit=25, placeholder='?', like='LIKE'):
+    # Query e parametri di una pagina: una riga in più del limite, per sapere se esiste una
+    # pagina successiva. placeholder e operatore di ricerca dipendono dall'archivio (vedi storage.py).
+    spec = TABLES[table]
+    sort_column, sort_name = spec['sort'][sort]
+    key, key_name = spec['key']
+    conditions = [f"{spec['tenant']} = {placeholder}"]
+    params = [current_tenant()]
+
+    if search:
+        conditions.append('(' + ' OR '.join(f'{column} {like} {placeholder}' for column in spec['search']) + ')')
+        params.extend([f'%{search}%'] * len(spec['search']))
+
+    if after is not None:
+        operator = '<' if descending else '>'
+        if sort_column == key:
+            conditions.append(f'{key} {operator} {placeholder}')
+            params.append(after[1])
+        else:
+            conditions.append(f'({sort_column}, {key}) {operator} ({placeholder}, {placeholder})')
+            params.extend(after)
+
+    query = spec['query'] + ' WHERE ' + ' AND '.join(conditions)
+    direction = 'DESC' if descending else 'ASC'
+    if sort_column == key:
+        query += f' ORDER BY {key} {direction}'
+    else:
+        query += f' ORDER BY {sort_column} {direction}, {key} {direction}'
+    query += f' LIMIT {placeholder}'
+    params.append(limit + 1)
+    return query, params
+
+
+def page_result(table, sort, columns, rows, limit):
+    # Restituisce (DataFrame della pagina, cursore della pagina successiva o None)
+    spec = TABLES[table]
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit and page:
+        # Cursore costruito dai valori grezzi dell'ultima riga visualizzata
+        last = page[-1]
+        next_cursor = (last[columns.index(spec['sort'][sort][1])], last[columns.index(spec['key'][1])])
+    return pd.DataFrame(page, columns=columns), next_cursor
+
+
+def fetch_page(table, sort, descending=False, search=None, after=None, limit=25):
+    # Restituisce (DataFrame della pagina, cursore della pagina successiva o None).
+    # after è il cursore (valore di ordinamento, id) dell'ultima riga della pagina precedente.
+    query, params = page_query(table, sort, descending, search, after, limit)
+
+    def read():
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(query, params)
+            return [description[0] for description in c.description], c.fetchall()
+
+    columns, rows = get_or_compute(('fetch_page', query, tuple(params)), TABLES[table]['tables'], read)
+    return page_result(table, sort, columns, rows, limit)
@@ -0,0 +1,165 @@
+import functools
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+import metrics
+import tenancy
+from connection import data_version, get_connection
+
+# Limite di memoria della cache (byte), configurabile tramite variabile d'ambiente
+MAX_BYTES = int(os.environ.get('PLANNER_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Cache dei risultati condivisa tra tutte le sessioni del processo.
+# Ogni voce ricorda le tabelle da cui dipende e la loro generazione al momento della lettura:
+# una scrittura incrementa la generazione della tabella e scarta solo le voci che la usano.
+_entries = OrderedDict()  # chiave -> (valore, tabelle, generazioni, dimensione)
+_generations = {}
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+_size = 0
+
+
+def _sizeof(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(_sizeof(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+def _copy(value):
+    # I DataFrame vengono restituiti in copia: i chiamanti possono modificarli liberamente
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(_copy(item) for item in value)
+    return value
+
+
+def _drop(key):
+    global _size
+    _, _, _, size = _entries.pop(key)
+    _size -= size
+
+
+def generation(table):
+    return _generations.get(table, 0)
+
+
+def get(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            value, tables, generations, _ = entry
+            if all(_generations.get(t, 0) == g for t, g in zip(tables, generations)):
+                _entries.move_to_end(key)
+                _stats['hits'] += 1
+                return True, _copy(value)
+            _drop(key)
+        _stats['misses'] += 1
+    return False, None
+
+
+def put(key, value, tables, generations):
+    # generations va letto prima di eseguire la query, così un risultato letto
+    # mentre una scrittura era in corso non risulta mai valido
+    global _size
+    size = _sizeof(value)
+    if size > MAX_BYTES:
+        return
+    with _lock:
+        if any(_generations.get(t, 0) != g for t, g in zip(tables, generations)):
+            return
+        if key in _entries:
+            _drop(key)
+        _entries[key] = (_copy(value), tables, generations, size)
+        _size += size
+        # Eviction LRU fino a rientrare nel limite di memoria
+        while _size > MAX_BYTES and _entries:
+            _drop(next(iter(_entries)))
+            _stats['evictions'] += 1
+
+
+def invalidate(*tables):
+    # Da chiamare dopo il commit di ogni scrittura sulle tabelle indicate
+    with _lock:
+        for table in tables:
+            _generations[table] = _generations.get(table, 0) + 1
+        stale = [key for key, entry in _entries.items() if set(entry[1]) & set(tables)]
+        for key in stale:
+            _drop(key)
+        _stats['invalidations'] += len(stale)
+
+
+_seen_versions = {}
+
+
+def sync():
+    # Rileva le scritture fatte da altri processi sullo stesso database (ad esempio l'API
+    # accanto all'interfaccia Streamlit) e invalida tutte le tabelle. Va chiamata all'inizio
+    # di ogni richiesta: costa una PRAGMA. Anche i commit di questo processo cambiano la
+    # versione, quindi dopo una scrittura locale la cache viene comunque svuotata una volta.
+    path, version = data_version()
+    with _lock:
+        previous = _seen_versions.get(path)
+        _seen_versions[path] = version
+    if previous is not None and previous != version:
+        with get_connection() as conn:
+            tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        invalidate(*tables)
+        return True
+    return False
+
+
+def clear():
+    global _size
+    with _lock:
+        _entries.clear()
+        _size = 0
+
+
+def stats():
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses']
+        return dict(_stats, entries=len(_entries), bytes=_size, max_bytes=MAX_BYTES,
+                    hit_rate=_stats['hits'] / lookups if lookups else 0.0)
+
+
+def get_or_compute(key, tables, compute):
+    # Restituisce il valore in cache oppure lo calcola e lo memorizza.
+    # La chiave comprende il tenant corrente: tenant diversi non condividono risultati.
+    key = (tenancy.current_tenant(), key)
+    found, value = get(key)
+    if found:
+        return value
+    with _lock:
+        generations = tuple(_generations.get(t, 0) for t in tables)
+    value = compute()
+    put(key, value, tuple(tables), generations)
+    return value
+
+
+def cached(*tables):
+    # Decoratore: memorizza il risultato per funzione e argomenti finché le tabelle non cambiano
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items())))
+            return get_or_compute(key, tables, lambda: func(*args, **kwargs))
+        wrapper.uncached = func
+        return wrapper
+    return decorator
+
+
+def read_sql(query, params=(), tables=()):
+    # Equivalente in cache di pd.read_sql_query: la connessione viene presa solo in caso di miss
+    def compute():
+        with metrics.timer('pandas', query), get_connection() as conn:
+            return pd.read_sql_query(query, conn, params=params)
+    return get_or_compute(('read_sql', query, tuple(params)), tables, compute)
@@ -0,0 +1,227 @@
+import argparse
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+import query_cache
+from conflicts import BatchChecker, format_time
+from connection import get_connection, transaction
+from tenancy import current_tenant
+
+WEEKDAYS = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom']
+
+# Frequenze disponibili: intervallo in settimane tra due ripetizioni
+FREQUENCIES = {'Settimanale': 1, 'Bisettimanale': 2}
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def occurrences(start_date, weekdays, interval_weeks, start, end, end_date=None,
+                exceptions=(), materialized_until=None):
+    # Date della serie comprese in [start, end], calcolate senza scorrere le settimane precedenti:
+    # si salta direttamente alla prima settimana valida dopo l'inizio della finestra.
+    start_date = _to_date(start_date)
+    low = max(_to_date(start), start_date)
+    if materialized_until is not None:
+        low = max(low, _to_date(materialized_until) + timedelta(days=1))
+    high = _to_date(end)
+    if end_date is not None:
+        high = min(high, _to_date(end_date))
+    if low > high:
+        return
+
+    anchor = start_date - timedelta(days=start_date.weekday())
+    week = (low - timedelta(days=low.weekday()) - anchor).days // 7
+    if week % interval_weeks:
+        week += interval_weeks - week % interval_weeks
+    weekdays = sorted(weekdays)
+
+    monday = anchor + timedelta(weeks=week)
+    while monday <= high:
+        for weekday in weekdays:
+            day = monday + timedelta(days=weekday)
+            if low <= day <= high and day not in exceptions:
+                yield day
+        monday += timedelta(weeks=interval_weeks)
+
+
+def _parse_weekdays(text):
+    return [int(d) for d in text.split(',') if d != '']
+
+
+# Orizzonte per la verifica dei conflitti delle serie senza data di fine
+CONFLICT_HORIZON_DAYS = 365
+
+
+def add_series(student_id, subject_id, start_date, weekdays, duration, notes,
+               interval_weeks=1, end_date=None, start_time=None):
+    # Crea la serie se nessuna ripetizione (entro la data di fine o l'orizzonte) è in conflitto
+    start_time = format_time(start_time)
+    weekdays = sorted(int(d) for d in weekdays)
+    with transaction() as conn:
+        if start_time is not None:
+            last = _to_date(end_date) or _to_date(start_date) + timedelta(days=CONFLICT_HORIZON_DAYS)
+            checker = BatchChecker(conn, start_date, last)
+            for day in occurrences(start_date, weekdays, interval_weeks, start_date, last):
+                if checker.check(student_id, subject_id, day, start_time, duration):
+                    return False, f"Conflitto di orario il {day.strftime('%d/%m/%Y')} alle {start_time}"
+
+        conn.execute('''INSERT INTO lesson_series
+                  (student_id, subject_id, start_date, end_date, weekdays, interval_weeks, duration, notes,
+                  start_time, tenant_id)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                  (student_id, subject_id, start_date, end_date, ','.join(str(d) for d in weekdays),
+                   interval_weeks, duration, notes, start_time, current_tenant()))
+    query_cache.invalidate('lesson_series')
+    return True, "Serie creata con successo"
+
+
+def add_exception(series_id, day):
+    with transaction() as conn:
+        conn.execute('''INSERT OR IGNORE INTO lesson_series_exceptions (series_id, date)
+                        SELECT id, ? FROM lesson_series WHERE id = ? AND tenant_id = ?''',
+                     (_to_date(day).isoformat(), series_id, current_tenant()))
+    query_cache.invalidate('lesson_series')
+
+
+def delete_series(series_id):
+    # Le lezioni già materializzate restano in lessons
+    with transaction() as conn:
+        if not conn.execute('DELETE FROM lesson_series WHERE id=? AND tenant_id=?',
+                            (series_id, current_tenant())).rowcount:
+            return False, "Serie non trovata"
+        conn.execute('DELETE FROM lesson_series_exceptions WHERE series_id=?', (series_id,))
+        conn.execute('UPDATE lessons SET series_id=NULL WHERE series_id=?', (series_id,))
+    query_cache.invalidate('lesson_series', 'lessons')
+    return True, "Serie eliminata con successo"
+
+
+@query_cache.cached('lesson_series', 'students', 'subjects')
+def get_series():
+    with get_connection() as conn:
+        return pd.read_sql_query('''
+            SELECT lesson_series.*, students.name as studente, subjects.name as materia
+            FROM lesson_series
+            JOIN students ON lesson_series.student_id = students.id
+            JOIN subjects ON lesson_series.subject_id = subjects.id
+            WHERE lesson_series.tenant_id = ?
+            ORDER BY lesson_series.id
+        ''', conn, params=(current_tenant(),))
+
+
+def _series_in_range(conn, start, end, student_id=None):
+    query = '''
+        SELECT lesson_series.id, lesson_series.student_id, lesson_series.subject_id,
+               start_date, end_date, weekdays, interval_weeks, duration, notes, materialized_until,
+               students.name, subjects.name, students.hourly_cost, lesson_series.start_time
+        FROM lesson_series
+        JOIN students ON lesson_series.student_id = students.id
+        JOIN subjects ON lesson_series.subject_id = subjects.id
+        WHERE lesson_series.tenant_id = ? AND start_date <= ? AND (end_date IS NULL OR end_date >= ?)
+          AND (materialized_until IS NULL OR materialized_until < ?)
+    '''
+    params = [current_tenant(), _to_date(end).isoformat(), _to_date(start).isoformat(), _to_date(end).isoformat()]
+    if student_id is not None:
+        query += ' AND lesson_series.student_id = ?'
+        params.append(int(student_id))
+    series = conn.execute(query, params).fetchall()
+
+    exceptions = {}
+    if series:
+        placeholders = ','.join('?' * len(series))
+        for series_id, day in conn.execute(
+                f'''SELECT series_id, date FROM lesson_series_exceptions
+                    WHERE series_id IN ({placeholders}) AND date >= ? AND date <= ?''',
+                [s[0] for s in series] + [_to_date(start).isoformat(), _to_date(end).isoformat()]):
+            exceptions.setdefault(series_id, set()).add(_to_date(day))
+    return series, exceptions
+
+
+def expand(start, end, student_id=None):
+    # Lezioni ricorrenti non ancora materializzate nel periodo [start, end], generate al volo
+    rows = []
+    with get_connection() as conn:
+        series, exceptions = _series_in_range(conn, start, end, student_id)
+    for (series_id, s_student, s_subject, s_start, s_end, weekdays, interval, duration, notes,
+         materialized_until, student_name, subject_name, hourly_cost, start_time) in series:
+        for day in occurrences(s_start, _parse_weekdays(weekdays), interval, start, end, s_end,
+                               exceptions.get(series_id, ()), materialized_until):
+            rows.append((day, student_name, subject_name, duration, duration * hourly_cost, notes,
+                         s_student, s_subject, series_id, start_time))
+    return rows
+
+
+@query_cache.cached('lesson_series', 'students', 'subjects')
+def get_series_lessons_in_range(start, end, student_id=None):
+    # Stesse colonne di reports.get_lessons_in_range, con series_id al posto di id
+    df = pd.DataFrame(expand(start, end, student_id),
+                      columns=['date', 'studente', 'materia', 'duration', 'costo', 'notes',
+                               'student_id', 'subject_id', 'series_id', 'start_time'])
+    df['date'] = pd.to_datetime(df['date'])
+    return df.sort_values(['date', 'start_time'], kind='stable').reset_index(drop=True)
+
+
+def materialize(until, series_id=None):
+    # Copia in lessons tutte le ripetizioni fino a until, in un'unica transazione.
+    # Le ripetizioni in conflitto con altre lezioni non vengono create.
+    # Restituisce (numero di lezioni create, date saltate per conflitto).
+    until = _to_date(until)
+    with transaction() as conn:
+        query = '''SELECT id, student_id, subject_id, start_date, end_date, weekdays, interval_weeks,
+                          duration, notes, materialized_until, start_time
+                   FROM lesson_series
+                   WHERE tenant_id = ? AND start_date <= ?
+                     AND (materialized_until IS NULL OR materialized_until < ?)'''
+        params = [current_tenant(), until.isoformat(), until.isoformat()]
+        if series_id is not None:
+            query += ' AND id = ?'
+            params.append(series_id)
+        series = conn.execute(query, params).fetchall()
+        if not series:
+            return 0, []
+
+        first = min(_to_date(s[9]) + timedelta(days=1) if s[9] else _to_date(s[3]) for s in series)
+        checker = BatchChecker(conn, first, until, exclude_series={s[0] for s in series})
+
+        lessons = []
+        skipped = []
+        for (s_id, student_id, subject_id, s_start, s_end, weekdays, interval, duration, notes,
+             materialized_until, start_time) in series:
+            exceptions = {_to_date(r[0]) for r in conn.execute(
+                'SELECT date FROM lesson_series_exceptions WHERE series_id=?', (s_id,))}
+            for day in occurrences(s_start, _parse_weekdays(weekdays), interval, s_start, until, s_end,
+                                   exceptions, materialized_until):
+                if checker.check(student_id, subject_id, day, start_time, duration):
+                    skipped.append(day)
+                    continue
+                lessons.append((student_id, subject_id, day.isoformat(), start_time, duration, notes, s_id,
+                                current_tenant()))
+
+        conn.executemany('''INSERT INTO lessons
+                            (student_id, subject_id, date, start_time, duration, notes, series_id, tenant_id)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', lessons)
+        conn.executemany('UPDATE lesson_series SET materialized_until=? WHERE id=?',
+                         [(until.isoformat(), s[0]) for s in series])
+
+    query_cache.invalidate('lessons', 'lesson_series')
+    return len(lessons), skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Materializza le serie di lezioni ricorrenti')
+    parser.add_argument('until', help='ultima data da materializzare (AAAA-MM-GG)')
+    parser.add_argument('--series-id', type=int)
+    args = parser.parse_args()
+
+    from database import init_db
+    init_db()
+    created, skipped = materialize(args.until, args.series_id)
+    print(f"Lezioni create: {created}")
+    for day in skipped:
+        print(f"Saltata per conflitto di orario: {day.isoformat()}")
@@ -0,0 +1,243 @@
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+import billing
+import recurrence
+from connection import get_connection
+from query_cache import cached
+from tenancy import current_tenant
+
+# Raggruppamenti disponibili nel report: espressione SQL del periodo e frequenza pandas equivalente.
+# Le etichette seguono le convenzioni di pd.Grouper: giorno, lunedì di fine settimana, fine mese.
+PERIODS = {
+    'Giornaliero': ("date(lessons.date)", 'D'),
+    'Settimanale': ("date(lessons.date, 'weekday 1')", 'W-MON'),
+    'Mensile': ("date(lessons.date, 'start of month', '+1 month', '-1 day')", 'ME'),
+}
+
+_LESSONS_FROM = '''
+    FROM lessons
+    JOIN students ON lessons.student_id = students.id
+    JOIN subjects ON lessons.subject_id = subjects.id
+    WHERE lessons.tenant_id = ? AND lessons.date >= ? AND lessons.date < ?
+'''
+
+_DETAIL_COLUMNS = '''
+    SELECT lessons.id, lessons.date, lessons.start_time, students.name as studente, subjects.name as materia,
+           duration, (duration * students.hourly_cost) as costo, notes,
+           lessons.student_id, lessons.subject_id
+'''
+
+
+def _pandas_freq(freq):
+    # 'ME' è disponibile solo da pandas 2.2; le versioni precedenti usano 'M'
+    try:
+        pd.tseries.frequencies.to_offset(freq)
+        return freq
+    except ValueError:
+        return 'M'
+
+
+def _to_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def date_bounds(start, end):
+    # Intervallo [start, end + 1 giorno) in formato ISO, compatibile con l'indice su (tenant_id, date)
+    start, end = _to_date(start), _to_date(end)
+    return start.isoformat(), (end + timedelta(days=1)).isoformat()
+
+
+def _window_filter(start, end, student_id):
+    # Clausole FROM/WHERE comuni a dettaglio e aggregati, con i relativi parametri
+    query = _LESSONS_FROM
+    params = [current_tenant(), *date_bounds(start, end)]
+    if student_id is not None:
+        query += '    AND lessons.student_id = ?\n'
+        params.append(int(student_id))
+    return query, params
+
+
+@cached('lessons', 'lesson_series')
+def has_lessons():
+    with get_connection() as conn:
+        return conn.execute('''SELECT EXISTS (SELECT 1 FROM lessons WHERE tenant_id = ?)
+                               OR EXISTS (SELECT 1 FROM lesson_series WHERE tenant_id = ?)''',
+                            (current_tenant(), current_tenant())).fetchone()[0] == 1
+
+
+@cached('lessons', 'students', 'subjects')
+def get_lessons_in_range(start, end, student_id=None):
+    # Lezioni dettagliate nel periodo [start, end], eventualmente per un solo studente
+    where, params = _window_filter(start, end, student_id)
+    query = _DETAIL_COLUMNS + where + '    ORDER BY lessons.date, lessons.start_time, lessons.id'
+    with get_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+    df['date'] = pd.to_datetime(df['date'])
+    return df
+
+
+@cached('lessons', 'students', 'lesson_series')
+def get_students_in_range(start, end):
+    # Studenti con almeno una lezione (o una serie ricorrente attiva) nel periodo, per il filtro del dettaglio
+    first, after_last = date_bounds(start, end)
+    with get_connection() as conn:
+        return pd.read_sql_query('''
+            SELECT students.id, students.name
+            FROM lessons
+            JOIN students ON lessons.student_id = students.id
+            WHERE lessons.tenant_id = ? AND lessons.date >= ? AND lessons.date < ?
+            UNION
+            SELECT students.id, students.name
+            FROM lesson_series
+            JOIN students ON lesson_series.student_id = students.id
+            WHERE lesson_series.tenant_id = ? AND lesson_series.start_date < ?
+              AND (lesson_series.end_date IS NULL OR lesson_series.end_date >= ?)
+            ORDER BY 2
+        ''', conn, params=(current_tenant(), first, after_last, current_tenant(), after_last, first))
+
+
+def fill_buckets(grouped, period):
+    # Aggiunge i periodi senza lezioni, come farebbe pd.Grouper
+    if grouped.empty:
+        return grouped
+    freq = _pandas_freq(PERIODS[period][1])
+    full_index = pd.date_range(grouped.index.min(), grouped.index.max(), freq=freq, name='date')
+    return grouped.reindex(full_index, fill_value=0)
+
+
+def _sql_totals(start, end, period, student_id):
+    bucket = PERIODS[period][0]
+    where, params = _window_filter(start, end, student_id)
+    query = f'''
+    SELECT {bucket} as date, SUM(duration) as duration,
+           SUM(duration * students.hourly_cost) as costo, COUNT(*) as lezioni
+    ''' + where + f'    GROUP BY {bucket} ORDER BY 1'
+    with get_connection() as conn:
+        grouped = pd.read_sql_query(query, conn, params=params)
+    grouped['date'] = pd.to_datetime(grouped['date'])
+    return grouped.set_index('date')
+
+
+def _monthly_totals(start, end, student_id):
+    # I mesi interamente compresi nel periodo si leggono da billing_summary (una riga per
+    # studente e mese); solo i mesi parziali agli estremi vengono aggregati dalle lezioni
+    start, end = _to_date(start), _to_date(end)
+    first_full = start if start.day == 1 else month_bounds(start)[1] + timedelta(days=1)
+    last_full = end if end == month_bounds(end)[1] else month_bounds(end)[0] - timedelta(days=1)
+    if first_full > last_full:
+        return _sql_totals(start, end, 'Mensile', student_id)
+
+    summary = billing.get_monthly_totals(billing.month_key(first_full), billing.month_key(last_full), student_id)
+    summary['date'] = pd.to_datetime(summary.pop('month') + '-01') + pd.offsets.MonthEnd(0)
+    parts = [summary.set_index('date')]
+    if start < first_full:
+        parts.insert(0, _sql_totals(start, first_full - timedelta(days=1), 'Mensile', student_id))
+    if last_full < end:
+        parts.append(_sql_totals(last_full + timedelta(days=1), end, 'Mensile', student_id))
+    return pd.concat(parts)
+
+
+@cached('lessons', 'students', 'lesson_series', 'billing_summary')
+def get_report_totals(start, end, period, student_id=None):
+    # Totali per periodo calcolati interamente in SQL: restituisce solo le righe aggregate
+    if period == 'Mensile':
+        grouped = _monthly_totals(start, end, student_id)
+    else:
+        grouped = _sql_totals(start, end, period, student_id)
+    
+    # Lezioni ricorrenti non materializzate: generate solo per la finestra richiesta e aggregate a parte
+    series = recurrence.get_series_lessons_in_range(start, end, student_id)
+    if not series.empty:
+        grouped = grouped.add(aggregate_lessons_pandas(series, period), fill_value=0)
+        grouped = grouped[grouped['lezioni'] > 0].astype({'lezioni': int})
+    return fill_buckets(grouped, period)
+
+
+def aggregate_lessons_pandas(df, period):
+    # Versione pandas dell'aggregazione, mantenuta per i confronti con get_report_totals
+    freq = _pandas_freq(PERIODS[period][1])
+    grouped = df.groupby(pd.Grouper(key='date', freq=freq)).agg(
+        duration=('duration', 'sum'),
+        costo=('costo', 'sum'),
+        lezioni=('date', 'count'),
+    )
+    return grouped
+
+
+def get_report_totals_pandas(start, end, period, student_id=None):
+    df = pd.concat([get_lessons_in_range(start, end, student_id),
+                    recurrence.get_series_lessons_in_range(start, end, student_id)], ignore_index=True)
+    return aggregate_lessons_pandas(df, period)
+
+
+def month_bounds(day):
+    first = date(day.year, day.month, 1)
+    last = (first.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    return first, last
+
+
+# Area studente: tutte le letture usano l'indice (student_id, date) di lessons
+
+# Giorni per cui mostrare le ripetizioni future delle serie ricorrenti
+UPCOMING_DAYS = 60
+
+
+@cached('lessons', 'students', 'billing_summary')
+def get_student_summary(student_id):
+    # Totali dello studente da billing_summary, una riga per mese invece che per lezione
+    with get_connection() as conn:
+        lessons, hours, cost = conn.execute('''
+            SELECT COALESCE(SUM(lessons), 0), COALESCE(SUM(hours), 0), COALESCE(SUM(cost), 0)
+            FROM billing_summary WHERE student_id = ? AND tenant_id = ?''',
+            (int(student_id), current_tenant())).fetchone()
+    return {'lezioni': lessons, 'ore': hours, 'costo': cost}
+
+
+@cached('lessons', 'subjects', 'lesson_series')
+def get_upcoming_lessons(student_id, today, limit=20):
+    # Prossime lezioni da oggi in poi, comprese le ripetizioni delle serie non ancora create
+    with get_connection() as conn:
+        df = pd.read_sql_query('''
+            SELECT lessons.date, lessons.start_time, subjects.name as materia, duration, notes
+            FROM lessons
+            JOIN subjects ON lessons.subject_id = subjects.id
+            WHERE lessons.student_id = ? AND lessons.date >= ? AND lessons.tenant_id = ?
+            ORDER BY lessons.date, lessons.start_time, lessons.id
+            LIMIT ?
+        ''', conn, params=(int(student_id), today.isoformat(), current_tenant(), limit))
+    df['date'] = pd.to_datetime(df['date'])
+    series = recurrence.get_series_lessons_in_range(today, today + timedelta(days=UPCOMING_DAYS), student_id)
+    if not series.empty:
+        df = pd.concat([df, series[df.columns]], ignore_index=True)
+        df = df.sort_values(['date', 'start_time'], kind='stable', na_position='first').head(limit)
+    return df.reset_index(drop=True)
+
+
+@cached('lessons', 'students', 'subjects')
+def get_past_lessons(student_id, today, before=None, limit=20):
+    # Lezioni passate dalla più recente, a pagine: before è il cursore (data, id) dell'ultima
+    # riga della pagina precedente. Restituisce (DataFrame, cursore successivo o None).
+    query = '''
+        SELECT lessons.id, lessons.date, lessons.start_time, subjects.name as materia, duration,
+               (duration * students.hourly_cost) as costo, notes
+        FROM lessons
+        JOIN students ON lessons.student_id = students.id
+        JOIN subjects ON lessons.subject_id = subjects.id
+        WHERE lessons.student_id = ? AND lessons.date < ? AND lessons.tenant_id = ?
+    '''
+    params = [int(student_id), today.isoformat(), current_tenant()]
+    if before is not None:
+        query += ' AND (lessons.date, lessons.id) < (?, ?)'
+        params.extend(before)
+    query += ' ORDER BY lessons.date DESC, lessons.id DESC LIMIT ?'
+    params.append(limit + 1)
+    with get_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+    cursor = None
+    if len(df) > limit:
+        df = df.iloc[:limit]
+        cursor = (df['date'].iloc[-1], int(df['id'].iloc[-1]))
+    df['date'] = pd.to_datetime(df['date'])
+    return df, cursor
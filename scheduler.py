@@ -0,0 +1,315 @@
+import argparse
+import json
+import random
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+import calendar_data
+import query_cache
+from conflicts import BatchChecker, format_time, to_minutes
+from connection import get_connection, transaction
+from tenancy import current_tenant
+
+WEEKDAY_NAMES = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom']
+
+# Una lezione da collocare: ogni requisito di ore viene diviso in sessioni di durata fissa.
+# key identifica la sessione tra due risoluzioni successive (studente, materia, progressivo).
+Session = namedtuple('Session', ['key', 'student_id', 'subject_id', 'teacher_id', 'length', 'domain'])
+
+Timetable = namedtuple('Timetable', ['assignments', 'unassigned', 'elapsed', 'iterations'])
+
+
+def _weekday(value):
+    if isinstance(value, int):
+        return value
+    if str(value).isdigit():
+        return int(value)
+    return WEEKDAY_NAMES.index(str(value)[:3].capitalize())
+
+
+class Problem:
+    # Orario settimanale diviso in slot di slot_minutes minuti; le disponibilità sono liste di
+    # finestre (giorno, 'HH:MM', 'HH:MM'). Gli insegnanti senza disponibilità indicata sono
+    # considerati sempre disponibili. rooms è il numero di lezioni contemporanee possibili.
+
+    def __init__(self, students, requirements, teachers=None, rooms=1, slot_minutes=30,
+                 teacher_of=None, busy=None):
+        self.slot_minutes = slot_minutes
+        self.slots_per_day = 24 * 60 // slot_minutes
+        self.rooms = rooms
+        self.students = {int(k): self._slots(v) for k, v in students.items()}
+        self.teachers = {int(k): self._slots(v) for k, v in (teachers or {}).items()}
+        self.teacher_of = teacher_of if teacher_of is not None else _load_teachers()
+        # Slot già occupati da lezioni esistenti: {('student'|'teacher', id): set(slot)}
+        self.busy = busy or {}
+        self.sessions = self._sessions(requirements)
+
+    def _slots(self, windows):
+        slots = set()
+        for day, start, end in windows:
+            day = _weekday(day)
+            first = to_minutes(start) // self.slot_minutes
+            last = -(-to_minutes(end) // self.slot_minutes)
+            slots.update(day * self.slots_per_day + s for s in range(first, last))
+        return slots
+
+    def _sessions(self, requirements):
+        sessions = []
+        for requirement in requirements:
+            student_id = int(requirement['student_id'])
+            subject_id = int(requirement['subject_id'])
+            session_hours = float(requirement.get('session_hours', 1))
+            length = max(1, round(session_hours * 60 / self.slot_minutes))
+            count = max(1, round(float(requirement['hours']) / session_hours))
+            teacher_id = self.teacher_of.get(subject_id)
+            domain = self._domain(student_id, teacher_id, length)
+            for n in range(count):
+                sessions.append(Session((student_id, subject_id, n), student_id, subject_id, teacher_id,
+                                        length, domain))
+        return sessions
+
+    def _domain(self, student_id, teacher_id, length):
+        # Propagazione dei vincoli unari: inizi in cui l'intera sessione rientra nelle
+        # disponibilità di studente e insegnante, nello stesso giorno e fuori dagli impegni esistenti
+        available = set(self.students.get(student_id, ()))
+        if teacher_id in self.teachers:
+            available &= self.teachers[teacher_id]
+        available -= self.busy.get(('student', student_id), set())
+        available -= self.busy.get(('teacher', teacher_id), set())
+        domain = []
+        for start in sorted(available):
+            if start % self.slots_per_day + length > self.slots_per_day:
+                continue
+            if all(start + i in available for i in range(length)):
+                domain.append(start)
+        return tuple(domain)
+
+    def to_time(self, slot):
+        day, offset = divmod(slot, self.slots_per_day)
+        minutes = offset * self.slot_minutes
+        return day, f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+def _load_teachers():
+    with get_connection() as conn:
+        return dict(conn.execute('SELECT id, teacher_id FROM subjects WHERE tenant_id = ?', (current_tenant(),)))
+
+
+class _State:
+    # Occupazione corrente di studenti, insegnanti e aule slot per slot
+
+    def __init__(self, problem):
+        self.problem = problem
+        self.start = {}
+        self.student = {}
+        self.teacher = {}
+        self.room = {}
+
+    def _cells(self, session, start):
+        for i in range(session.length):
+            slot = start + i
+            yield self.student.setdefault((session.student_id, slot), set())
+            # Le materie senza insegnante non si contendono una cella comune
+            if session.teacher_id is not None:
+                yield self.teacher.setdefault((session.teacher_id, slot), set())
+
+    def conflicts(self, index, start):
+        session = self.problem.sessions[index]
+        found = set()
+        for cell in self._cells(session, start):
+            found |= cell
+        for i in range(session.length):
+            users = self.room.get(start + i, set())
+            overflow = len(users - found) - self.problem.rooms + 1
+            if overflow > 0:
+                found |= set(sorted(users - found)[:overflow])
+        found.discard(index)
+        return found
+
+    def assign(self, index, start):
+        session = self.problem.sessions[index]
+        self.start[index] = start
+        for cell in self._cells(session, start):
+            cell.add(index)
+        for i in range(session.length):
+            self.room.setdefault(start + i, set()).add(index)
+
+    def unassign(self, index):
+        session = self.problem.sessions[index]
+        start = self.start.pop(index)
+        for cell in self._cells(session, start):
+            cell.discard(index)
+        for i in range(session.length):
+            self.room[start + i].discard(index)
+
+    def day_load(self, index, start):
+        # Vincolo morbido: evitare più lezioni dello stesso studente nello stesso giorno
+        session = self.problem.sessions[index]
+        per_day = self.problem.slots_per_day
+        day = start // per_day
+        return sum(1 for slot in range(day * per_day, (day + 1) * per_day)
+                   if self.student.get((session.student_id, slot)))
+
+
+def solve(problem, time_budget=10.0, previous=None, seed=0):
+    # Assegna un inizio a ogni sessione senza sovrapposizioni.
+    # 1. le sessioni della soluzione precedente ancora valide vengono mantenute (risoluzione incrementale);
+    # 2. le altre vengono collocate in ordine di dominio crescente sul primo inizio libero;
+    # 3. le sessioni rimaste vengono inserite con ricerca locale min-conflicts fino allo scadere del tempo.
+    rng = random.Random(seed)
+    started = time.monotonic()
+    state = _State(problem)
+    sessions = problem.sessions
+    previous = previous or {}
+
+    pending = []
+    for index, session in enumerate(sessions):
+        start = previous.get(session.key)
+        if start in session.domain and not state.conflicts(index, start):
+            state.assign(index, start)
+        else:
+            pending.append(index)
+
+    queue = []
+    for index in sorted(pending, key=lambda i: len(sessions[i].domain)):
+        free = [s for s in sessions[index].domain if not state.conflicts(index, s)]
+        if free:
+            state.assign(index, min(free, key=lambda s: (state.day_load(index, s), s)))
+        else:
+            queue.append(index)
+
+    best = dict(state.start)
+    tabu = {}
+    iterations = 0
+    while queue and time.monotonic() - started < time_budget:
+        iterations += 1
+        index = queue.pop(rng.randrange(len(queue)))
+        domain = sessions[index].domain
+        if not domain:
+            continue
+        scored = []
+        for start in domain:
+            penalty = len(state.conflicts(index, start))
+            if tabu.get((index, start), 0) > iterations:
+                penalty += 2
+            scored.append((penalty, rng.random(), start))
+        _, _, start = min(scored)
+        for other in state.conflicts(index, start):
+            state.unassign(other)
+            queue.append(other)
+            tabu[(other, start)] = iterations + 10
+        state.assign(index, start)
+        if len(state.start) > len(best):
+            best = dict(state.start)
+
+    if len(state.start) > len(best):
+        best = dict(state.start)
+    assignments = {sessions[i].key: s for i, s in best.items()}
+    unassigned = [s.key for i, s in enumerate(sessions) if i not in best]
+    return Timetable(assignments, unassigned, time.monotonic() - started, iterations)
+
+
+def rows(problem, timetable):
+    # Righe leggibili della soluzione: (studente, materia, giorno, ora, durata in ore)
+    lengths = {s.key: s.length for s in problem.sessions}
+    result = []
+    for key, start in sorted(timetable.assignments.items(), key=lambda item: item[1]):
+        day, start_time = problem.to_time(start)
+        result.append((key[0], key[1], WEEKDAY_NAMES[day], start_time,
+                       lengths[key] * problem.slot_minutes / 60))
+    return result
+
+
+def load_busy(week_start, slot_minutes=30):
+    # Impegni già presenti nella settimana, da escludere dai domini
+    busy = {}
+    slots_per_day = 24 * 60 // slot_minutes
+    week_start = week_start - timedelta(days=week_start.weekday())
+    week_end = week_start + timedelta(days=6)
+    with get_connection() as conn:
+        for student_id, teacher_id, day, start_time, duration in conn.execute('''
+                SELECT lessons.student_id, subjects.teacher_id, lessons.date, lessons.start_time, lessons.duration
+                FROM lessons JOIN subjects ON lessons.subject_id = subjects.id
+                WHERE lessons.tenant_id = ? AND lessons.date >= ? AND lessons.date <= ?
+                  AND lessons.start_time IS NOT NULL
+                ''', (current_tenant(), week_start.isoformat(), week_end.isoformat())):
+            offset = (date.fromisoformat(day[:10]) - week_start).days * slots_per_day
+            first = offset + to_minutes(start_time) // slot_minutes
+            last = offset + -(-(to_minutes(start_time) + int(duration * 60)) // slot_minutes)
+            for key in (('student', student_id), ('teacher', teacher_id)):
+                busy.setdefault(key, set()).update(range(first, last))
+    return busy
+
+
+def apply_timetable(problem, timetable, week_start, weeks=1, notes=None):
+    # Scrive la soluzione in lessons per le settimane indicate, in un'unica transazione.
+    # week_start deve essere un lunedì. Restituisce (lezioni create, lezioni scartate per conflitto
+    # o perché studente o materia non appartengono al tenant corrente).
+    lengths = {s.key: s.length for s in problem.sessions}
+    week_start = week_start - timedelta(days=week_start.weekday())
+    last_day = week_start + timedelta(weeks=weeks) - timedelta(days=1)
+    lessons = []
+    rejected = []
+    with transaction() as conn:
+        tenant = current_tenant()
+        students = {r[0] for r in conn.execute('SELECT id FROM students WHERE tenant_id = ?', (tenant,))}
+        subjects = {r[0] for r in conn.execute('SELECT id FROM subjects WHERE tenant_id = ?', (tenant,))}
+        checker = BatchChecker(conn, week_start, last_day)
+        for week in range(weeks):
+            for key, start in sorted(timetable.assignments.items(), key=lambda item: item[1]):
+                day, start_time = problem.to_time(start)
+                lesson_date = week_start + timedelta(weeks=week, days=day)
+                duration = lengths[key] * problem.slot_minutes / 60
+                student_id, subject_id, _ = key
+                if student_id not in students or subject_id not in subjects:
+                    rejected.append((key, lesson_date))
+                    continue
+                if checker.check(student_id, subject_id, lesson_date, start_time, duration):
+                    rejected.append((key, lesson_date))
+                    continue
+                lessons.append((student_id, subject_id, lesson_date.isoformat(), format_time(start_time),
+                                duration, notes, tenant))
+        conn.executemany('''INSERT INTO lessons (student_id, subject_id, date, start_time, duration, notes, tenant_id)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''', lessons)
+    query_cache.invalidate('lessons')
+    calendar_data.invalidate()
+    return len(lessons), rejected
+
+
+def problem_from_spec(spec, week_start=None):
+    # Costruisce il problema da un dizionario (ad esempio letto da JSON):
+    # {"slot_minutes": 30, "rooms": 2, "students": {"1": [["Lun", "15:00", "19:00"]]},
+    #  "teachers": {"1": [...]}, "requirements": [{"student_id": 1, "subject_id": 1, "hours": 2}]}
+    slot_minutes = int(spec.get('slot_minutes', 30))
+    busy = load_busy(week_start, slot_minutes) if week_start else None
+    return Problem(spec['students'], spec['requirements'], spec.get('teachers'),
+                   int(spec.get('rooms', 1)), slot_minutes, busy=busy)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pianificazione automatica dell\'orario settimanale')
+    parser.add_argument('spec', help='file JSON con disponibilità, requisiti e aule')
+    parser.add_argument('--week', type=date.fromisoformat,
+                        help='lunedì della prima settimana (tiene conto delle lezioni esistenti)')
+    parser.add_argument('--weeks', type=int, default=1)
+    parser.add_argument('--budget', type=float, default=10.0, help='tempo massimo in secondi')
+    parser.add_argument('--apply', action='store_true', help='scrive le lezioni nel database')
+    args = parser.parse_args()
+
+    from database import init_db
+    init_db()
+
+    with open(args.spec, encoding='utf-8') as f:
+        problem = problem_from_spec(json.load(f), args.week)
+    timetable = solve(problem, args.budget)
+    for student_id, subject_id, day, start_time, hours in rows(problem, timetable):
+        print(f"studente {student_id}\tmateria {subject_id}\t{day} {start_time}\t{hours:g} ore")
+    print(f"Sessioni collocate: {len(timetable.assignments)}, non collocate: {len(timetable.unassigned)} "
+          f"({timetable.elapsed:.2f}s, {timetable.iterations} iterazioni)")
+
+    if args.apply:
+        if not args.week:
+            parser.error('--apply richiede --week')
+        created, rejected = apply_timetable(problem, timetable, args.week, args.weeks)
+        print(f"Lezioni create: {created}, scartate (conflitti o riferimenti non validi): {len(rejected)}")
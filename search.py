@@ -0,0 +1,100 @@
+import argparse
+import re
+
+import pandas as pd
+
+import query_cache
+from connection import get_connection, transaction
+from reports import date_bounds
+from tenancy import current_tenant
+
+PAGE_SIZE = 20
+
+# Pesi bm25 delle colonne di lessons_fts (note, studente, materia): una corrispondenza
+# nel nome dello studente o della materia conta più di una parola nelle note
+WEIGHTS = (1.0, 2.0, 2.0)
+
+# Delimitatori dei termini trovati, interpretati come grassetto da st.markdown
+HIGHLIGHT = ('**', '**')
+
+_COLUMNS = ['id', 'date', 'start_time', 'studente', 'materia', 'duration', 'notes', 'student_id', 'subject_id']
+
+
+def match_query(text):
+    # Converte il testo digitato in una query FTS5: ogni parola diventa un prefisso tra
+    # virgolette (nessun operatore interpretato), tutte le parole devono essere presenti
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text or ''))
+
+
+@query_cache.cached('lessons', 'students', 'subjects')
+def search_lessons(text, start=None, end=None, student_id=None, page=0, page_size=PAGE_SIZE):
+    # Lezioni che contengono il testo nelle note, nel nome dello studente o della materia,
+    # dalla più pertinente. Restituisce (DataFrame della pagina, esiste una pagina successiva).
+    # L'ordinamento per rank richiede comunque di valutare tutte le corrispondenze, quindi la
+    # paginazione usa OFFSET invece di un cursore come pagination.fetch_page.
+    match = match_query(text)
+    if not match:
+        return pd.DataFrame(columns=_COLUMNS + ['rank']), False
+
+    before, after = HIGHLIGHT
+    query = f'''
+        SELECT lessons.id, lessons.date, lessons.start_time,
+               highlight(lessons_fts, 1, ?, ?) as studente, highlight(lessons_fts, 2, ?, ?) as materia,
+               lessons.duration, snippet(lessons_fts, 0, ?, ?, '…', 24) as notes,
+               lessons.student_id, lessons.subject_id, bm25(lessons_fts, {', '.join(map(str, WEIGHTS))}) as rank
+        FROM lessons_fts
+        JOIN lessons ON lessons.id = lessons_fts.rowid
+        WHERE lessons_fts MATCH ? AND lessons.tenant_id = ?
+    '''
+    params = [before, after, before, after, before, after, match, current_tenant()]
+    if start is not None and end is not None:
+        query += ' AND lessons.date >= ? AND lessons.date < ?'
+        params.extend(date_bounds(start, end))
+    if student_id is not None:
+        query += ' AND lessons.student_id = ?'
+        params.append(int(student_id))
+    # Una riga in più per sapere se esiste una pagina successiva
+    query += ' ORDER BY rank, lessons.id LIMIT ? OFFSET ?'
+    params.extend([page_size + 1, page * page_size])
+
+    with get_connection() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+    has_more = len(df) > page_size
+    df = df.iloc[:page_size].copy()
+    df['date'] = pd.to_datetime(df['date'])
+    return df, has_more
+
+
+def rebuild():
+    # Ricostruisce l'indice dalle tabelle (ad esempio dopo modifiche fatte senza trigger);
+    # restituisce il numero di lezioni indicizzate
+    with transaction() as conn:
+        conn.execute('DELETE FROM lessons_fts')
+        conn.execute('''INSERT INTO lessons_fts (rowid, notes, student, subject)
+                        SELECT lessons.id, lessons.notes, students.name, subjects.name
+                        FROM lessons
+                        JOIN students ON lessons.student_id = students.id
+                        JOIN subjects ON lessons.subject_id = subjects.id''')
+        conn.execute("INSERT INTO lessons_fts (lessons_fts) VALUES ('optimize')")
+        count = conn.execute('SELECT COUNT(*) FROM lessons_fts').fetchone()[0]
+    query_cache.invalidate('lessons')
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ricerca testuale sulle lezioni')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('rebuild', help="ricostruisce l'indice")
+    find = subparsers.add_parser('find', help='cerca nelle lezioni')
+    find.add_argument('text')
+    args = parser.parse_args()
+
+    from database import init_db
+    init_db()
+
+    if args.command == 'rebuild':
+        print(f"Indice ricostruito: {rebuild()} lezioni")
+    else:
+        results, _ = search_lessons(args.text)
+        for row in results.itertuples():
+            print(f"{row.date:%d/%m/%Y} {row.studente} - {row.materia}: {row.notes}")
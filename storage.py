@@ -0,0 +1,719 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+import calendar_data
+import connection
+import database
+import pagination
+import query_cache
+import recurrence
+import reports
+from auth import LOCKED_PASSWORD, dummy_verify, hash_password, login_throttle, verify_password
+from conflicts import BatchChecker, Conflict, describe, format_time, to_minutes
+from tenancy import current_tenant
+
+# Archivio dei dati del planner dietro un'interfaccia comune (Repository), con due implementazioni:
+# SQLite, che usa i moduli esistenti, e PostgreSQL, per più server applicativi che condividono
+# gli stessi dati senza il lock di scrittura unico di SQLite. Le firme e i valori restituiti sono
+# quelli di database.py, reports.py e pagination.py: le due implementazioni passano la stessa
+# verifica (conformance.py). L'API e l'interfaccia usano get_repository(); l'interfaccia
+# Streamlit richiede comunque SQLite per calendario, ricerca, serie e fatturazione.
+STORAGE = os.environ.get('PLANNER_STORAGE', 'sqlite')
+PG_DSN = os.environ.get('PLANNER_PG_DSN', '')
+PG_POOL_MIN = int(os.environ.get('PLANNER_PG_POOL_MIN', '1'))
+PG_POOL_MAX = int(os.environ.get('PLANNER_PG_POOL_MAX', '10'))
+
+BACKENDS = ('sqlite', 'postgres')
+
+_DETAIL_COLUMNS = ['id', 'date', 'start_time', 'studente', 'materia', 'duration', 'costo', 'notes',
+                   'student_id', 'subject_id']
+
+
+class Repository(ABC):
+    # Operazioni su studenti, materie, lezioni e report, filtrate sul tenant corrente. Un archivio
+    # a cui manca un'operazione non può essere istanziato.
+
+    # Funzioni dell'applicazione che leggono direttamente SQLite e quindi non usano questo
+    # archivio (elencate da conformance.py check)
+    UNAVAILABLE = ()
+
+    @abstractmethod
+    def add_student(self, name, email, hourly_cost):
+        pass
+
+    @abstractmethod
+    def get_student(self, student_id):
+        pass
+
+    @abstractmethod
+    def update_student(self, student_id, name, email, hourly_cost):
+        pass
+
+    @abstractmethod
+    def delete_student(self, student_id):
+        pass
+
+    @abstractmethod
+    def add_subject(self, name, teacher_id):
+        pass
+
+    @abstractmethod
+    def get_subject(self, subject_id):
+        pass
+
+    @abstractmethod
+    def update_subject(self, subject_id, name, teacher_id):
+        pass
+
+    @abstractmethod
+    def delete_subject(self, subject_id):
+        pass
+
+    @abstractmethod
+    def add_lesson(self, student_id, subject_id, date, duration, notes, start_time=None):
+        pass
+
+    @abstractmethod
+    def get_lesson(self, lesson_id):
+        pass
+
+    @abstractmethod
+    def update_lesson(self, lesson_id, student_id, subject_id, date, duration, notes, start_time=None):
+        pass
+
+    @abstractmethod
+    def delete_lesson(self, lesson_id):
+        pass
+
+    @abstractmethod
+    def add_series(self, student_id, subject_id, start_date, weekdays, duration, notes,
+                   interval_weeks=1, end_date=None, start_time=None):
+        pass
+
+    @abstractmethod
+    def add_exception(self, series_id, day):
+        pass
+
+    @abstractmethod
+    def get_lessons_in_range(self, start, end, student_id=None):
+        pass
+
+    @abstractmethod
+    def get_report_totals(self, start, end, period, student_id=None):
+        pass
+
+    @abstractmethod
+    def fetch_page(self, table, sort, descending=False, search=None, after=None, limit=25):
+        pass
+
+    @abstractmethod
+    def authenticate_user(self, username, password):
+        pass
+
+    @abstractmethod
+    def create_teacher(self, username, password, tenant_id=None):
+        pass
+
+    @abstractmethod
+    def is_teacher(self, user_id):
+        pass
+
+    def clear_cache(self):
+        # Svuota le cache applicative, per misurare le letture a freddo
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteRepository(Repository):
+    # Il database SQLite dell'applicazione (connection.DB_PATH e shard dei tenant), con cache,
+    # journal e account degli studenti come nel resto del codice
+
+    def __init__(self):
+        database.init_db()
+
+    def add_student(self, name, email, hourly_cost):
+        return database.add_student(name, email, hourly_cost)
+
+    def get_student(self, student_id):
+        return database.get_student(student_id)
+
+    def update_student(self, student_id, name, email, hourly_cost):
+        return database.update_student(student_id, name, email, hourly_cost)
+
+    def delete_student(self, student_id):
+        return database.delete_student(student_id)
+
+    def add_subject(self, name, teacher_id):
+        return database.add_subject(name, teacher_id)
+
+    def get_subject(self, subject_id):
+        return database.get_subject(subject_id)
+
+    def update_subject(self, subject_id, name, teacher_id):
+        return database.update_subject(subject_id, name, teacher_id)
+
+    def delete_subject(self, subject_id):
+        return database.delete_subject(subject_id)
+
+    def add_lesson(self, student_id, subject_id, date, duration, notes, start_time=None):
+        return database.add_lesson(student_id, subject_id, date, duration, notes, start_time)
+
+    def get_lesson(self, lesson_id):
+        return database.get_lesson(lesson_id)
+
+    def update_lesson(self, lesson_id, student_id, subject_id, date, duration, notes, start_time=None):
+        return database.update_lesson(lesson_id, student_id, subject_id, date, duration, notes, start_time)
+
+    def delete_lesson(self, lesson_id):
+        return database.delete_lesson(lesson_id)
+
+    def add_series(self, student_id, subject_id, start_date, weekdays, duration, notes,
+                   interval_weeks=1, end_date=None, start_time=None):
+        # Studente e materia verificati nella stessa transazione in cui viene creata la serie
+        with connection.transaction() as conn:
+            database.check_references(conn, student_id, subject_id)
+            return recurrence.add_series(student_id, subject_id, start_date, weekdays, duration, notes,
+                                         interval_weeks, end_date, start_time)
+
+    def add_exception(self, series_id, day):
+        return recurrence.add_exception(series_id, day)
+
+    def get_lessons_in_range(self, start, end, student_id=None):
+        return reports.get_lessons_in_range(start, end, student_id)
+
+    def get_report_totals(self, start, end, period, student_id=None):
+        return reports.get_report_totals(start, end, period, student_id)
+
+    def fetch_page(self, table, sort, descending=False, search=None, after=None, limit=25):
+        return pagination.fetch_page(table, sort, descending, search, after, limit)
+
+    def authenticate_user(self, username, password):
+        return database.authenticate_user(username, password)
+
+    def create_teacher(self, username, password, tenant_id=None):
+        return database.create_teacher(username, password, tenant_id)
+
+    def is_teacher(self, user_id):
+        return database.is_teacher(user_id)
+
+    def clear_cache(self):
+        query_cache.clear()
+        calendar_data.invalidate()
+
+    def close(self):
+        connection.close_all()
+
+
+# Schema PostgreSQL: stesse colonne delle tabelle SQLite, con date come DATE e orari come testo
+# 'HH:MM'. Anche gli account sono qui, così tutti i server vedono gli stessi utenti; teacher_id
+# non ha un vincolo di chiave esterna, come in SQLite dove le chiavi esterne non sono attive.
+_PG_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS users
+       (id BIGSERIAL PRIMARY KEY,
+        username TEXT NOT NULL,
+        password TEXT NOT NULL,
+        role TEXT NOT NULL,
+        student_id BIGINT,
+        tenant_id INTEGER NOT NULL DEFAULT 1)''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_users_tenant_student ON users (tenant_id, student_id)',
+    # Username ed email sono unici nel tenant; i vincoli globali delle prime versioni vengono rimossi
+    'ALTER TABLE users DROP CONSTRAINT IF EXISTS users_username_key',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_users_tenant_username ON users (tenant_id, username)',
+    'CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)',
+    '''CREATE TABLE IF NOT EXISTS students
+       (id BIGSERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        email TEXT NOT NULL,
+        hourly_cost DOUBLE PRECISION NOT NULL,
+        tenant_id INTEGER NOT NULL DEFAULT 1)''',
+    'ALTER TABLE students DROP CONSTRAINT IF EXISTS students_email_key',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_students_tenant_email ON students (tenant_id, email)',
+    '''CREATE TABLE IF NOT EXISTS subjects
+       (id BIGSERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        teacher_id INTEGER NOT NULL,
+        tenant_id INTEGER NOT NULL DEFAULT 1)''',
+    '''CREATE TABLE IF NOT EXISTS lessons
+       (id BIGSERIAL PRIMARY KEY,
+        student_id BIGINT NOT NULL REFERENCES students(id),
+        subject_id BIGINT NOT NULL REFERENCES subjects(id),
+        date DATE NOT NULL,
+        start_time TEXT,
+        duration DOUBLE PRECISION NOT NULL,
+        notes TEXT,
+        tenant_id INTEGER NOT NULL DEFAULT 1)''',
+    # Le serie non vengono materializzate in lessons: le ripetizioni sono generate a ogni lettura
+    '''CREATE TABLE IF NOT EXISTS lesson_series
+       (id BIGSERIAL PRIMARY KEY,
+        student_id BIGINT NOT NULL,
+        subject_id BIGINT NOT NULL,
+        start_date DATE NOT NULL,
+        end_date DATE,
+        weekdays TEXT NOT NULL,
+        interval_weeks INTEGER NOT NULL DEFAULT 1,
+        duration DOUBLE PRECISION NOT NULL,
+        notes TEXT,
+        start_time TEXT,
+        tenant_id INTEGER NOT NULL DEFAULT 1)''',
+    '''CREATE TABLE IF NOT EXISTS lesson_series_exceptions
+       (series_id BIGINT NOT NULL,
+        date DATE NOT NULL,
+        PRIMARY KEY(series_id, date))''',
+    'CREATE INDEX IF NOT EXISTS idx_series_tenant_period ON lesson_series (tenant_id, start_date, end_date)',
+    'CREATE INDEX IF NOT EXISTS idx_lessons_tenant_date ON lessons (tenant_id, date)',
+    'CREATE INDEX IF NOT EXISTS idx_lessons_student_date ON lessons (student_id, date)',
+    'CREATE INDEX IF NOT EXISTS idx_lessons_subject_date ON lessons (subject_id, date)',
+    'CREATE INDEX IF NOT EXISTS idx_subjects_tenant_teacher ON subjects (tenant_id, teacher_id)',
+]
+
+# Etichette dei periodi come in reports.PERIODS: giorno, lunedì di fine settimana, fine mese
+_PG_PERIODS = {
+    'Giornaliero': 'lessons.date',
+    'Settimanale': 'lessons.date + MOD(8 - EXTRACT(ISODOW FROM lessons.date)::int, 7)',
+    'Mensile': "(date_trunc('month', lessons.date) + interval '1 month - 1 day')::date",
+}
+
+_PG_MINUTES = "(split_part({0}, ':', 1)::int * 60 + split_part({0}, ':', 2)::int)"
+
+_PG_LESSONS_FROM = '''
+    FROM lessons
+    JOIN students ON lessons.student_id = students.id
+    JOIN subjects ON lessons.subject_id = subjects.id
+    WHERE lessons.tenant_id = %s AND lessons.date >= %s AND lessons.date <= %s
+'''
+
+
+# Colonne di recurrence.get_series_lessons_in_range
+_SERIES_COLUMNS = ['date', 'studente', 'materia', 'duration', 'costo', 'notes', 'student_id', 'subject_id',
+                   'series_id', 'start_time']
+
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _row(cursor):
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    row = dict(zip([column.name for column in cursor.description], row))
+    if isinstance(row.get('date'), date):
+        row['date'] = row['date'].isoformat()
+    return row
+
+
+class PostgresRepository(Repository):
+    # Archivio PostgreSQL con un pool di connessioni condiviso dai thread del processo.
+    # La verifica dei conflitti e l'inserimento avvengono nella stessa transazione, sotto un
+    # advisory lock per (tenant, giorno): due server che programmano lo stesso giorno non
+    # possono entrambi superare la verifica.
+
+    UNAVAILABLE = (
+        "interfaccia Streamlit (app.py): calendario, ricerca, gestione delle serie, fatturazione, "
+        "registro delle modifiche e attività in background",
+        "importazione massiva da file (bulk_import.py); l'API /batch inserisce le righe una alla volta",
+        "pianificazione automatica (scheduler.py)",
+        "materializzazione ed eliminazione delle serie (recurrence.py)",
+    )
+
+    def __init__(self, dsn=None, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX, schema=None):
+        try:
+            import psycopg
+            from psycopg_pool import ConnectionPool
+        except ImportError:
+            raise RuntimeError("Per usare PostgreSQL è necessario installare psycopg[pool]")
+        self._errors = psycopg
+        dsn = dsn or PG_DSN
+        if not dsn:
+            raise RuntimeError("PLANNER_PG_DSN non impostata")
+
+        if schema:
+            with psycopg.connect(dsn, autocommit=True) as conn:
+                conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+        kwargs = {'options': f'-c search_path="{schema}"'} if schema else {}
+        self.pool = ConnectionPool(dsn, min_size=min_size, max_size=max_size, kwargs=kwargs, open=True)
+        with self.pool.connection() as conn:
+            # Più processi possono avviarsi insieme: lo schema viene creato da uno solo
+            conn.execute('SELECT pg_advisory_xact_lock(0)')
+            for statement in _PG_SCHEMA:
+                conn.execute(statement)
+            # Utente admin di default (tenant 1), come init_db()
+            if conn.execute("SELECT 1 FROM users WHERE username='admin' AND tenant_id=1").fetchone() is None:
+                conn.execute("INSERT INTO users (username, password, role) VALUES ('admin', %s, 'insegnante')",
+                             (hash_password('admin'),))
+
+    def _fetch(self, query, params):
+        with self.pool.connection() as conn:
+            return _row(conn.execute(query, params))
+
+    def add_student(self, name, email, hourly_cost):
+        # Come database.add_student: lo studente riceve un account con password bloccata, o viene
+        # collegato a quello esistente con la stessa email, nella stessa transazione. Se lo username
+        # è già usato da un altro account del tenant lo studente non viene creato.
+        tenant = current_tenant()
+        try:
+            with self.pool.connection() as conn:
+                student_id = conn.execute('INSERT INTO students (name, email, hourly_cost, tenant_id) '
+                                          'VALUES (%s, %s, %s, %s) RETURNING id',
+                                          (name, email, hourly_cost, tenant)).fetchone()[0]
+                conn.execute('''UPDATE users SET student_id = %s
+                                WHERE username = %s AND tenant_id = %s AND student_id IS NULL
+                                  AND role != 'insegnante' ''', (student_id, email, tenant))
+                conn.execute('''INSERT INTO users (username, password, role, student_id, tenant_id)
+                                SELECT %s, %s, 'studente', %s, %s
+                                WHERE NOT EXISTS (SELECT 1 FROM users WHERE tenant_id = %s AND student_id = %s)''',
+                             (email, LOCKED_PASSWORD, student_id, tenant, tenant, student_id))
+            return student_id
+        except self._errors.IntegrityError:
+            return False
+
+    def get_student(self, student_id):
+        return self._fetch('SELECT * FROM students WHERE id=%s AND tenant_id=%s', (student_id, current_tenant()))
+
+    def update_student(self, student_id, name, email, hourly_cost):
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('UPDATE students SET name=%s, email=%s, hourly_cost=%s WHERE id=%s AND tenant_id=%s',
+                             (name, email, hourly_cost, student_id, current_tenant()))
+            return True
+        except self._errors.IntegrityError:
+            return False
+
+    def _delete_unused(self, table, column, item_id, label, cleanup=None):
+        # Elimina la riga solo se non ha lezioni, con un solo DELETE. Una lezione inserita da un
+        # altro server nel frattempo fa fallire la chiave esterna: anche questo caso viene
+        # riportato come lezioni associate. cleanup(conn) completa l'eliminazione nella stessa transazione.
+        tenant = current_tenant()
+        try:
+            with self.pool.connection() as conn:
+                deleted = conn.execute(f'''DELETE FROM {table} WHERE id=%s AND tenant_id=%s
+                                           AND NOT EXISTS (SELECT 1 FROM lessons WHERE {column}=%s)''',
+                                       (item_id, tenant, item_id)).rowcount
+                if deleted and cleanup:
+                    cleanup(conn)
+        except self._errors.IntegrityError:
+            deleted = 0
+        if not deleted:
+            with self.pool.connection() as conn:
+                count = conn.execute(f'SELECT COUNT(*) FROM lessons WHERE {column}=%s AND tenant_id=%s',
+                                     (item_id, tenant)).fetchone()[0]
+            if count > 0:
+                return False, f"Impossibile eliminare {label}: ci sono {count} lezioni associate"
+        return True, None
+
+    def delete_student(self, student_id):
+        # Insieme allo studente viene eliminato il suo account
+        ok, message = self._delete_unused(
+            'students', 'student_id', student_id, 'lo studente',
+            lambda conn: conn.execute('DELETE FROM users WHERE tenant_id=%s AND student_id=%s',
+                                      (current_tenant(), student_id)))
+        return ok, message or "Studente eliminato con successo"
+
+    def add_subject(self, name, teacher_id):
+        with self.pool.connection() as conn:
+            return conn.execute('INSERT INTO subjects (name, teacher_id, tenant_id) VALUES (%s, %s, %s) RETURNING id',
+                                (name, teacher_id, current_tenant())).fetchone()[0]
+
+    def get_subject(self, subject_id):
+        return self._fetch('SELECT * FROM subjects WHERE id=%s AND tenant_id=%s', (subject_id, current_tenant()))
+
+    def update_subject(self, subject_id, name, teacher_id):
+        try:
+            with self.pool.connection() as conn:
+                conn.execute('UPDATE subjects SET name=%s, teacher_id=%s WHERE id=%s AND tenant_id=%s',
+                             (name, teacher_id, subject_id, current_tenant()))
+            return True
+        except self._errors.Error:
+            return False
+
+    def delete_subject(self, subject_id):
+        ok, message = self._delete_unused('subjects', 'subject_id', subject_id, 'la materia')
+        return ok, message or "Materia eliminata con successo"
+
+    def _check_references(self, conn, student_id, subject_id):
+        tenant = current_tenant()
+        if conn.execute('SELECT 1 FROM students WHERE id=%s AND tenant_id=%s',
+                        (int(student_id), tenant)).fetchone() is None:
+            raise ValueError(f"Studente inesistente: {student_id}")
+        if conn.execute('SELECT 1 FROM subjects WHERE id=%s AND tenant_id=%s',
+                        (int(subject_id), tenant)).fetchone() is None:
+            raise ValueError(f"Materia inesistente: {subject_id}")
+
+    def _conflicts(self, conn, student_id, subject_id, day, start_time, duration, exclude_lesson_id=None):
+        # Lezioni dello studente o dell'insegnante della materia che si sovrappongono, con
+        # l'intervallo confrontato direttamente in SQL
+        start = to_minutes(start_time)
+        if start is None:
+            return []
+        tenant = current_tenant()
+        conn.execute('SELECT pg_advisory_xact_lock(%s, %s)', (tenant, day.toordinal()))
+        minutes = _PG_MINUTES.format('lessons.start_time')
+        rows = conn.execute(f'''
+            SELECT CASE WHEN lessons.student_id = %s THEN 'student' ELSE 'teacher' END,
+                   lessons.id, lessons.date, lessons.start_time, lessons.duration, students.name, subjects.name
+            FROM lessons
+            JOIN students ON lessons.student_id = students.id
+            JOIN subjects ON lessons.subject_id = subjects.id
+            WHERE lessons.tenant_id = %s AND lessons.date = %s AND lessons.start_time IS NOT NULL
+              AND lessons.id IS DISTINCT FROM %s
+              AND (lessons.student_id = %s OR lessons.subject_id IN (
+                       SELECT id FROM subjects
+                       WHERE tenant_id = %s AND teacher_id = (SELECT teacher_id FROM subjects WHERE id = %s)))
+              AND {minutes} < %s AND {minutes} + lessons.duration * 60 > %s
+            ORDER BY lessons.student_id = %s DESC, lessons.start_time, lessons.id
+        ''', (int(student_id), tenant, day, exclude_lesson_id, int(student_id), tenant, int(subject_id),
+              start + duration * 60, start, int(student_id))).fetchall()
+        conflicts = [Conflict(kind, lesson_id, lesson_date.isoformat(), lesson_start, lesson_duration, student, subject)
+                     for kind, lesson_id, lesson_date, lesson_start, lesson_duration, student, subject in rows]
+
+        # Ripetizioni delle serie nello stesso giorno, come conflicts.find_conflicts
+        teacher_of = self._teachers(conn)
+        teacher = teacher_of.get(int(subject_id))
+        for (_, student, subject, s_duration, _, _, s_student, s_subject, _,
+             s_start) in self._series(conn, day, day):
+            s_minutes = to_minutes(s_start)
+            if s_minutes is None or not (s_minutes < start + duration * 60 and s_minutes + s_duration * 60 > start):
+                continue
+            if s_student == int(student_id):
+                kind = 'student'
+            elif teacher is not None and teacher_of.get(s_subject) == teacher:
+                kind = 'teacher'
+            else:
+                continue
+            conflicts.append(Conflict(kind, None, day.isoformat(), s_start, s_duration, student, subject))
+        return conflicts
+
+    def _teachers(self, conn):
+        return dict(conn.execute('SELECT id, teacher_id FROM subjects WHERE tenant_id = %s',
+                                 (current_tenant(),)).fetchall())
+
+    def _series(self, conn, start, end, student_id=None):
+        # Ripetizioni delle serie nel periodo [start, end], con le colonne di recurrence.expand
+        start, end = _day(start), _day(end)
+        query = '''
+            SELECT lesson_series.id, lesson_series.student_id, lesson_series.subject_id, start_date, end_date,
+                   weekdays, interval_weeks, duration, notes, students.name, subjects.name, students.hourly_cost,
+                   lesson_series.start_time
+            FROM lesson_series
+            JOIN students ON lesson_series.student_id = students.id
+            JOIN subjects ON lesson_series.subject_id = subjects.id
+            WHERE lesson_series.tenant_id = %s AND start_date <= %s AND (end_date IS NULL OR end_date >= %s)
+        '''
+        params = [current_tenant(), end, start]
+        if student_id is not None:
+            query += ' AND lesson_series.student_id = %s'
+            params.append(int(student_id))
+        series = conn.execute(query, params).fetchall()
+        exceptions = {}
+        if series:
+            for series_id, day in conn.execute(
+                    '''SELECT series_id, date FROM lesson_series_exceptions
+                       WHERE series_id = ANY(%s) AND date >= %s AND date <= %s''',
+                    ([s[0] for s in series], start, end)):
+                exceptions.setdefault(series_id, set()).add(day)
+        rows = []
+        for (series_id, s_student, s_subject, s_start, s_end, weekdays, interval, duration, notes,
+             student_name, subject_name, hourly_cost, start_time) in series:
+            for day in recurrence.occurrences(s_start, [int(d) for d in weekdays.split(',') if d != ''], interval,
+                                              start, end, s_end, exceptions.get(series_id, ())):
+                rows.append((day, student_name, subject_name, duration, duration * hourly_cost, notes,
+                             s_student, s_subject, series_id, start_time))
+        return rows
+
+    def add_lesson(self, student_id, subject_id, date, duration, notes, start_time=None):
+        start_time = format_time(start_time)
+        day = _day(date)
+        with self.pool.connection() as conn:
+            self._check_references(conn, student_id, subject_id)
+            conflicts = self._conflicts(conn, student_id, subject_id, day, start_time, duration)
+            if conflicts:
+                return False, describe(conflicts[0])
+            conn.execute('''INSERT INTO lessons (student_id, subject_id, date, start_time, duration, notes, tenant_id)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s)''',
+                         (student_id, subject_id, day, start_time, duration, notes, current_tenant()))
+        return True, "Lezione programmata con successo!"
+
+    def get_lesson(self, lesson_id):
+        return self._fetch('SELECT * FROM lessons WHERE id=%s AND tenant_id=%s', (lesson_id, current_tenant()))
+
+    def update_lesson(self, lesson_id, student_id, subject_id, date, duration, notes, start_time=None):
+        start_time = format_time(start_time)
+        day = _day(date)
+        try:
+            with self.pool.connection() as conn:
+                self._check_references(conn, student_id, subject_id)
+                conflicts = self._conflicts(conn, student_id, subject_id, day, start_time, duration,
+                                            exclude_lesson_id=lesson_id)
+                if conflicts:
+                    return False, describe(conflicts[0])
+                conn.execute('''UPDATE lessons SET student_id=%s, subject_id=%s, date=%s, start_time=%s, duration=%s,
+                                notes=%s WHERE id=%s AND tenant_id=%s''',
+                             (student_id, subject_id, day, start_time, duration, notes, lesson_id, current_tenant()))
+            return True, "Lezione aggiornata con successo"
+        except self._errors.Error:
+            return False, "Errore durante l'aggiornamento della lezione"
+
+    def delete_lesson(self, lesson_id):
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM lessons WHERE id=%s AND tenant_id=%s', (lesson_id, current_tenant()))
+        return True, "Lezione eliminata con successo"
+
+    def add_series(self, student_id, subject_id, start_date, weekdays, duration, notes,
+                   interval_weeks=1, end_date=None, start_time=None):
+        # Come recurrence.add_series: nessuna ripetizione (entro la data di fine o l'orizzonte)
+        # deve sovrapporsi a lezioni o ad altre serie. I giorni interessati vengono bloccati con
+        # gli stessi advisory lock di add_lesson.
+        start_time = format_time(start_time)
+        weekdays = sorted(int(d) for d in weekdays)
+        start_date = _day(start_date)
+        end_date = _day(end_date) if end_date else None
+        tenant = current_tenant()
+        with self.pool.connection() as conn:
+            self._check_references(conn, student_id, subject_id)
+            if start_time is not None:
+                last = end_date or start_date + timedelta(days=recurrence.CONFLICT_HORIZON_DAYS)
+                days = list(recurrence.occurrences(start_date, weekdays, interval_weeks, start_date, last))
+                conn.execute('SELECT pg_advisory_xact_lock(%s, day) FROM unnest(%s::int[]) AS day ORDER BY day',
+                             (tenant, [day.toordinal() for day in days]))
+                busy = conn.execute('''SELECT student_id, subject_id, date, start_time, duration FROM lessons
+                                       WHERE tenant_id = %s AND date >= %s AND date <= %s
+                                         AND start_time IS NOT NULL''', (tenant, start_date, last)).fetchall()
+                busy += [(row[6], row[7], row[0], row[9], row[3]) for row in self._series(conn, start_date, last)]
+                checker = BatchChecker.from_busy(self._teachers(conn), busy)
+                for day in days:
+                    if checker.check(student_id, subject_id, day, start_time, duration):
+                        return False, f"Conflitto di orario il {day.strftime('%d/%m/%Y')} alle {start_time}"
+            conn.execute('''INSERT INTO lesson_series
+                            (student_id, subject_id, start_date, end_date, weekdays, interval_weeks, duration, notes,
+                             start_time, tenant_id)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''',
+                         (student_id, subject_id, start_date, end_date, ','.join(str(d) for d in weekdays),
+                          interval_weeks, duration, notes, start_time, tenant))
+        return True, "Serie creata con successo"
+
+    def add_exception(self, series_id, day):
+        with self.pool.connection() as conn:
+            conn.execute('''INSERT INTO lesson_series_exceptions (series_id, date)
+                            SELECT id, %s FROM lesson_series WHERE id = %s AND tenant_id = %s
+                            ON CONFLICT DO NOTHING''', (_day(day), series_id, current_tenant()))
+
+    def _window(self, start, end, student_id):
+        query = _PG_LESSONS_FROM
+        params = [current_tenant(), _day(start), _day(end)]
+        if student_id is not None:
+            query += '    AND lessons.student_id = %s\n'
+            params.append(int(student_id))
+        return query, params
+
+    def get_lessons_in_range(self, start, end, student_id=None):
+        where, params = self._window(start, end, student_id)
+        query = '''
+            SELECT lessons.id, lessons.date, lessons.start_time, students.name, subjects.name, duration,
+                   duration * students.hourly_cost, notes, lessons.student_id, lessons.subject_id
+        ''' + where + '    ORDER BY lessons.date, lessons.start_time NULLS FIRST, lessons.id'
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        df = pd.DataFrame(rows, columns=_DETAIL_COLUMNS)
+        df['date'] = pd.to_datetime(df['date'])
+        return df
+
+    def get_report_totals(self, start, end, period, student_id=None):
+        bucket = _PG_PERIODS[period]
+        where, params = self._window(start, end, student_id)
+        query = f'''
+            SELECT {bucket} AS date, SUM(duration), SUM(duration * students.hourly_cost), COUNT(*)
+        ''' + where + '    GROUP BY 1 ORDER BY 1'
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+            series = self._series(conn, start, end, student_id)
+        grouped = pd.DataFrame(rows, columns=['date', 'duration', 'costo', 'lezioni'])
+        grouped['date'] = pd.to_datetime(grouped['date'])
+        grouped = grouped.astype({'duration': float, 'costo': float, 'lezioni': int}).set_index('date')
+
+        # Ripetizioni delle serie aggregate a parte, come in reports.get_report_totals
+        if series:
+            series = pd.DataFrame(series, columns=_SERIES_COLUMNS)
+            series['date'] = pd.to_datetime(series['date'])
+            grouped = grouped.add(reports.aggregate_lessons_pandas(series, period), fill_value=0)
+            grouped = grouped[grouped['lezioni'] > 0].astype({'lezioni': int})
+        return reports.fill_buckets(grouped, period)
+
+    def fetch_page(self, table, sort, descending=False, search=None, after=None, limit=25):
+        # Stesse query di pagination.py, con i segnaposto di psycopg e la ricerca senza maiuscole
+        query, params = pagination.page_query(table, sort, descending, search, after, limit,
+                                              placeholder='%s', like='ILIKE')
+        with self.pool.connection() as conn:
+            cursor = conn.execute(query, params)
+            columns = [column.name for column in cursor.description]
+            rows = [tuple(value.isoformat() if isinstance(value, date) else value for value in row)
+                    for row in cursor.fetchall()]
+        return pagination.page_result(table, sort, columns, rows, limit)
+
+    def authenticate_user(self, username, password):
+        # Come database.authenticate_user: (id, ruolo, id dello studente, tenant) oppure None
+        if login_throttle.retry_after(username):
+            return None
+        with self.pool.connection() as conn:
+            users = conn.execute('SELECT id, role, student_id, tenant_id, password FROM users WHERE username=%s '
+                                 'ORDER BY id', (username,)).fetchall()
+        if not users:
+            dummy_verify(password)
+            login_throttle.failure(username)
+            return None
+        for user_id, role, student_id, tenant_id, stored in users:
+            valid, needs_update = verify_password(password, stored)
+            if valid:
+                break
+        else:
+            login_throttle.failure(username)
+            return None
+        login_throttle.success(username)
+        if needs_update:
+            with self.pool.connection() as conn:
+                conn.execute('UPDATE users SET password=%s WHERE id=%s', (hash_password(password), user_id))
+        return user_id, role, student_id, tenant_id
+
+    def create_teacher(self, username, password, tenant_id=None):
+        try:
+            with self.pool.connection() as conn:
+                if tenant_id is None:
+                    # Il lock evita che due server assegnino lo stesso nuovo tenant
+                    conn.execute('LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE')
+                    tenant_id = conn.execute('SELECT COALESCE(MAX(tenant_id), 0) + 1 FROM users').fetchone()[0]
+                conn.execute("INSERT INTO users (username, password, role, tenant_id) VALUES (%s, %s, 'insegnante', %s)",
+                             (username, hash_password(password), tenant_id))
+            return True, f"Insegnante {username} creato nel tenant {tenant_id}"
+        except self._errors.IntegrityError:
+            return False, "Username già esistente"
+
+    def is_teacher(self, user_id):
+        return self._fetch("SELECT 1 AS found FROM users WHERE id=%s AND tenant_id=%s AND role='insegnante'",
+                           (user_id, current_tenant())) is not None
+
+    def close(self):
+        self.pool.close()
+
+
+_repository = None
+_lock = threading.Lock()
+
+
+def get_repository():
+    # Archivio scelto con PLANNER_STORAGE ('sqlite' o 'postgres'), condiviso dal processo
+    global _repository
+    with _lock:
+        if _repository is None:
+            if STORAGE not in BACKENDS:
+                raise ValueError(f"Archivio sconosciuto: {STORAGE}")
+            _repository = PostgresRepository() if STORAGE == 'postgres' else SQLiteRepository()
+        return _repository
@@ -0,0 +1,118 @@
+import argparse
+import contextvars
+import os
+from contextlib import contextmanager
+
+# Ogni insegnante o scuola è un tenant: studenti, materie, lezioni e serie hanno una colonna
+# tenant_id e tutte le query filtrano sul tenant corrente, impostato per la sessione con activate()
+# o per un blocco di codice con tenant_scope().
+DEFAULT_TENANT = int(os.environ.get('PLANNER_TENANT', '1'))
+
+# Con PLANNER_SHARD_DIR ogni tenant ha un proprio file SQLite in questa directory, così le
+# scritture di un tenant non bloccano gli altri. Gli account (tabella users) restano nel
+# database principale, che fa da elenco per il login.
+SHARD_DIR = os.environ.get('PLANNER_SHARD_DIR')
+
+# Tabelle con colonna tenant_id, nell'ordine in cui copiarle in uno shard
+TENANT_TABLES = ['students', 'subjects', 'lesson_series', 'lessons']
+
+_tenant = contextvars.ContextVar('tenant', default=None)
+_directory = contextvars.ContextVar('directory', default=False)
+
+
+def current_tenant():
+    tenant = _tenant.get()
+    return DEFAULT_TENANT if tenant is None else tenant
+
+
+def activate(tenant_id):
+    # Imposta il tenant per il resto del contesto corrente (ad esempio un'esecuzione dello script Streamlit)
+    _tenant.set(int(tenant_id))
+
+
+@contextmanager
+def tenant_scope(tenant_id):
+    token = _tenant.set(int(tenant_id))
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+@contextmanager
+def directory():
+    # Accesso al database principale (account utente) anche quando i tenant sono su shard separati
+    token = _directory.set(True)
+    try:
+        yield
+    finally:
+        _directory.reset(token)
+
+
+def shard_path(tenant_id):
+    return os.path.join(SHARD_DIR, f'tenant_{int(tenant_id)}.db')
+
+
+def database_path(default):
+    # File su cui eseguire le query del contesto corrente
+    if SHARD_DIR is None or _directory.get():
+        return default
+    return shard_path(current_tenant())
+
+
+def split_tenant(tenant_id):
+    # Copia i dati di un tenant dal database principale al suo shard, in un'unica transazione
+    # sullo shard. I trigger dello shard ricostruiscono billing_summary durante la copia delle lezioni.
+    # Le righe originali restano nel database principale finché non vengono rimosse a mano.
+    from connection import DB_PATH, get_connection, transaction
+
+    if SHARD_DIR is None:
+        raise RuntimeError("PLANNER_SHARD_DIR non impostata")
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    copied = {}
+    with tenant_scope(tenant_id), get_connection() as conn:
+        if conn.execute('SELECT EXISTS (SELECT 1 FROM students)').fetchone()[0]:
+            raise RuntimeError(f"Lo shard del tenant {tenant_id} contiene già dati")
+        # ATTACH non è ammesso dentro una transazione
+        conn.execute('ATTACH DATABASE ? AS source', (DB_PATH,))
+        try:
+            with transaction():
+                for table in TENANT_TABLES:
+                    columns = ', '.join(r[1] for r in conn.execute(f'PRAGMA source.table_info({table})'))
+                    copied[table] = conn.execute(
+                        f'''INSERT INTO main.{table} ({columns})
+                            SELECT {columns} FROM source.{table} WHERE tenant_id = ?''',
+                        (int(tenant_id),)).rowcount
+                conn.execute('''INSERT INTO main.lesson_series_exceptions
+                                SELECT * FROM source.lesson_series_exceptions
+                                WHERE series_id IN (SELECT id FROM main.lesson_series)''')
+                conn.execute('''INSERT INTO main.invoices
+                                SELECT * FROM source.invoices WHERE student_id IN (SELECT id FROM main.students)''')
+        finally:
+            conn.execute('DETACH DATABASE source')
+    return copied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gestione dei tenant')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    teacher = subparsers.add_parser('add-teacher', help='crea un account insegnante')
+    teacher.add_argument('username')
+    teacher.add_argument('password')
+    teacher.add_argument('--tenant', type=int, help='tenant esistente (predefinito: nuovo tenant)')
+    split = subparsers.add_parser('split', help='copia un tenant nel proprio shard')
+    split.add_argument('tenant', type=int)
+    args = parser.parse_args()
+
+    # Eseguito come script questo modulo è __main__: il contesto del tenant va impostato
+    # sul modulo tenancy importato da connection
+    import tenancy
+    from database import create_teacher, init_db
+    init_db()
+
+    if args.command == 'add-teacher':
+        success, message = create_teacher(args.username, args.password, args.tenant)
+        print(message)
+    else:
+        for table, count in tenancy.split_tenant(args.tenant).items():
+            print(f"{table}: {count} righe copiate")
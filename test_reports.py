@@ -0,0 +1,37 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import connection
+import query_cache
+import recurrence
+import reports
+from database import add_lesson, add_student, add_subject, init_db
+
+START, END = date(2025, 1, 15), date(2025, 3, 20)
+
+
+@pytest.fixture
+def planner_db(tmp_path):
+    connection.configure(str(tmp_path / 'planner.db'))
+    query_cache.clear()
+    init_db()
+    anna = add_student('Anna', 'anna@esempio.it', 20)
+    luca = add_student('Luca', 'luca@esempio.it', 30)
+    subject = add_subject('Matematica', 1)
+    for student, day, duration in [(anna, '2025-01-10', 1), (anna, '2025-01-20', 1.5), (luca, '2025-01-20', 2),
+                                   (luca, '2025-02-03', 1), (anna, '2025-02-28', 1), (luca, '2025-03-20', 0.5),
+                                   (anna, '2025-03-21', 1)]:
+        add_lesson(student, subject, day, duration, None)
+    recurrence.add_series(luca, subject, date(2025, 3, 1), [2], 1, None, end_date=date(2025, 4, 30))
+    yield
+    connection.configure(connection.DB_PATH)
+    query_cache.clear()
+
+
+@pytest.mark.parametrize('period', list(reports.PERIODS))
+def test_report_totals_match_pandas(planner_db, period):
+    sql = reports.get_report_totals(START, END, period)
+    expected = reports.get_report_totals_pandas(START, END, period)
+    pd.testing.assert_frame_equal(sql, expected, check_dtype=False, check_freq=False)